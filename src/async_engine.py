@@ -0,0 +1,293 @@
+"""The asyncio engine: MLLP feeds, processing and paging on one event loop.
+
+Selected with --engine asyncio. Each feed is read with asyncio streams and
+acknowledged in order, windows are processed in a worker thread, and pages
+are sent by an `AsyncPagerDispatcher`.
+"""
+
+import asyncio
+import concurrent.futures
+import time
+import signal
+import socket
+import logging
+
+import prediction_core
+from prediction_core import (ACK, AKIPredictor, MESSAGE_QUEUE_SIZE,
+                             MLLP_CARRIAGE_RETURN, MLLP_END_OF_BLOCK,
+                             MLLP_RECEIVE_BUFFER_SIZE, MLLP_START_OF_BLOCK,
+                             ProcessingOptions, from_mllp, process_window,
+                             stop_event, to_mllp)
+from pager import AsyncPagerDispatcher
+
+
+# Separator ending every MLLP frame, read up to by the asyncio engine.
+MLLP_END_OF_FRAME = bytes([MLLP_END_OF_BLOCK, MLLP_CARRIAGE_RETURN])
+
+
+class AsyncQueuedMessage:
+    """An HL7 message handed over to the processor by the asyncio engine.
+
+    Attributes:
+        segments (list[str]): The HL7 message split into string segments.
+        processed (asyncio.Future): Resolved by the processor once the message
+                                    has been fully handled and may be ACKed.
+    """
+
+    __slots__ = ("segments", "processed")
+
+    def __init__(self, segments: list[str]):
+        self.segments = segments
+        self.processed = asyncio.get_running_loop().create_future()
+
+
+async def async_message_receiver(address: tuple[str, int],
+                                 pipeline: asyncio.Queue,
+                                 max_retries: int = 1100,
+                                 base_delay: float = 1.0,
+                                 max_delay: float = 30.0,
+                                 feed: str | None = None) -> None:
+    """Receives HL7 messages with asyncio streams and queues them.
+
+    The asyncio counterpart of `message_receiver`. Frames are read with
+    `StreamReader.readuntil`, queued on `pipeline` as they arrive, and
+    acknowledged in arrival order by a separate task as the processor
+    resolves them, so reading never waits for processing.
+
+    Args:
+        address (tuple[str, int]): Hostname and port number of the MLLP
+                                   server.
+        pipeline (asyncio.Queue): Queue of `AsyncQueuedMessage` consumed by
+                                  `async_processor`.
+        max_retries (int): Maximum number of reconnection attempts.
+        base_delay (float): Initial delay between reconnection attempts
+                            in seconds.
+        max_delay (float): Maximum delay between reconnection attempts
+                           in seconds.
+        feed (str): Name of the feed in logs and metrics. Defaults to
+                    'hostname:port'.
+    """
+    attempt_count = 0
+    delay = base_delay
+    feed = feed or f"{address[0]}:{address[1]}"
+    received = prediction_core.FEED_MESSAGES_RECEIVED.labels(feed)
+
+    while attempt_count < max_retries:
+        writer = None
+        acknowledger = None
+        try:
+            print(f"Attempting to connect to {feed}...")
+            reader, writer = await asyncio.open_connection(
+                *address, limit=MLLP_RECEIVE_BUFFER_SIZE)
+            # ACKs are small writes; do not hold them back (Nagle).
+            writer.get_extra_info('socket').setsockopt(
+                socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Connected to {feed}!")
+            prediction_core.MLLP_SOCKET_CONNECTIONS.inc()
+            attempt_count = 0  # Reset attempt_count
+            delay = base_delay
+
+            in_flight = asyncio.Queue()
+            acknowledger = asyncio.create_task(
+                acknowledge_in_order(writer, in_flight, feed))
+            while True:
+                frame = await reader.readuntil(MLLP_END_OF_FRAME)
+                start = frame.find(MLLP_START_OF_BLOCK)
+                if start < 0:
+                    continue
+                restart = frame.rfind(MLLP_START_OF_BLOCK, start + 1)
+                if restart != -1:  # As in `MLLPFrameDecoder.decode`.
+                    logging.error(f"Dropped an MLLP frame of "
+                                  f"{restart - start - 1} bytes without an "
+                                  f"end marker: a new frame started")
+                    start = restart
+                item = AsyncQueuedMessage(from_mllp(frame[start:]))
+                received_at = time.monotonic()
+                await pipeline.put(item)
+                prediction_core.MESSAGES_RECEIVED.inc()
+                received.inc()
+                in_flight.put_nowait((item.processed, received_at))
+                if acknowledger.done():
+                    acknowledger.result()  # Raises the error that ended it
+
+        except (OSError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError) as e:
+            print(f"An error occurred on {feed}: {e!r}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_delay)  # Exponential backoff with a max
+            attempt_count += 1
+            prediction_core.FEED_RECONNECTIONS.labels(feed).inc()
+            print(f"Attempting to reconnect to {feed}, attempt "
+                  f"{attempt_count}.")
+        finally:
+            if acknowledger is not None:
+                acknowledger.cancel()
+            if writer is not None:
+                writer.close()
+
+    print(f"Maximum reconnection attempts to {feed} reached, stopping.")
+
+
+async def acknowledge_in_order(writer: asyncio.StreamWriter,
+                               in_flight: asyncio.Queue, feed: str) -> None:
+    """Sends an ACK for each message, in arrival order, once it is processed.
+
+    The ACKs of consecutive messages that are already processed are sent
+    in a single write.
+
+    Args:
+        writer (asyncio.StreamWriter): The MLLP connection.
+        in_flight (asyncio.Queue): The messages' `processed` futures and
+                                   receive times, in arrival order.
+        feed (str): Name of the feed in metrics.
+    """
+    ack = to_mllp(ACK)
+    acknowledged = prediction_core.FEED_MESSAGES_ACKNOWLEDGED.labels(feed)
+    lag = prediction_core.FEED_ACKNOWLEDGEMENT_LAG.labels(feed)
+    pending, received_at = await in_flight.get()
+    oldest = received_at
+    ready = 0
+    while True:
+        await pending
+        ready += 1
+        try:
+            pending, received_at = in_flight.get_nowait()
+        except asyncio.QueueEmpty:
+            pending = None
+        if pending is None or not pending.done():
+            writer.write(ack * ready)
+            await writer.drain()
+            prediction_core.MESSAGES_ACKNOWLEDGED.inc(ready)
+            acknowledged.inc(ready)
+            lag.observe(time.monotonic() - oldest)
+            ready = 0
+            if pending is None:
+                pending, received_at = await in_flight.get()
+            oldest = received_at
+
+
+async def collect_window_async(pipeline: asyncio.Queue,
+                               first: AsyncQueuedMessage, max_size: int,
+                               max_latency: float) -> list:
+    """Gathers a window of queued messages, like `collect_window`."""
+    window = [first]
+    deadline = time.monotonic() + max_latency
+    while len(window) < max_size:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                window.append(await asyncio.wait_for(pipeline.get(),
+                                                     remaining))
+            else:
+                window.append(pipeline.get_nowait())
+        except (asyncio.TimeoutError, asyncio.QueueEmpty):
+            break
+    return window
+
+
+async def async_processor(address: str, model, pipeline: asyncio.Queue,
+                          options: ProcessingOptions | None = None,
+                          pager_send=None) -> None:
+    """Processes queued messages for the asyncio engine.
+
+    The asyncio counterpart of `processor`. Windows of messages are taken
+    from `pipeline` and handed to the `AKIPredictor` on a single worker
+    thread, which owns the SQLite connections and the model and keeps the
+    messages in order. Positive predictions are paged by an
+    `AsyncPagerDispatcher` whose database work runs on the same thread.
+
+    Args:
+        address (str): Address to send notifications to, if necessary.
+        model: Pretrained Machine learning model for predictions.
+        pipeline (asyncio.Queue): Queue of `AsyncQueuedMessage` to process.
+        options (ProcessingOptions): Database, paging, batching and patient
+                                     state settings; the defaults if None.
+        pager_send (callable): Optional coroutine function replacing the
+                               pager HTTP client, see `AsyncPagerDispatcher`.
+    """
+    options = options or ProcessingOptions()
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(
+        max_workers=1, thread_name_prefix="aki-predictor")
+    aki_predictor = AKIPredictor(
+        model, options.db_path, cache_size=options.cache_size,
+        patient_store=options.patient_store,
+        history_snapshot=options.history_snapshot,
+        decision_mode=options.decision_mode,
+        metrics_count_flag=options.metrics_count_flag)
+    if options.model_reloader is not None:
+        options.model_reloader.register(aki_predictor, model)
+    dispatcher = AsyncPagerDispatcher(
+        address, options.db_path, options.max_retries, options.retry_delay,
+        metrics_count_flag=options.metrics_count_flag, send=pager_send,
+        executor=executor)
+    try:
+        await dispatcher.start()
+        if options.patient_store is None and options.history_snapshot is None:
+            warmed = await loop.run_in_executor(executor,
+                                                aki_predictor.warm_cache)
+            print(f"Patient cache warmed with {warmed} records.")
+        for mrn in await loop.run_in_executor(
+                executor, aki_predictor.resume_pending_predictions):
+            await dispatcher.submit(mrn)
+
+        while True:
+            window = await collect_window_async(
+                pipeline, await pipeline.get(), options.batch_size,
+                options.batch_latency)
+            results = await loop.run_in_executor(
+                executor, process_window, aki_predictor,
+                [queued.segments for queued in window])
+            if results is None:
+                break  # Stopping: the window is never acknowledged.
+            try:
+                for mrn in results:
+                    if mrn:
+                        await dispatcher.submit(mrn)
+            finally:
+                # Release the window for acknowledgement.
+                for queued in window:
+                    if not queued.processed.done():
+                        queued.processed.set_result(None)
+    finally:
+        await dispatcher.close()
+        await loop.run_in_executor(executor, aki_predictor.close)
+        executor.shutdown()
+
+
+async def run_async_engine(mllp_addresses: list[tuple[str, int]],
+                           pager_address: str, model,
+                           options: ProcessingOptions | None = None) -> None:
+    """Runs the asyncio engine until SIGTERM/SIGINT or a task ends.
+
+    Args:
+        mllp_addresses (list[tuple[str, int]]): Hostname and port of every
+                                                MLLP feed.
+        pager_address (str): Address of the pager service.
+        model: Pretrained Machine learning model for predictions.
+        options (ProcessingOptions): Settings passed to `async_processor`.
+    """
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signal_number in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signal_number, stopping.set)
+
+    pipeline = asyncio.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+    tasks = [asyncio.create_task(async_processor(pager_address, model,
+                                                 pipeline, options))]
+    tasks += [asyncio.create_task(async_message_receiver(address, pipeline))
+              for address in mllp_addresses]
+    stop = asyncio.create_task(stopping.wait())
+    try:
+        await asyncio.wait([stop, *tasks],
+                           return_when=asyncio.FIRST_COMPLETED)
+        print("Stopping tasks...")
+    finally:
+        stop_event.set()
+        for task in (stop, *tasks):
+            task.cancel()
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                print(f"An error occurred: {result!r}")
+        for signal_number in (signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signal_number)
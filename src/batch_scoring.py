@@ -0,0 +1,285 @@
+"""The `batch` command: offline scoring of CSV files and MLLP replays."""
+
+import os
+import time
+import concurrent.futures
+import multiprocessing
+import threading
+import queue
+import contextlib
+import collections
+import csv
+import itertools
+import warnings
+import sqlite3
+import tempfile
+import numpy as np
+
+from prediction_core import (BATCH_CHUNK_SIZE, BatchScores, KDIGORules,
+                             MLLPFrameDecoder, PATIENT_CACHE_SIZE,
+                             PATIENT_HISTORY_TABLE_SQL, PICKLED_MODEL_PATH,
+                             build_history_snapshot, csv_chunk_features,
+                             load_model, message_shard, read_csv_chunks,
+                             shard_worker)
+
+
+# How many chunks per process are scored ahead of the one being written,
+# which bounds the memory use of the `batch` command.
+BATCH_CHUNKS_IN_FLIGHT = 2
+
+# Bytes read from an MLLP input at a time.
+BATCH_READ_SIZE = 1024 * 1024
+
+
+def read_mllp_messages(path: str, read_size: int = BATCH_READ_SIZE):
+    """Yields the HL7 messages of an MLLP replay file, split into segments."""
+    decoder = MLLPFrameDecoder()
+    with open(path, 'rb') as file:
+        while data := file.read(read_size):
+            decoder.feed(data)
+            yield from decoder.decode()
+
+
+# The model and rules of a batch scoring process, set by
+# `start_batch_worker`.
+_batch_model = None
+_batch_rules = None
+
+
+def start_batch_worker(model_path: str, decision_mode: str) -> None:
+    """Loads the model of a batch scoring process."""
+    global _batch_model, _batch_rules
+    warnings.filterwarnings("ignore")
+    _batch_model = load_model(model_path)
+    _batch_rules = KDIGORules(decision_mode)
+
+
+def score_csv_chunk(rows: list[list[str]]) -> np.ndarray:
+    """Predicts AKI for a chunk of CSV rows with one model call.
+
+    Returns:
+        np.ndarray: A boolean array, True where AKI is predicted.
+    """
+    features, latest, minimum, median = csv_chunk_features(rows)
+    return _batch_rules.predict(_batch_model, features, latest, minimum,
+                                median)
+
+
+def batch_score_csv(input_path: str, output_path: str, model_path: str,
+                    labels_path: str | None = None,
+                    decision_mode: str = 'model',
+                    chunk_size: int = BATCH_CHUNK_SIZE,
+                    processes: int = 1) -> tuple[int, BatchScores | None]:
+    """Scores every row of a test_f3.csv-style CSV file.
+
+    Chunks of rows are scored on `processes` processes while earlier ones
+    are written out, so memory use does not grow with the input.
+
+    Args:
+        input_path (str): The CSV file to score.
+        output_path (str): Where to write the predictions, in the format of
+                           labels_f3.csv: an 'aki' column of 'y' and 'n'.
+        model_path (str): Compiled (.npz) or pickled model to score with.
+        labels_path (str): Optional labels of the rows, as in
+                           labels_f3.csv.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES.
+        chunk_size (int): Number of rows scored together.
+        processes (int): Number of scoring processes; 1 scores in this
+                         process.
+
+    Returns:
+        tuple[int, Optional[BatchScores]]: The number of rows scored, and
+                                           their scores against the labels
+                                           if given.
+    """
+    scores = None if labels_path is None else BatchScores()
+    scored = 0
+    with contextlib.ExitStack() as stack:
+        output = stack.enter_context(open(output_path, 'w', newline=''))
+        output.write("aki\n")
+        labels = None
+        if labels_path is not None:
+            labels = csv.reader(stack.enter_context(open(labels_path, 'r')))
+            next(labels, None)
+
+        def write(predictions: np.ndarray) -> None:
+            nonlocal scored
+            output.writelines("y\n" if aki else "n\n" for aki in predictions)
+            if labels is not None:
+                chunk_labels = np.array(
+                    [row[0].lower() == 'y'
+                     for row in itertools.islice(labels, len(predictions))])
+                if len(chunk_labels) != len(predictions):
+                    raise ValueError(f"'{labels_path}' has fewer labels "
+                                     f"than '{input_path}' has rows")
+                scores.update(predictions, chunk_labels)
+            scored += len(predictions)
+
+        chunks = read_csv_chunks(input_path, chunk_size)
+        if processes <= 1:
+            start_batch_worker(model_path, decision_mode)
+            for rows in chunks:
+                write(score_csv_chunk(rows))
+            return scored, scores
+
+        executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context("spawn"),
+            initializer=start_batch_worker,
+            initargs=(model_path, decision_mode)))
+        in_flight = collections.deque()
+        for rows in chunks:
+            in_flight.append(executor.submit(score_csv_chunk, rows))
+            if len(in_flight) >= processes * BATCH_CHUNKS_IN_FLIGHT:
+                write(in_flight.popleft().result())
+        while in_flight:
+            write(in_flight.popleft().result())
+    return scored, scores
+
+
+def _forward_results(connection, results: queue.Queue) -> None:
+    """Moves a shard worker's results to a queue until it exits.
+
+    Batch scoring publishes no metrics, so the workers' metrics are dropped.
+    """
+    while True:
+        try:
+            results.put(connection.recv()[0])
+        except EOFError:
+            results.put(None)
+            return
+
+
+def batch_score_mllp(input_path: str, output_path: str, model,
+                     history_snapshot: str, directory: str,
+                     decision_mode: str = 'model',
+                     chunk_size: int = BATCH_CHUNK_SIZE,
+                     processes: int = 1,
+                     cache_size: int = PATIENT_CACHE_SIZE) -> int:
+    """Replays an MLLP file through `shard_worker` processes, without paging.
+
+    Each chunk of messages is split by `message_shard` and its parts are
+    scored concurrently, every shard applying its part with one model call.
+    Patient state starts from the history snapshot, in a new database in
+    `directory`, so the live database is never touched.
+
+    Args:
+        input_path (str): The MLLP replay file.
+        output_path (str): Where to write the positive predictions, as
+                           'message,mrn' rows where 'message' is the index
+                           of the triggering message in the file.
+        model: Pretrained Machine learning model, copied to every process.
+        history_snapshot (str): History snapshot to start from.
+        directory (str): Directory for the replay's database.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES.
+        chunk_size (int): Number of messages split across the shards at a
+                          time.
+        processes (int): Number of shard processes.
+        cache_size (int): Maximum number of patients held by each process.
+
+    Returns:
+        int: The number of messages scored.
+    """
+    db_path = os.path.join(directory, "batch.db")
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(PATIENT_HISTORY_TABLE_SQL)
+
+    processes = max(processes, 1)
+    context = multiprocessing.get_context("spawn")
+    shards = []
+    for shard in range(processes):
+        requests_reader, requests = context.Pipe(duplex=False)
+        results_reader, results_writer = context.Pipe(duplex=False)
+        process = context.Process(
+            target=shard_worker, name=f"aki-batch-{shard}", daemon=True,
+            args=(requests_reader, results_writer, shard, processes, model,
+                  db_path, cache_size, history_snapshot, decision_mode))
+        process.start()
+        requests_reader.close()
+        results_writer.close()
+        # A thread per shard keeps its results flowing while windows are
+        # sent, so neither side can block on a full pipe.
+        results = queue.Queue()
+        threading.Thread(target=_forward_results,
+                         args=(results_reader, results), daemon=True).start()
+        shards.append((process, requests, results))
+    for shard, (_, _, results) in enumerate(shards):
+        if results.get() is None:  # Otherwise the resumed predictions.
+            raise RuntimeError(f"batch shard {shard} failed to start")
+
+    scored = 0
+    with open(output_path, 'w', newline='') as output:
+        output.write("message,mrn\n")
+
+        def write(parts: list) -> None:
+            positives = []
+            for shard, indices in parts:
+                results = shards[shard][2].get()
+                if results is None:
+                    raise RuntimeError(f"batch shard {shard} exited")
+                positives += [(index, mrn)
+                              for index, mrn in zip(indices, results) if mrn]
+            output.writelines(f"{index},{mrn}\n"
+                              for index, mrn in sorted(positives))
+
+        in_flight = collections.deque()
+        try:
+            messages = enumerate(read_mllp_messages(input_path))
+            while chunk := list(itertools.islice(messages, chunk_size)):
+                indices = [[] for _ in shards]
+                windows = [[] for _ in shards]
+                for index, message in chunk:
+                    shard = message_shard(message, processes)
+                    indices[shard].append(index)
+                    windows[shard].append(message)
+                parts = []
+                for shard, window in enumerate(windows):
+                    if window:
+                        shards[shard][1].send(window)
+                        parts.append((shard, indices[shard]))
+                in_flight.append(parts)
+                scored += len(chunk)
+                if len(in_flight) > BATCH_CHUNKS_IN_FLIGHT:
+                    write(in_flight.popleft())
+            while in_flight:
+                write(in_flight.popleft())
+        finally:
+            for process, requests, _ in shards:
+                requests.close()
+            for process, _, _ in shards:
+                process.join(timeout=10)
+                if process.is_alive():
+                    process.terminate()
+    return scored
+
+
+def run_batch(flags) -> None:
+    """Runs the `batch` command with the parsed command-line flags."""
+    model_path = flags.model_path
+    if not os.path.exists(model_path):
+        model_path = PICKLED_MODEL_PATH
+    output_path = flags.output or \
+        f"{os.path.splitext(flags.input)[0]}_predictions.csv"
+    scores = None
+    started = time.perf_counter()
+    if flags.input.endswith(".mllp"):
+        with tempfile.TemporaryDirectory() as directory:
+            history_snapshot = flags.history_snapshot
+            if history_snapshot is None:
+                history_snapshot = os.path.join(directory, "history.db")
+                build_history_snapshot(flags.pathname, history_snapshot)
+            scored = batch_score_mllp(
+                flags.input, output_path, load_model(model_path),
+                history_snapshot, directory, flags.decision_mode,
+                flags.chunk_size, flags.processes)
+    else:
+        scored, scores = batch_score_csv(
+            flags.input, output_path, model_path, flags.labels,
+            flags.decision_mode, flags.chunk_size, flags.processes)
+    elapsed = time.perf_counter() - started
+    print(f"Scored {scored} in {elapsed:.2f}s "
+          f"({scored / max(elapsed, 1e-9):.0f}/s), predictions written to "
+          f"'{output_path}'.")
+    if scores is not None:
+        print(f"F3: {scores.f_score():.4f}, precision: "
+              f"{scores.precision():.4f}, recall: {scores.recall():.4f}")
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+"""Measures the receiver to processor hand-off before and after a change.
+
+Each revision's `src/prediction_system.py` is exported from git and run
+against a local MLLP sender that acts as the hospital feed. With the
+connection open and no messages sent, the service's CPU use is sampled
+from /proc (a busy-waiting hand-off shows up here). Then LIMS messages are
+sent one at a time, each only after the previous one was ACKed, and the
+time from sending a message to receiving its ACK is recorded.
+
+The default revisions are the commit that replaced the spin-wait ACK
+handshake with a blocking queue and its parent. Both load
+models/trained_model.pkl, so the script is run from the repository root.
+
+Example:
+    python src/benchmark_handoff.py --messages data/messages.mllp \\
+        --count 500
+"""
+
+import argparse
+import http.server
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import simulator
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+class PagerHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts every page, so that paging costs the same in each run."""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def cpu_seconds(pid: int) -> float:
+    """Returns the user and system CPU time used so far by process `pid`."""
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime are fields 14 and 15 of proc(5), counted from the pid.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def export_revision(revision: str, directory: str) -> str:
+    """Writes `revision`'s src/*.py modules to `directory`.
+
+    Returns:
+        str: The path of the exported prediction_system.py.
+    """
+    names = subprocess.run(
+        ["git", "ls-tree", "--full-tree", "--name-only", revision,
+         "src/"],
+        cwd=SOURCE_DIRECTORY, check=True, capture_output=True,
+        text=True).stdout.split()
+    for name in names:
+        if not name.endswith(".py"):
+            continue
+        source = subprocess.run(
+            ["git", "show", f"{revision}:{name}"],
+            cwd=SOURCE_DIRECTORY, check=True, capture_output=True).stdout
+        with open(os.path.join(directory, os.path.basename(name)), "wb") as f:
+            f.write(source)
+    return os.path.join(directory, "prediction_system.py")
+
+
+def read_frame(connection: socket.socket, buffer: bytearray) -> bytes:
+    """Reads one MLLP frame, such as an ACK, from the connection."""
+    end = bytes([simulator.MLLP_END_OF_BLOCK,
+                 simulator.MLLP_CARRIAGE_RETURN])
+    while end not in buffer:
+        received = connection.recv(4096)
+        if not received:
+            raise ConnectionError("The prediction system closed the feed")
+        buffer += received
+    frame, _, rest = bytes(buffer).partition(end)
+    buffer[:] = rest
+    return frame
+
+
+def run(revision: str, messages: list[bytes], flags,
+        directory: str) -> tuple[float, list[float]]:
+    """Runs one revision of the prediction system against the sender.
+
+    Returns:
+        tuple[float, list[float]]: The share of a core used while idle, and
+                                   the seconds from sending each message to
+                                   receiving its ACK.
+    """
+    state = tempfile.mkdtemp(dir=directory)
+    program = export_revision(revision, state)
+
+    pager = http.server.ThreadingHTTPServer(("localhost", 0), PagerHandler)
+    threading.Thread(target=pager.serve_forever, daemon=True).start()
+    feed = socket.create_server(("localhost", 0))
+    environment = dict(
+        os.environ,
+        MLLP_ADDRESS=f"localhost:{feed.getsockname()[1]}",
+        PAGER_ADDRESS=f"localhost:{pager.server_address[1]}")
+    with open(os.path.join(state, "service.log"), "w") as log:
+        service = subprocess.Popen(
+            [sys.executable, "-u", program,
+             f"--pathname={flags.pathname}",
+             f"--db_path={os.path.join(state, 'db.db')}",
+             f"--metrics_path={os.path.join(state, 'counters.json')}"],
+            env=environment, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            feed.settimeout(flags.timeout)
+            connection, _ = feed.accept()
+            with connection:
+                time.sleep(flags.settle)
+                before = cpu_seconds(service.pid)
+                time.sleep(flags.idle)
+                idle_cpu = (cpu_seconds(service.pid) - before) / flags.idle
+
+                connection.settimeout(flags.timeout)
+                buffer = bytearray()
+                latencies = []
+                for message in messages:
+                    start = time.perf_counter()
+                    connection.sendall(
+                        bytes([simulator.MLLP_START_OF_BLOCK]) + message
+                        + bytes([simulator.MLLP_END_OF_BLOCK,
+                                 simulator.MLLP_CARRIAGE_RETURN]))
+                    read_frame(connection, buffer)
+                    latencies.append(time.perf_counter() - start)
+        finally:
+            service.terminate()
+            service.wait()
+            feed.close()
+            pager.shutdown()
+    return idle_cpu, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", default="data/messages.mllp",
+                        help="HL7 messages to replay, in MLLP format")
+    parser.add_argument("--pathname",
+                        default="data/hospital-history/history.csv")
+    parser.add_argument("--revisions", default=["b1ea19f^", "b1ea19f"],
+                        nargs="+", help="Git revisions to measure")
+    parser.add_argument("--count", default=500, type=int,
+                        help="Number of LIMS messages to send")
+    parser.add_argument("--settle", default=2, type=float,
+                        help="Seconds to wait after the service connects")
+    parser.add_argument("--idle", default=5, type=float,
+                        help="Seconds over which idle CPU is measured")
+    parser.add_argument("--timeout", default=600, type=float,
+                        help="Maximum wait for the service, in seconds")
+    flags = parser.parse_args()
+
+    messages = [message
+                for message in simulator.read_hl7_messages(flags.messages)
+                if message.split(b"|", 9)[8:9] == [b"ORU^R01"]]
+    messages = messages[:flags.count]
+    print(f"{len(messages)} LIMS messages, one in flight")
+    print(f"{'revision':>12} {'idle CPU':>9} {'median ms':>10} "
+          f"{'p99 ms':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for revision in flags.revisions:
+            idle_cpu, latencies = run(revision, messages, flags, directory)
+            p99 = statistics.quantiles(latencies, n=100)[98]
+            print(f"{revision:>12} {idle_cpu:>8.1%} "
+                  f"{statistics.median(latencies) * 1e3:>10.2f} "
+                  f"{p99 * 1e3:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""Compares HL7 field extraction with and without `HL7Message`.
+
+Both variants read the fields the predictor uses from every message of a
+replay corpus: the message type, timestamp and MRN, then the test type and
+result of LIMS messages or the date of birth and sex of PAS messages.
+`split_per_field` splits a segment for every field, as the predictor did
+before `HL7Message`.
+
+Example:
+    python src/benchmark_hl7_parsing.py --messages data/messages.mllp
+"""
+
+import argparse
+import timeit
+
+import simulator
+from prediction_core import HL7Message
+
+
+def split_per_field(message: list[str]) -> tuple:
+    message_type = message[0].split("|")[8]
+    mrn = message[1].split("|")[3]
+    timestamp = message[0].split("|")[6]
+    if message_type == "ORU^R01":
+        return (message_type, mrn, timestamp, message[3].split("|")[3],
+                message[3].split("|")[5])
+    if message_type == "ADT^A01":
+        return (message_type, mrn, timestamp, message[1].split("|")[7],
+                message[1].split("|")[8])
+    return message_type, mrn, timestamp
+
+
+def hl7_message(message: list[str]) -> tuple:
+    hl7 = HL7Message(message)
+    message_type = hl7.message_type
+    mrn = hl7.mrn
+    timestamp = hl7.timestamp
+    if message_type == "ORU^R01":
+        return message_type, mrn, timestamp, hl7.test_type, hl7.test_result
+    if message_type == "ADT^A01":
+        return message_type, mrn, timestamp, hl7.date_of_birth, hl7.sex
+    return message_type, mrn, timestamp
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", default="data/messages.mllp",
+                        help="HL7 messages to replay, in MLLP format")
+    parser.add_argument("--repeat", default=7, type=int)
+    flags = parser.parse_args()
+
+    messages = [str(message, "ascii").split("\r")
+                for message in simulator.read_hl7_messages(flags.messages)]
+    for message in messages:
+        if split_per_field(message) != hl7_message(message):
+            raise AssertionError(f"Fields differ for {message!r}")
+
+    print(f"{len(messages)} messages")
+    baseline = None
+    for extract in (split_per_field, hl7_message):
+        seconds = min(timeit.repeat(
+            lambda: [extract(message) for message in messages],
+            number=10, repeat=flags.repeat)) / 10
+        per_message = seconds / len(messages) * 1e9
+        baseline = baseline or per_message
+        print(f"{extract.__name__:>16}: {per_message:7.0f} ns/message "
+              f"({baseline / per_message:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Measures the per-message cost of the processing metrics.
+
+Replays a corpus of HL7 messages through an `AKIPredictor` twice, once with
+metrics counting disabled and once with it enabled, and reports the
+difference per message, including the cost of publishing the metrics to
+Prometheus at the end. Patient state is kept in a `ColumnarPatientStore`
+without a database, so that database time does not drown out the
+metrics.
+
+Example:
+    python src/benchmark_metrics.py --messages data/messages.mllp \\
+        --model_path models/trained_model.npz
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+
+import prediction_core
+import simulator
+from prediction_core import AKIPredictor, ColumnarPatientStore
+
+
+def replay(model, messages: list[list[str]], metrics: bool) -> float:
+    """Returns the seconds taken to process every message."""
+    predictor = AKIPredictor(model, db_path=None, metrics_count_flag=metrics,
+                             patient_store=ColumnarPatientStore())
+    start = time.perf_counter()
+    for message in messages:
+        predictor.examine_message_and_predict_aki(message)
+    if metrics:
+        prediction_core.PROCESSING_METRICS.flush()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", default="data/messages.mllp",
+                        help="HL7 messages to replay, in MLLP format")
+    parser.add_argument("--model_path", default="models/trained_model.npz")
+    parser.add_argument("--repeat", default=15, type=int)
+    flags = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    with tempfile.TemporaryDirectory() as directory:
+        prediction_core.initialise_or_load_counters(
+            os.path.join(directory, "counter_state.json"))
+    model = prediction_core.load_model(flags.model_path)
+    messages = [str(message, "ascii").split("\r")
+                for message in simulator.read_hl7_messages(flags.messages)]
+
+    print(f"{len(messages)} messages")
+    timings = {False: [], True: []}
+    for _ in range(flags.repeat):
+        for metrics in timings:
+            timings[metrics].append(replay(model, messages, metrics))
+    without, with_metrics = (min(timings[False]) / len(messages) * 1e9,
+                             min(timings[True]) / len(messages) * 1e9)
+    print(f"without metrics: {without:8.0f} ns/message")
+    print(f"   with metrics: {with_metrics:8.0f} ns/message")
+    print(f"       overhead: {with_metrics - without:8.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Measures replay throughput against --batch_size and --batch_latency_ms.
+
+The simulator waits for each ACK before sending the next message, so it
+never holds more than one message in flight and cannot show the effect of
+committing a window of messages at once. Here a pipelining MLLP sender
+keeps up to --in_flight messages unacknowledged instead, and the time from
+the first message sent to the last ACK received is measured for each
+setting. With --in_flight 1 it replays like the simulator.
+
+Example:
+    python src/benchmark_replay.py --messages data/messages.mllp \\
+        --in_flight 64 --batch_sizes 1 64 --batch_latencies_ms 0 2
+"""
+
+import argparse
+import http.server
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import simulator
+from benchmark_handoff import PagerHandler, read_frame
+from benchmark_workers import watch
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def send(connection: socket.socket, messages: list[bytes],
+         window: threading.Semaphore) -> None:
+    """Sends every message, each once fewer than `in_flight` are unACKed."""
+    for message in messages:
+        window.acquire()
+        connection.sendall(bytes([simulator.MLLP_START_OF_BLOCK]) + message
+                           + bytes([simulator.MLLP_END_OF_BLOCK,
+                                    simulator.MLLP_CARRIAGE_RETURN]))
+
+
+def run(batch_size: int, batch_latency_ms: float, messages: list[bytes],
+        flags, directory: str) -> float:
+    """Replays the messages through one prediction system run.
+
+    Returns:
+        float: Seconds from sending the first message to the last ACK.
+    """
+    state = tempfile.mkdtemp(dir=directory)
+    pager = http.server.ThreadingHTTPServer(("localhost", 0), PagerHandler)
+    threading.Thread(target=pager.serve_forever, daemon=True).start()
+    feed = socket.create_server(("localhost", 0))
+    environment = dict(
+        os.environ,
+        MLLP_ADDRESS=f"localhost:{feed.getsockname()[1]}",
+        PAGER_ADDRESS=f"localhost:{pager.server_address[1]}")
+    events = {}
+    with open(os.path.join(state, "service.log"), "w") as log:
+        service = subprocess.Popen(
+            [sys.executable, "-u", os.path.join(SOURCE_DIRECTORY,
+                                                "prediction_system.py"),
+             f"--pathname={flags.pathname}",
+             f"--db_path={os.path.join(state, 'db.db')}",
+             f"--metrics_path={os.path.join(state, 'counters.json')}",
+             f"--model_path={flags.model_path}",
+             f"--batch_size={batch_size}",
+             f"--batch_latency_ms={batch_latency_ms}"],
+            env=environment, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True)
+        watcher = threading.Thread(target=watch, args=(service, events, log))
+        watcher.start()
+        try:
+            feed.settimeout(flags.timeout)
+            connection, _ = feed.accept()
+            with connection:
+                deadline = time.monotonic() + flags.timeout
+                while "ready" not in events:
+                    if time.monotonic() > deadline:
+                        raise RuntimeError(f"The prediction system did not "
+                                           f"start, see {state}/service.log")
+                    time.sleep(0.05)
+
+                connection.settimeout(flags.timeout)
+                window = threading.Semaphore(flags.in_flight)
+                start = time.perf_counter()
+                sender = threading.Thread(
+                    target=send, args=(connection, messages, window),
+                    daemon=True)
+                sender.start()
+                buffer = bytearray()
+                for _ in messages:
+                    read_frame(connection, buffer)
+                    window.release()
+                seconds = time.perf_counter() - start
+                sender.join()
+        finally:
+            service.terminate()
+            service.wait()
+            watcher.join()
+            feed.close()
+            pager.shutdown()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", default="data/messages.mllp",
+                        help="HL7 messages to replay, in MLLP format")
+    parser.add_argument("--pathname",
+                        default="data/hospital-history/history.csv")
+    parser.add_argument("--model_path", default="models/trained_model.npz")
+    parser.add_argument("--in_flight", default=64, type=int,
+                        help="Messages sent ahead of their ACKs")
+    parser.add_argument("--batch_sizes", default=[1, 64], type=int,
+                        nargs="+", help="--batch_size values to measure")
+    parser.add_argument("--batch_latencies_ms", default=[0], type=float,
+                        nargs="+",
+                        help="--batch_latency_ms values to measure")
+    parser.add_argument("--timeout", default=600, type=float,
+                        help="Maximum time per run, in seconds")
+    flags = parser.parse_args()
+
+    messages = simulator.read_hl7_messages(flags.messages)
+    print(f"{len(messages)} messages, {flags.in_flight} in flight")
+    print(f"{'batch_size':>10} {'latency ms':>11} {'seconds':>9} "
+          f"{'messages/s':>11}")
+    with tempfile.TemporaryDirectory() as directory:
+        for batch_size in flags.batch_sizes:
+            for batch_latency_ms in flags.batch_latencies_ms:
+                seconds = run(batch_size, batch_latency_ms, messages, flags,
+                              directory)
+                print(f"{batch_size:>10} {batch_latency_ms:>11g} "
+                      f"{seconds:>9.2f} {len(messages) / seconds:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""Measures how the prediction system's throughput scales with --workers.
+
+The HL7 messages are split by MRN into several feeds, each replayed by its
+own simulator, and the prediction system reads all of them at once
+(MLLP_ADDRESS lists every feed). The simulator waits for each ACK before
+sending the next message, so every feed holds one message in flight and
+enough feeds are needed to keep all workers busy.
+
+Example:
+    python src/benchmark_workers.py --messages data/messages.mllp \\
+        --feeds 16 --workers 1 2 4 8
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+
+import simulator
+
+SOURCE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def split_feeds(messages: list[bytes], feeds: int,
+                directory: str) -> list[str]:
+    """Writes the messages of each MRN shard to its own MLLP file."""
+    shards = [[] for _ in range(feeds)]
+    for message in messages:
+        segments = message.split(b"\r")
+        try:
+            mrn = segments[1].split(b"|")[3]
+        except IndexError:
+            mrn = b""
+        shards[zlib.crc32(mrn) % feeds].append(message)
+    paths = []
+    for index, shard in enumerate(shards):
+        path = os.path.join(directory, f"feed_{index}.mllp")
+        with open(path, "wb") as f:
+            for message in shard:
+                f.write(bytes([simulator.MLLP_START_OF_BLOCK]) + message
+                        + bytes([simulator.MLLP_END_OF_BLOCK,
+                                 simulator.MLLP_CARRIAGE_RETURN]))
+        paths.append(path)
+    return paths
+
+
+# Lines printed by the prediction system once it can process messages.
+READY_MESSAGES = ("Patient cache warmed with", "processing shards.")
+
+
+def watch(process: subprocess.Popen, events: dict, log=None) -> None:
+    """Records when a simulator is done or the prediction system is ready."""
+    for line in process.stdout:
+        if "end of messages" in line:
+            events["done"] = time.monotonic()
+        elif any(message in line for message in READY_MESSAGES):
+            events.setdefault("ready", time.monotonic())
+        if log is not None:
+            log.write(line)
+
+
+def run(workers: int, feed_paths: list[str], flags, directory: str) -> float:
+    """Replays every feed through one prediction system run.
+
+    Returns:
+        float: Seconds from the system being ready to the last ACK.
+    """
+    simulators = []
+    for path in feed_paths:
+        mllp_port, pager_port = free_port(), free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-u", os.path.join(SOURCE_DIRECTORY,
+                                                "simulator.py"),
+             f"--messages={path}", f"--mllp={mllp_port}",
+             f"--pager={pager_port}"],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        events = {}
+        threading.Thread(target=watch, args=(process, events),
+                         daemon=True).start()
+        simulators.append((process, mllp_port, pager_port, events))
+    time.sleep(1)
+
+    state = tempfile.mkdtemp(dir=directory)
+    environment = dict(
+        os.environ,
+        MLLP_ADDRESS=",".join(f"localhost:{mllp_port}"
+                              for _, mllp_port, _, _ in simulators),
+        PAGER_ADDRESS=f"localhost:{simulators[0][2]}")
+    service_events = {}
+    with open(os.path.join(state, "service.log"), "w") as log:
+        service = subprocess.Popen(
+            [sys.executable, "-u", os.path.join(SOURCE_DIRECTORY,
+                                                "prediction_system.py"),
+             f"--pathname={flags.pathname}",
+             f"--db_path={os.path.join(state, 'db.db')}",
+             f"--metrics_path={os.path.join(state, 'counters.json')}",
+             f"--model_path={flags.model_path}",
+             f"--batch_size={flags.batch_size}",
+             f"--workers={workers}"],
+            env=environment, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, text=True)
+        watcher = threading.Thread(target=watch,
+                                   args=(service, service_events, log))
+        watcher.start()
+        deadline = time.monotonic() + flags.timeout
+        while time.monotonic() < deadline and \
+                not all("done" in events for *_, events in simulators):
+            time.sleep(0.05)
+        service.terminate()
+        service.wait()
+        watcher.join()
+    for process, *_ in simulators:
+        process.terminate()
+        process.wait()
+
+    if not all("done" in events for *_, events in simulators):
+        raise RuntimeError(f"Feeds not replayed within {flags.timeout}s, "
+                           f"see {state}/service.log")
+    # Worker start-up is not measured: the simulators hold their first
+    # message until the prediction system is ready.
+    finished = max(events["done"] for *_, events in simulators)
+    return finished - service_events["ready"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", default="data/messages.mllp",
+                        help="HL7 messages to replay, in MLLP format")
+    parser.add_argument("--pathname",
+                        default="data/hospital-history/history.csv")
+    parser.add_argument("--model_path", default="models/trained_model.npz")
+    parser.add_argument("--feeds", default=16, type=int,
+                        help="Number of simulators the messages are split "
+                             "across")
+    parser.add_argument("--workers", default=[1, 2, 4, 8], type=int,
+                        nargs="+", help="Worker counts to measure")
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--timeout", default=600, type=float,
+                        help="Maximum time per run, in seconds")
+    flags = parser.parse_args()
+
+    messages = simulator.read_hl7_messages(flags.messages)
+    with tempfile.TemporaryDirectory() as directory:
+        feed_paths = split_feeds(messages, flags.feeds, directory)
+        print(f"{len(messages)} messages over {flags.feeds} feeds, "
+              f"{os.cpu_count()} CPUs")
+        print(f"{'workers':>8} {'seconds':>9} {'messages/s':>11} "
+              f"{'speedup':>8}")
+        baseline = None
+        for workers in flags.workers:
+            seconds = run(workers, feed_paths, flags, directory)
+            rate = len(messages) / seconds
+            baseline = baseline or rate
+            print(f"{workers:>8} {seconds:>9.2f} {rate:>11.0f} "
+                  f"{rate / baseline:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""Compares the AKI decision modes on a labelled test set.
+
+Every row of the test CSV (age, sex, then alternating creatinine dates and
+results) is replayed into a `CreatinineBaselines`, and its latest result is
+decided by each of the `DECISION_MODES` with `KDIGORules.predict`. Reports
+the F3 score, precision and recall against the labels, the share of results
+the rules decide without the model, the agreement with the model and the
+time taken per result.
+
+With --tune, the rows are split at random (with --seed) into a tuning set,
+on which the 'hybrid' band with the best F3 is chosen, and an evaluation
+set, on which the modes are then compared. The evaluation rows are never
+used to choose the band, so their scores are not inflated by the search.
+
+Example:
+    python src/evaluate_decision_modes.py \\
+        --test_data data/test_data/test_f3.csv \\
+        --labels data/test_data/labels_f3.csv \\
+        --model_path models/trained_model.npz --tune
+"""
+
+import argparse
+import csv
+import time
+from datetime import datetime
+
+import numpy as np
+from sklearn.metrics import fbeta_score, precision_score, recall_score
+
+from prediction_core import (DECISION_MODES, HISTORY_DATE_FORMAT,
+                             HYBRID_AMBIGUOUS_BAND, NUMBER_OF_TEST_RESULTS,
+                             RESULT_TIME_EPOCH, CreatinineBaselines,
+                             KDIGORules, latest_results, load_model)
+
+# Band bounds searched by --tune.
+LOWER_BOUNDS = np.round(np.arange(1.0, 1.51, 0.05), 2)
+UPPER_BOUNDS = np.round(np.arange(1.5, 3.01, 0.1), 2)
+
+
+def load_test_data(test_data_path: str, labels_path: str) -> tuple:
+    """Reads the test set.
+
+    Returns:
+        tuple: The model features, the (latest, 7-day minimum, 365-day
+               median) baselines with NaN where unknown, and the labels as
+               booleans.
+    """
+    features, baselines = [], []
+    with open(test_data_path, 'r') as file:
+        reader = csv.reader(file)
+        next(reader)
+        for row in reader:
+            row = [value for value in row if value != '']
+            patient = CreatinineBaselines()
+            for date, result in zip(row[2::2], row[3::2]):
+                taken_at = datetime.strptime(date, HISTORY_DATE_FORMAT)
+                patient.push((taken_at - RESULT_TIME_EPOCH).total_seconds(),
+                             float(result))
+            features.append((int(row[0]), 0 if row[1].lower() == 'm' else 1,
+                             [float(result) for result in row[3::2]]))
+            baselines.append([np.nan if value is None else value
+                              for value in patient.features()])
+
+    # Pad every row's results to the same width for `latest_results`.
+    width = max(len(results) for _, _, results in features)
+    results = np.full((len(features), width), np.nan)
+    for i, (_, _, row_results) in enumerate(features):
+        results[i, :len(row_results)] = row_results
+    demographics = np.array([(age, sex) for age, sex, _ in features],
+                            dtype=np.float64)
+    features = np.hstack([demographics,
+                          latest_results(results, NUMBER_OF_TEST_RESULTS)])
+
+    with open(labels_path, 'r') as file:
+        reader = csv.reader(file)
+        next(reader)
+        labels = np.array([row[0].lower() == 'y' for row in reader])
+    return features, np.array(baselines, dtype=np.float64).T, labels
+
+
+def tune_band(model_predictions: np.ndarray, labels: np.ndarray,
+              latest: np.ndarray, minimum: np.ndarray,
+              median: np.ndarray) -> tuple[float, float]:
+    """Chooses the 'hybrid' band with the best F3 on the given rows.
+
+    Among bands with the same F3, the one leaving the fewest results to the
+    model is chosen.
+
+    Returns:
+        tuple[float, float]: The lower and upper bound of the band.
+    """
+    best = None
+    for lower in LOWER_BOUNDS:
+        for upper in UPPER_BOUNDS[UPPER_BOUNDS > lower]:
+            decisions = KDIGORules('hybrid', band=(lower, upper)).decide_all(
+                latest, minimum, median)
+            undecided = np.isnan(decisions)
+            predictions = np.where(undecided, model_predictions,
+                                   decisions == 1.0)
+            score = (fbeta_score(labels, predictions, beta=3),
+                     -undecided.sum())
+            if best is None or score > best[0]:
+                best = (score, (float(lower), float(upper)))
+    return best[1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test_data", default="data/test_data/test_f3.csv")
+    parser.add_argument("--labels", default="data/test_data/labels_f3.csv")
+    parser.add_argument("--model_path", default="models/trained_model.npz")
+    parser.add_argument("--repeat", default=7, type=int)
+    parser.add_argument("--tune", action="store_true",
+                        help="Choose the hybrid band on a tuning split and "
+                             "evaluate on the remaining rows")
+    parser.add_argument("--tuning_fraction", default=0.5, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    flags = parser.parse_args()
+
+    model = load_model(flags.model_path)
+    features, (latest, minimum, median), labels = \
+        load_test_data(flags.test_data, flags.labels)
+    model_predictions = KDIGORules('model').predict(
+        model, features, latest, minimum, median)
+
+    band = HYBRID_AMBIGUOUS_BAND
+    if flags.tune:
+        rows = np.random.default_rng(flags.seed).permutation(len(labels))
+        split = int(len(labels) * flags.tuning_fraction)
+        tuning, rows = rows[:split], rows[split:]
+        band = tune_band(model_predictions[tuning], labels[tuning],
+                         latest[tuning], minimum[tuning], median[tuning])
+        print(f"Band {band} chosen on {len(tuning)} tuning results "
+              f"(currently {HYBRID_AMBIGUOUS_BAND})")
+        features, latest, minimum, median, labels, model_predictions = (
+            features[rows], latest[rows], minimum[rows], median[rows],
+            labels[rows], model_predictions[rows])
+
+    print(f"{len(labels)} results, {labels.sum()} with AKI")
+    print(f"{'mode':>8} {'F3':>7} {'precision':>10} {'recall':>7} "
+          f"{'by rules':>9} {'agreement':>10} {'ns/result':>10}")
+    for mode in DECISION_MODES:
+        rules = KDIGORules(mode, band=band)
+        timings = []
+        for _ in range(flags.repeat):
+            started = time.perf_counter()
+            predictions = rules.predict(model, features, latest, minimum,
+                                        median)
+            timings.append(time.perf_counter() - started)
+        by_rules = np.mean(~np.isnan(rules.decide_all(latest, minimum,
+                                                      median)))
+        print(f"{mode:>8} {fbeta_score(labels, predictions, beta=3):7.4f} "
+              f"{precision_score(labels, predictions):10.4f} "
+              f"{recall_score(labels, predictions):7.4f} "
+              f"{by_rules:9.1%} "
+              f"{np.mean(predictions == model_predictions):10.2%} "
+              f"{min(timings) / len(labels) * 1e9:10.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""Write-ahead log of received messages, used with --ingest_log."""
+
+import os
+import time
+import struct
+import threading
+import zlib
+import logging
+
+
+# Write-ahead log of received messages, used with --ingest_log. Messages are
+# acknowledged once they are durably appended; a processor drains the log.
+INGEST_SEGMENT_SIZE = 64 * 1024 * 1024
+INGEST_RECORD_HEADER = struct.Struct("<II")  # payload length, crc32
+
+# Position in the log up to which messages have been processed, written in
+# the same transaction as the messages' own writes.
+INGEST_POSITION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS ingest_position (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    segment INTEGER NOT NULL,
+    offset INTEGER NOT NULL
+)
+"""
+
+
+class IngestLog:
+    """Append-only, checksummed log of received HL7 messages.
+
+    The log is a directory of numbered segment files. Each record is a
+    header holding the payload's length and CRC-32, then the message's
+    segments joined by carriage returns. `append` returns once the records
+    are fsynced. A position is a (segment, offset) pair; records are read
+    from a position with `read`, which waits for new records.
+
+    Each run appends to a new segment, so a record torn by a crash can only
+    be at the end of an earlier segment, where `read` skips it.
+
+    Constructor Attributes:
+        directory (str): Directory holding the segment files.
+        segment_size (int): Size after which a new segment is started.
+
+    Methods:
+        start: Returns the position of the oldest record kept.
+        append: Durably appends messages.
+        read: Reads the records following a position.
+        discard_before: Deletes segments older than a position's.
+        close: Closes the log.
+    """
+
+    def __init__(self, directory: str,
+                 segment_size: int = INGEST_SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self._appended = threading.Condition()
+        existing = self._segments()
+        self._first = existing[0] if existing else 1
+        self._open_segment(existing[-1] + 1 if existing else 1)
+        self._reader = None
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.log")
+
+    def _segments(self) -> list[int]:
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory)
+                      if name.endswith(".log") and name[:-4].isdigit())
+
+    def _open_segment(self, segment: int) -> None:
+        """Starts appending to a new segment file."""
+        self._file = open(self._path(segment), "xb")
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)  # Make the new file itself durable
+        finally:
+            os.close(directory)
+        # End of the durable records
+        self._end = (segment, 0)
+
+    def start(self) -> tuple[int, int]:
+        """Returns the position of the oldest record still kept."""
+        return self._first, 0
+
+    def append(self, messages: list[list[str]]) -> None:
+        """Appends messages and waits until they are on disk.
+
+        Args:
+            messages (list[list[str]]): HL7 messages, each split into string
+                                        segments.
+        """
+        records = bytearray()
+        for message in messages:
+            payload = "\r".join(message).encode("ascii")
+            records += INGEST_RECORD_HEADER.pack(len(payload),
+                                                 zlib.crc32(payload))
+            records += payload
+        with self._appended:
+            self._file.write(records)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            segment, offset = self._end
+            self._end = (segment, offset + len(records))
+            if self._end[1] >= self.segment_size:
+                self._file.close()
+                self._open_segment(segment + 1)
+            self._appended.notify_all()
+
+    def read(self, position: tuple[int, int], max_records: int,
+             timeout: float, max_latency: float = 0.0) -> list:
+        """Reads the records following a position.
+
+        Waits up to `timeout` seconds for a first record, then up to
+        `max_latency` seconds for further records.
+
+        Args:
+            position (tuple[int, int]): Position to read from.
+            max_records (int): Maximum number of records returned.
+            timeout (float): Time to wait for a first record, in seconds.
+            max_latency (float): Time to wait for more records, in seconds.
+
+        Returns:
+            list[tuple[list[str], tuple[int, int]]]: Each message with the
+                position following it, in log order.
+        """
+        records = []
+        deadline = time.monotonic() + timeout
+        while not records:
+            with self._appended:
+                if not self._appended.wait_for(
+                        lambda: position < self._end,
+                        deadline - time.monotonic()):
+                    return records
+                end = self._end
+            position = self._read_until(records, position, end, max_records)
+        deadline = time.monotonic() + max_latency
+        while len(records) < max_records:
+            with self._appended:
+                if not self._appended.wait_for(
+                        lambda: position < self._end,
+                        deadline - time.monotonic()):
+                    break
+                end = self._end
+            position = self._read_until(records, position, end, max_records)
+        return records
+
+    def _read_until(self, records: list, position: tuple[int, int],
+                    end: tuple[int, int], max_records: int) -> tuple[int, int]:
+        """Appends the records between two positions to `records`.
+
+        Returns:
+            tuple[int, int]: The position following the last record read.
+        """
+        segment, offset = position
+        while len(records) < max_records and (segment, offset) < end:
+            record = self._read_record(segment, offset,
+                                       end[1] if segment == end[0] else None)
+            if record is None:
+                # Only a crash can leave a torn record, at a segment's end.
+                logging.error(f"Skipping the unreadable end of ingest log "
+                              f"segment {segment} from offset {offset}")
+                segment, offset = segment + 1, 0
+            elif record is False:
+                segment, offset = segment + 1, 0
+            else:
+                offset += INGEST_RECORD_HEADER.size + len(record)
+                records.append((str(record, "ascii").split("\r"),
+                                (segment, offset)))
+        return segment, offset
+
+    def _read_record(self, segment: int, offset: int, limit: int | None):
+        """Reads the payload of the record at a position.
+
+        Returns:
+            The payload; False at the clean end of a finished segment; or
+            None if the record is torn or corrupt.
+        """
+        if self._reader is None or self._reader[0] != segment:
+            if self._reader is not None:
+                self._reader[1].close()
+            try:
+                self._reader = (segment, open(self._path(segment), "rb"))
+            except FileNotFoundError:
+                self._reader = None
+                return False
+        file = self._reader[1]
+        file.seek(offset)
+        header = file.read(INGEST_RECORD_HEADER.size)
+        if not header:
+            return False
+        if len(header) < INGEST_RECORD_HEADER.size:
+            return None
+        length, checksum = INGEST_RECORD_HEADER.unpack(header)
+        payload = file.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum or \
+                (limit is not None and
+                 offset + INGEST_RECORD_HEADER.size + length > limit):
+            return None
+        return payload
+
+    def discard_before(self, position: tuple[int, int]) -> None:
+        """Deletes the segments wholly before a processed position.
+
+        Args:
+            position (tuple[int, int]): Position up to which every record
+                                        has been processed.
+        """
+        while self._first < position[0]:
+            try:
+                os.remove(self._path(self._first))
+            except FileNotFoundError:
+                pass
+            self._first += 1
+
+    def close(self) -> None:
+        """Closes the segment files."""
+        with self._appended:
+            self._file.close()
+        if self._reader is not None:
+            self._reader[1].close()
+            self._reader = None
@@ -0,0 +1,688 @@
+"""Delivery of AKI pages to the pager service, with retries.
+
+`PagerDispatcher` sends pages from worker threads for the threads engine,
+and `AsyncPagerDispatcher` from tasks for the asyncio engine. Pages not yet
+delivered are kept in the patient database.
+"""
+
+import asyncio
+import time
+import http.client
+import threading
+import heapq
+import random
+import sqlite3
+import logging
+
+import prediction_core
+from prediction_core import PENDING_PAGES_TABLE_SQL, open_patient_database
+
+
+# Paging runs on its own worker threads so that a slow or unavailable pager
+# never holds up message processing or acknowledgements.
+PAGER_QUEUE_SIZE = 1024
+PAGER_WORKERS = 4
+PAGER_MAX_RETRY_DELAY = 30.0
+PAGER_REQUEST_TIMEOUT = 5.0
+
+
+def parse_pager_address(value: str) -> tuple[str, int]:
+    """Parses the address of the pager service.
+
+    Args:
+        value (str): The address as 'hostname:port', e.g. 'pager:8441'.
+
+    Returns:
+        tuple[str, int]: Hostname and port of the pager service.
+
+    Raises:
+        ValueError: If `value` is not 'hostname:port' with a numeric port.
+    """
+    hostname, _, port = value.strip().rpartition(':')
+    if not hostname or not port.isdigit():
+        raise ValueError(f"Invalid pager address '{value}', expected "
+                         f"'hostname:port'")
+    return hostname, int(port)
+
+
+class PagerConnectionPool:
+    """Persistent HTTP/1.1 connections to the pager service.
+
+    Idle connections are kept for reuse, so consecutive pages do not each
+    open a new TCP connection. A connection the server has closed is
+    replaced transparently: a request that fails on a reused connection is
+    retried once on a fresh one. Connections the server marks as closing
+    (e.g. an HTTP/1.0 server) are not kept.
+
+    Constructor Attributes:
+        address (str): Address of the pager service, 'hostname:port'. A
+                       malformed address raises ValueError here rather
+                       than on every page.
+        size (int): Maximum number of idle connections kept.
+        timeout (float): Timeout of each request, in seconds.
+        metrics_count_flag (bool): Whether to record request latencies.
+
+    Methods:
+        send: Sends one page request.
+        close: Closes the idle connections.
+    """
+
+    def __init__(self, address: str, size: int = PAGER_WORKERS,
+                 timeout: float = PAGER_REQUEST_TIMEOUT,
+                 metrics_count_flag: bool = True):
+        self.address = address
+        self._host, self._port = parse_pager_address(address)
+        self.size = size
+        self.timeout = timeout
+        self.metrics_count_flag = metrics_count_flag
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def send(self, mrn: str) -> bool:
+        """Sends a page request for a patient.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            bool: True if the pager accepted the page.
+        """
+        start = time.perf_counter()
+        status = None
+        try:
+            status = self._request(mrn.encode('utf-8'))
+        except (http.client.HTTPException, OSError) as e:
+            logging.error(f"Paging failed for MRN {mrn}: {e}")
+        if self.metrics_count_flag:
+            prediction_core.PAGER_REQUEST_LATENCY.labels(
+                'delivered' if status == 200 else 'failed').observe(
+                time.perf_counter() - start)
+        return status == 200
+
+    def _request(self, body: bytes) -> int:
+        """POSTs to /page, retrying once if a reused connection was stale."""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is not None:
+            try:
+                return self._post(conn, body)
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed the idle connection; reconnect below.
+                pass
+        return self._post(http.client.HTTPConnection(
+            self._host, self._port, timeout=self.timeout), body)
+
+    def _post(self, conn: http.client.HTTPConnection, body: bytes) -> int:
+        """Sends the request on `conn`, keeping it if it can be reused."""
+        try:
+            conn.request("POST", "/page", body=body,
+                         headers={"Content-Type": "text/plain"})
+            response = conn.getresponse()
+            response.read()
+        except BaseException:
+            conn.close()
+            raise
+        with self._lock:
+            if response.will_close or len(self._idle) >= self.size:
+                conn.close()
+            else:
+                self._idle.append(conn)
+        return response.status
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def pager_backoff(attempts: int, retry_delay: float,
+                  max_retry_delay: float) -> float:
+    """Returns the delay before the next paging attempt.
+
+    The delay doubles with every failed attempt up to `max_retry_delay`,
+    and is drawn from its upper half (equal jitter) so that retries of
+    pages that failed together are spread out.
+
+    Args:
+        attempts (int): Number of attempts made so far.
+        retry_delay (float): Delay after the first attempt, in seconds.
+        max_retry_delay (float): Upper bound on the delay, in seconds.
+
+    Returns:
+        float: The delay in seconds.
+    """
+    delay = min(max_retry_delay, retry_delay * 2 ** (attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def select_pending_pages(conn: sqlite3.Connection, exclude: set,
+                         limit: int) -> list[str]:
+    """Returns the oldest stored pages, skipping those already in memory.
+
+    Args:
+        conn (sqlite3.Connection): Connection to the database holding the
+                                   `pending_pages` table.
+        exclude (set): MRNs to skip.
+        limit (int): Maximum number of MRNs to return.
+
+    Returns:
+        list[str]: MRNs in the order their pages were queued.
+    """
+    placeholders = ",".join("?" * len(exclude))
+    rows = conn.execute(
+        f"SELECT mrn FROM pending_pages "
+        f"WHERE mrn NOT IN ({placeholders}) "
+        f"ORDER BY queued_at LIMIT ?", (*exclude, limit)).fetchall()
+    return [mrn for (mrn,) in rows]
+
+
+class PagerDispatcher:
+    """Delivers pages in the background with retries and de-duplication.
+
+    `submit` records the page and returns at once. Worker threads send the
+    pages, retrying a failed page with exponential backoff and jitter until
+    `max_retries` attempts have been made. An MRN that already has a page
+    outstanding is not paged twice.
+
+    At most `queue_size` pages are held in memory. With a database, every
+    page is first recorded in the `pending_pages` table and only removed once
+    it has been delivered or abandoned; pages that do not fit in memory wait
+    there, and pages left over from a previous run are resumed by `start`.
+    Without a database, pages submitted while the queue is full are dropped
+    and counted as unsuccessful.
+
+    Constructor Attributes:
+        address (str): Address of the pager service.
+        db_path (str): Path to the SQLite database holding pending pages, or
+                       None to keep them in memory only.
+        max_retries (int): Maximum number of attempts per page.
+        retry_delay (float): Delay before the first retry, in seconds; it
+                             doubles with every further attempt.
+        max_retry_delay (float): Upper bound on the delay between attempts.
+        workers (int): Maximum number of pages sent concurrently.
+        queue_size (int): Maximum number of pages held in memory.
+        metrics_count_flag (bool): Whether to update Prometheus metrics.
+        send (callable): Sends one page, `send(mrn) -> bool`. Defaults to
+                         a `PagerConnectionPool` to `address` with one
+                         connection per worker. An exception it raises is
+                         logged and counted as a failed attempt.
+        writers (int): Number of connections writing to the database at the
+                       same time, sizing the wait for its write lock (see
+                       `open_patient_database`). Defaults to 1.
+
+    Methods:
+        start: Resumes stored pages and starts the worker threads.
+        submit: Queues a page for an MRN.
+        join: Waits until no page is outstanding.
+        close: Stops the workers, keeping undelivered pages stored.
+    """
+
+    def __init__(self, address: str, db_path: str | None = None,
+                 max_retries: int = 15, retry_delay: float = 1.0,
+                 max_retry_delay: float = PAGER_MAX_RETRY_DELAY,
+                 workers: int = PAGER_WORKERS,
+                 queue_size: int = PAGER_QUEUE_SIZE,
+                 metrics_count_flag: bool = True, send=None,
+                 writers: int = 1):
+        self.address = address
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue_size = queue_size
+        self.metrics_count_flag = metrics_count_flag
+        self._pool = None
+        if send is None:
+            self._pool = PagerConnectionPool(
+                address, workers, metrics_count_flag=metrics_count_flag)
+            send = self._pool.send
+        self.send = send
+        self.number_of_workers = workers
+        # Heap of (due time, sequence, MRN, attempts made).
+        self._heap = []
+        self._sequence = 0
+        # MRNs queued in memory or being sent.
+        self._outstanding = set()
+        # Whether the table holds pages that did not fit in memory.
+        self._overflow = False
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._threads = []
+        self._conn = None
+        if db_path is not None:
+            self._conn = open_patient_database(db_path, writers=writers)
+            self._conn.execute(PENDING_PAGES_TABLE_SQL)
+
+    def start(self) -> None:
+        """Resumes pages stored by a previous run and starts the workers."""
+        with self._condition:
+            self._overflow = self._conn is not None
+            self._refill()
+        for _ in range(self.number_of_workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, mrn: str) -> bool:
+        """Queues a page for a patient without waiting for it to be sent.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            bool: False if the page was dropped because the queue is full
+                  and there is no database to hold it; otherwise, True.
+        """
+        with self._condition:
+            if mrn in self._outstanding:
+                return True
+            if self._conn is not None:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO pending_pages (mrn, queued_at) "
+                    "VALUES (?, ?)", (mrn, time.time()))
+            if len(self._outstanding) >= self.queue_size:
+                if self._conn is None:
+                    logging.error(f"Pager queue full, page for MRN {mrn} "
+                                  f"dropped")
+                    self._count_unsuccessful()
+                    return False
+                self._overflow = True
+                return True
+            self._push(mrn, 0, time.monotonic())
+            return True
+
+    def join(self, timeout: float | None = None) -> bool:
+        """Waits until every submitted page has been delivered or abandoned.
+
+        Args:
+            timeout (float): Maximum time to wait, in seconds.
+
+        Returns:
+            bool: True if no page is outstanding.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._outstanding and not self._overflow,
+                timeout)
+
+    def close(self) -> None:
+        """Stops the workers. Undelivered pages stay in the database."""
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        if self._pool is not None:
+            self._pool.close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _push(self, mrn: str, attempts: int, due: float) -> None:
+        """Adds a page to the in-memory schedule; the condition is held."""
+        self._outstanding.add(mrn)
+        self._sequence += 1
+        heapq.heappush(self._heap, (due, self._sequence, mrn, attempts))
+        self._condition.notify()
+
+    def _refill(self) -> None:
+        """Moves stored pages into memory while there is room."""
+        if not self._overflow:
+            return
+        room = self.queue_size - len(self._outstanding)
+        if room <= 0:
+            return
+        mrns = select_pending_pages(self._conn, self._outstanding, room + 1)
+        now = time.monotonic()
+        for mrn in mrns[:room]:
+            self._push(mrn, 0, now)
+        self._overflow = len(mrns) > room
+        if not self._overflow:
+            self._condition.notify_all()
+
+    def _finish(self, mrn: str) -> None:
+        """Forgets a delivered or abandoned page; the condition is held."""
+        self._outstanding.discard(mrn)
+        if self._conn is not None:
+            self._conn.execute("DELETE FROM pending_pages WHERE mrn = ?",
+                               (mrn,))
+            self._refill()
+        self._condition.notify_all()
+
+    def _count_unsuccessful(self) -> None:
+        if self.metrics_count_flag:
+            prediction_core.UNSUCCESSFUL_PAGER_REQUESTS.inc()
+
+    def _work(self) -> None:
+        """Worker loop: sends due pages and reschedules failed ones."""
+        while True:
+            with self._condition:
+                while not self._stopping:
+                    if self._heap:
+                        wait = self._heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(wait)
+                if self._stopping:
+                    return
+                _, _, mrn, attempts = heapq.heappop(self._heap)
+
+            try:
+                delivered = self.send(mrn)
+            except Exception:
+                # A failing `send` must not kill the worker or lose the page.
+                logging.exception(f"Paging failed for MRN {mrn}")
+                delivered = False
+            attempts += 1
+
+            with self._condition:
+                if delivered:
+                    self._finish(mrn)
+                elif attempts >= self.max_retries:
+                    logging.error(f"Paging for MRN {mrn} abandoned after "
+                                  f"{attempts} attempts")
+                    self._count_unsuccessful()
+                    self._finish(mrn)
+                else:
+                    self._push(mrn, attempts, time.monotonic() + pager_backoff(
+                        attempts, self.retry_delay, self.max_retry_delay))
+
+
+class AsyncPagerConnectionPool:
+    """Non-blocking HTTP/1.1 keep-alive connections to the pager service.
+
+    The asyncio counterpart of `PagerConnectionPool`: idle connections are
+    reused, a request failing on a reused connection is retried once on a
+    fresh one, and connections the server closes (e.g. an HTTP/1.0 server)
+    are not kept.
+
+    Constructor Attributes:
+        address (str): Address of the pager service, 'hostname:port'. A
+                       malformed address raises ValueError here rather
+                       than on every page.
+        size (int): Maximum number of idle connections kept.
+        timeout (float): Timeout of each request, in seconds.
+        metrics_count_flag (bool): Whether to record request latencies.
+
+    Methods:
+        send: Sends one page request.
+        close: Closes the idle connections.
+    """
+
+    def __init__(self, address: str, size: int = PAGER_WORKERS,
+                 timeout: float = PAGER_REQUEST_TIMEOUT,
+                 metrics_count_flag: bool = True):
+        self.address = address
+        self._host, self._port = parse_pager_address(address)
+        self.size = size
+        self.timeout = timeout
+        self.metrics_count_flag = metrics_count_flag
+        self._idle = []
+
+    async def send(self, mrn: str) -> bool:
+        """Sends a page request for a patient.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            bool: True if the pager accepted the page.
+        """
+        start = time.perf_counter()
+        status = None
+        try:
+            status = await self._request(mrn.encode('utf-8'))
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError, OSError) as e:
+            logging.error(f"Paging failed for MRN {mrn}: {e!r}")
+        if self.metrics_count_flag:
+            prediction_core.PAGER_REQUEST_LATENCY.labels(
+                'delivered' if status == 200 else 'failed').observe(
+                time.perf_counter() - start)
+        return status == 200
+
+    async def _request(self, body: bytes) -> int:
+        """POSTs to /page, retrying once if a reused connection was stale."""
+        if self._idle:
+            try:
+                return await self._post(*self._idle.pop(), body)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                # The server closed the idle connection; reconnect below.
+                pass
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(self._host, self._port), self.timeout)
+        return await self._post(*connection, body)
+
+    async def _post(self, reader: asyncio.StreamReader,
+                    writer: asyncio.StreamWriter, body: bytes) -> int:
+        """Sends the request on a connection, keeping it if reusable."""
+        try:
+            status, keep_alive = await asyncio.wait_for(
+                self._exchange(reader, writer, body), self.timeout)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and len(self._idle) < self.size:
+            self._idle.append((reader, writer))
+        else:
+            writer.close()
+        return status
+
+    async def _exchange(self, reader: asyncio.StreamReader,
+                        writer: asyncio.StreamWriter,
+                        body: bytes) -> tuple[int, bool]:
+        """Writes one request and reads its response.
+
+        Returns:
+            tuple[int, bool]: The response status, and whether the
+                              connection may be reused.
+        """
+        writer.write(f"POST /page HTTP/1.1\r\n"
+                     f"Host: {self.address}\r\n"
+                     f"Content-Type: text/plain\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode('ascii')
+                     + body)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("Pager closed the connection")
+        version, status = status_line.split()[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        keep_alive = version == b"HTTP/1.1" and \
+            headers.get('connection') != 'close'
+        if 'content-length' in headers:
+            await reader.readexactly(int(headers['content-length']))
+        else:
+            # The body runs until the server closes the connection.
+            await reader.read()
+            keep_alive = False
+        return int(status), keep_alive
+
+    def close(self) -> None:
+        """Closes every idle connection."""
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+
+
+class AsyncPagerDispatcher:
+    """Delivers pages from the asyncio engine, like `PagerDispatcher`.
+
+    Each outstanding page is a task that retries with exponential backoff
+    and jitter; at most `workers` requests are in flight at once. An MRN
+    that already has a page outstanding is not paged twice, at most
+    `queue_size` pages are held in memory, and with a database every page
+    is kept in the `pending_pages` table until it has been delivered or
+    abandoned. Database work runs on `executor`, off the event loop.
+
+    Constructor Attributes:
+        address (str): Address of the pager service.
+        db_path (str): Path to the SQLite database holding pending pages, or
+                       None to keep them in memory only.
+        max_retries (int): Maximum number of attempts per page.
+        retry_delay (float): Delay before the first retry, in seconds.
+        max_retry_delay (float): Upper bound on the delay between attempts.
+        workers (int): Maximum number of pages sent concurrently.
+        queue_size (int): Maximum number of pages held in memory.
+        metrics_count_flag (bool): Whether to update Prometheus metrics.
+        send (callable): Coroutine function sending one page,
+                         `await send(mrn) -> bool`. Defaults to an
+                         `AsyncPagerConnectionPool` to `address`.
+        executor (concurrent.futures.Executor): Executor for database work.
+                                                Defaults to the loop's.
+
+    Methods:
+        start: Resumes pages stored by a previous run.
+        submit: Records a page for an MRN and starts delivering it.
+        join: Waits until no page is outstanding.
+        close: Cancels delivery, keeping undelivered pages stored.
+    """
+
+    def __init__(self, address: str, db_path: str | None = None,
+                 max_retries: int = 15, retry_delay: float = 1.0,
+                 max_retry_delay: float = PAGER_MAX_RETRY_DELAY,
+                 workers: int = PAGER_WORKERS,
+                 queue_size: int = PAGER_QUEUE_SIZE,
+                 metrics_count_flag: bool = True, send=None, executor=None):
+        self.address = address
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.queue_size = queue_size
+        self.metrics_count_flag = metrics_count_flag
+        self._pool = None
+        if send is None:
+            self._pool = AsyncPagerConnectionPool(
+                address, workers, metrics_count_flag=metrics_count_flag)
+            send = self._pool.send
+        self.send = send
+        self._executor = executor
+        self._requests = asyncio.Semaphore(workers)
+        # Delivery task of every MRN held in memory.
+        self._tasks = {}
+        self._overflow = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._conn = None
+        self._db_path = db_path
+
+    async def _run_db(self, function, *args):
+        """Runs a database call on the executor."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args)
+
+    async def start(self) -> None:
+        """Opens the database and resumes pages stored by a previous run."""
+        if self._db_path is not None:
+            self._conn = await self._run_db(open_patient_database,
+                                            self._db_path)
+            await self._run_db(self._conn.execute, PENDING_PAGES_TABLE_SQL)
+            self._overflow = True
+            await self._refill()
+
+    async def submit(self, mrn: str) -> bool:
+        """Records a page for a patient and starts delivering it.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            bool: False if the page was dropped because the queue is full
+                  and there is no database to hold it; otherwise, True.
+        """
+        if mrn in self._tasks:
+            return True
+        if self._conn is not None:
+            await self._run_db(
+                self._conn.execute,
+                "INSERT OR IGNORE INTO pending_pages (mrn, queued_at) "
+                "VALUES (?, ?)", (mrn, time.time()))
+            if mrn in self._tasks:
+                return True
+        if len(self._tasks) >= self.queue_size:
+            if self._conn is None:
+                logging.error(f"Pager queue full, page for MRN {mrn} dropped")
+                self._count_unsuccessful()
+                return False
+            self._overflow = True
+            self._idle.clear()
+            return True
+        self._start_delivery(mrn)
+        return True
+
+    async def join(self) -> None:
+        """Waits until every submitted page has been delivered or abandoned."""
+        await self._idle.wait()
+
+    async def close(self) -> None:
+        """Cancels delivery. Undelivered pages stay in the database."""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self._pool is not None:
+            self._pool.close()
+        if self._conn is not None:
+            await self._run_db(self._conn.close)
+            self._conn = None
+
+    def _start_delivery(self, mrn: str) -> None:
+        self._idle.clear()
+        self._tasks[mrn] = asyncio.create_task(self._deliver(mrn))
+
+    async def _refill(self) -> None:
+        """Starts delivering stored pages while there is room."""
+        room = self.queue_size - len(self._tasks)
+        if self._overflow and room > 0:
+            mrns = await self._run_db(select_pending_pages, self._conn,
+                                      set(self._tasks), room + 1)
+            for mrn in mrns[:room]:
+                if mrn not in self._tasks:
+                    self._start_delivery(mrn)
+            self._overflow = len(mrns) > room
+        if not self._tasks and not self._overflow:
+            self._idle.set()
+
+    async def _deliver(self, mrn: str) -> None:
+        """Sends a page, retrying with backoff, then forgets it."""
+        attempts = 0
+        while True:
+            async with self._requests:
+                try:
+                    delivered = await self.send(mrn)
+                except Exception:
+                    logging.exception(f"Paging failed for MRN {mrn}")
+                    delivered = False
+            attempts += 1
+            if delivered:
+                break
+            if attempts >= self.max_retries:
+                logging.error(f"Paging for MRN {mrn} abandoned after "
+                              f"{attempts} attempts")
+                self._count_unsuccessful()
+                break
+            await asyncio.sleep(pager_backoff(attempts, self.retry_delay,
+                                              self.max_retry_delay))
+        del self._tasks[mrn]
+        if self._conn is not None:
+            await self._run_db(self._conn.execute,
+                               "DELETE FROM pending_pages WHERE mrn = ?",
+                               (mrn,))
+        await self._refill()
+
+    def _count_unsuccessful(self) -> None:
+        if self.metrics_count_flag:
+            prediction_core.UNSUCCESSFUL_PAGER_REQUESTS.inc()
@@ -0,0 +1,4020 @@
+"""Patient state, model scoring and message processing for AKI detection.
+
+The parts of the prediction system shared by its engines: Prometheus
+metrics, MLLP framing and HL7 parsing, the SQLite patient database and its
+caches, creatinine baselines and the KDIGO rules, the compiled model and its
+reloader, `AKIPredictor`, and the MRN-sharded worker processes.
+"""
+
+import os
+import socket
+import time
+import signal
+import urllib.parse
+import threading
+import contextlib
+import collections
+import array
+import heapq
+import csv
+import statistics
+import functools
+import itertools
+import math
+from datetime import date, datetime, timedelta
+import pickle
+import sqlite3
+import zlib
+import numpy as np
+import logging
+from prometheus_client import Counter, Gauge, Histogram
+import json
+
+from ingest_log import INGEST_POSITION_TABLE_SQL
+
+
+# SIGTERM handling
+def sigterm_handler(signum, frame):
+    print("SIGTERM received, signaling threads to stop...")
+    stop_event.set()
+
+
+signal.signal(signal.SIGTERM, sigterm_handler)
+
+# Configure logging.
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+# Global event to signal threads when to exit, used for graceful shutdown.
+stop_event = threading.Event()
+
+# ACK messages formatted for HL7 protocol responses.
+ACK = [
+    "MSH|^~\&|||||20240129093837||ACK|||2.5",  # Header
+    "MSA|AA",  # Acknowledgment Success
+]
+
+# Constants defining the MLLP (Minimum Lower Layer Protocol) framing.
+MLLP_START_OF_BLOCK = 0x0b
+MLLP_END_OF_BLOCK = 0x1c
+MLLP_CARRIAGE_RETURN = 0x0d
+
+# Receive buffer sizing for the MLLP stream. A large buffer lets one recv
+# syscall deliver many messages when the sender pipelines them.
+MLLP_RECEIVE_BUFFER_SIZE = 256 * 1024
+MLLP_MINIMUM_RECEIVE_SIZE = 64 * 1024
+
+# Bounded hand-off between the message receivers and the processor. Both
+# sides block on it (or on a message's completion event) instead of polling.
+MESSAGE_QUEUE_SIZE = 1024
+
+# How often blocked threads wake up to check the stop event, in seconds.
+STOP_POLL_INTERVAL = 0.5
+
+# Model for processing messages. Load with appropriate model before use.
+model = None
+
+
+# ========================================
+# === PROMETHEUS METRICS SETUP - START ===
+# ========================================
+
+def initialise_or_load_counters(save_path: str = 'state/counter_state.json'):
+    # Initialise the metrics, then restore their values from the last run
+    global MESSAGES_RECEIVED, MESSAGES_PROCESSED, MESSAGES_ACKNOWLEDGED, \
+        TOTAL_BLOOD_TEST_RESULTS_RECEIVED, NORMAL_BLOOD_TEST_RESULTS_RECEIVED, \
+        AKI_BLOOD_TEST_RESULTS_RECEIVED, POSITIVE_AKI_PREDICTIONS, \
+        RULE_BASED_PREDICTIONS
+    global UNSUCCESSFUL_PAGER_REQUESTS, MLLP_SOCKET_CONNECTIONS, \
+        POSITIVE_PREDICTION_RATE
+    global TOTAL_BLOOD_TEST_RESULT_MEAN, TOTAL_BLOOD_TEST_RESULT_STDDEV, \
+        NORMAL_BLOOD_TEST_RESULT_MEAN, NORMAL_BLOOD_TEST_RESULT_STDDEV, \
+        AKI_BLOOD_TEST_RESULT_MEAN, AKI_BLOOD_TEST_RESULT_STDDEV
+    global NON_CREATININE_LIMS_MESSAGES_RECEIVED, \
+        INVALID_CREATININE_LIMS_MESSAGES_RECEIVED, NEW_PATIENTS, \
+        LIMS_RECEIVED_BEFORE_PAS, PENDING_PREDICTIONS, \
+        PENDING_PREDICTIONS_EXPIRED, LIMS_MESSAGES_PROCESSED, \
+        PAS_MESSAGES_PROCESSED, INVALID_MRN_RECEIVED, INVALID_DOB_RECEIVED, \
+        INVALID_SEX_RECEIVED, NON_RELEVANT_MESSAGES_PROCESSED
+    global PAGER_REQUEST_LATENCY, FEED_MESSAGES_RECEIVED, \
+        FEED_MESSAGES_ACKNOWLEDGED, FEED_ACKNOWLEDGEMENT_LAG, \
+        FEED_RECONNECTIONS, MESSAGE_STAGE_LATENCY
+    global MODEL_VERSION, MODEL_RELOADS, MODEL_RELOAD_LATENCY
+
+    MESSAGES_RECEIVED = \
+        Counter('messages_received',
+                'Number of messages received')
+    MESSAGES_ACKNOWLEDGED = \
+        Counter('messages_acknowledged',
+                'Number of messages acknowledged')
+    MESSAGES_PROCESSED = \
+        Counter('messages_processed',
+                'Number of messages processed')
+    INVALID_MRN_RECEIVED = \
+        Counter('invalid_mrn_received',
+                'Number of invalid MRN received')
+    LIMS_MESSAGES_PROCESSED = \
+        Counter('lims_messages_processed',
+                'Total number of LIMS messages processed')
+    PAS_MESSAGES_PROCESSED = \
+        Counter('pas_messages_processed',
+                'Total number of PAS messages processed')
+    NON_RELEVANT_MESSAGES_PROCESSED = \
+        Counter('non_relevant_messages_processed',
+                'Total number of non-relevant messages processed')
+    NEW_PATIENTS = \
+        Counter('new_patients',
+                'Number of new patients')
+    LIMS_RECEIVED_BEFORE_PAS = \
+        Counter('lims_received_before_pas',
+                'Number of LIMS messages received before PAS messages')
+    # Rebuilt from the durable backlog on startup, so not saved
+    PENDING_PREDICTIONS = \
+        Gauge('pending_predictions',
+              'Number of pending predictions')
+    PENDING_PREDICTIONS_EXPIRED = \
+        Counter('pending_predictions_expired',
+                'Number of pending predictions dropped after their TTL')
+    NON_CREATININE_LIMS_MESSAGES_RECEIVED = \
+        Counter('non_creatinine_lims_messages_received',
+                'Number of non-creatinine LIMS messages received')
+    INVALID_CREATININE_LIMS_MESSAGES_RECEIVED = \
+        Counter('invalid_creatinine_lims_messages_received',
+                'Number of invalid creatinine LIMS messages received')
+    INVALID_DOB_RECEIVED = \
+        Counter('invalid_dob_received',
+                'Number of invalid DOB received')
+    INVALID_SEX_RECEIVED = \
+        Counter('invalid_sex_received',
+                'Number of invalid sex information received')
+    TOTAL_BLOOD_TEST_RESULTS_RECEIVED = \
+        Counter('total_blood_test_results_received',
+                'Total number of blood test results received')
+    TOTAL_BLOOD_TEST_RESULT_MEAN = \
+        Gauge('total_blood_test_result_mean',
+              'Mean of all blood test results')
+    TOTAL_BLOOD_TEST_RESULT_STDDEV = \
+        Gauge('total_blood_test_result_stddev',
+              'Standard deviation of all blood test results')
+    NORMAL_BLOOD_TEST_RESULTS_RECEIVED = \
+        Counter('normal_blood_test_results_received',
+                'Number of norma blood test results received')
+    NORMAL_BLOOD_TEST_RESULT_MEAN = \
+        Gauge('normal_blood_test_result_mean',
+              'Mean of normal blood test results')
+    NORMAL_BLOOD_TEST_RESULT_STDDEV = \
+        Gauge('normal_blood_test_result_stddev',
+              'Standard deviation of normal blood test results')
+    AKI_BLOOD_TEST_RESULTS_RECEIVED = \
+        Counter('aki_blood_test_results_received',
+                'Number of AKI blood test results received')
+    AKI_BLOOD_TEST_RESULT_MEAN = \
+        Gauge('aki_blood_test_result_mean',
+              'Mean of AKI blood test results')
+    AKI_BLOOD_TEST_RESULT_STDDEV = \
+        Gauge('aki_blood_test_result_stddev',
+              'Standard deviation of AKI blood test results')
+    POSITIVE_AKI_PREDICTIONS = \
+        Counter('positive_aki_predictions',
+                'Number of positive AKI predictions')
+    RULE_BASED_PREDICTIONS = \
+        Counter('rule_based_predictions',
+                'Number of AKI predictions decided by the KDIGO rules '
+                'without the model')
+    POSITIVE_PREDICTION_RATE = \
+        Gauge('positive_prediction_rate',
+              'Rate of positive AKI predictions')
+    UNSUCCESSFUL_PAGER_REQUESTS = \
+        Counter('unsuccessful_pager_requests',
+                'Number of unsuccessful pager HTTP requests')
+    MLLP_SOCKET_CONNECTIONS = \
+        Counter('mllp_socket_connections',
+                'Number of connections to the MLLP socket')
+    PAGER_REQUEST_LATENCY = \
+        Histogram('pager_request_latency_seconds',
+                  'Latency of pager HTTP requests', ['outcome'],
+                  buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                           0.25, 0.5, 1.0, 2.5, 5.0))
+    # Time spent per message in each processing stage (see
+    # MESSAGE_STAGES); pager requests have PAGER_REQUEST_LATENCY.
+    MESSAGE_STAGE_LATENCY = \
+        Histogram('message_stage_latency_seconds',
+                  'Time spent per message or model call in each '
+                  'processing stage', ['stage'],
+                  buckets=(0.00001, 0.000025, 0.00005, 0.0001, 0.00025,
+                           0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1))
+    # Per MLLP feed, since this process started
+    FEED_MESSAGES_RECEIVED = \
+        Counter('mllp_feed_messages_received',
+                'Number of messages received per MLLP feed', ['feed'])
+    FEED_MESSAGES_ACKNOWLEDGED = \
+        Counter('mllp_feed_messages_acknowledged',
+                'Number of messages acknowledged per MLLP feed', ['feed'])
+    FEED_ACKNOWLEDGEMENT_LAG = \
+        Histogram('mllp_feed_acknowledgement_lag_seconds',
+                  'Time from receiving a message to acknowledging it, '
+                  'per MLLP feed', ['feed'],
+                  buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                           0.1, 0.25, 0.5, 1.0, 2.5))
+    FEED_RECONNECTIONS = \
+        Counter('mllp_feed_reconnections',
+                'Number of reconnection attempts per MLLP feed', ['feed'])
+    # Hot model reloads by `ModelReloader`, since this process started
+    MODEL_VERSION = \
+        Gauge('model_version',
+              'CRC-32 of the model file in use')
+    MODEL_RELOADS = \
+        Counter('model_reloads',
+                'Number of new model files seen, by outcome', ['outcome'])
+    MODEL_RELOAD_LATENCY = \
+        Histogram('model_reload_latency_seconds',
+                  'Time taken to load, warm and validate a new model, and '
+                  'to swap it in', ['stage'],
+                  buckets=(0.00001, 0.0001, 0.001, 0.01, 0.05, 0.1, 0.25,
+                           0.5, 1.0, 2.5, 5.0, 10.0))
+
+    # Load saved counter states
+    counter_state = load_counter_state(save_path)
+    if counter_state is None:
+        # Create new counters if no checkpoint could be read
+        print("No counter state file found, initialising counters at zero.")
+    else:
+        print("Counter state file found, loading counters from file.")
+
+        # Counters cannot be set, but start at zero in a new process
+        for name in SAVED_COUNTERS:
+            globals()[name.upper()].inc(counter_state.get(name, 0))
+        PROCESSING_METRICS.restore(counter_state)
+        PROCESSING_METRICS.flush()
+        print("positive prediction rate set to: ",
+              metric_value(POSITIVE_PREDICTION_RATE))
+
+
+# Counters saved by `save_counters` and restored by
+# `initialise_or_load_counters`, named after their globals in lower case.
+SAVED_COUNTERS = (
+    'messages_received', 'messages_acknowledged', 'messages_processed',
+    'non_creatinine_lims_messages_received',
+    'invalid_creatinine_lims_messages_received', 'new_patients',
+    'lims_received_before_pas', 'pending_predictions_expired',
+    'lims_messages_processed',
+    'pas_messages_processed', 'non_relevant_messages_processed',
+    'invalid_mrn_received', 'invalid_dob_received', 'invalid_sex_received',
+    'total_blood_test_results_received',
+    'normal_blood_test_results_received', 'aki_blood_test_results_received',
+    'positive_aki_predictions', 'rule_based_predictions',
+    'unsuccessful_pager_requests',
+    'mllp_socket_connections',
+)
+
+# Blood test result statistics kept by `ProcessingMetrics`: all results,
+# then those scored as normal and as AKI.
+RESULT_STATISTICS = ('total', 'normal', 'aki')
+
+# Stages timed by MESSAGE_STAGE_LATENCY: building the HL7Message, SQLite
+# reads, writes and commits, and model calls.
+MESSAGE_STAGES = ('parse', 'database', 'inference')
+
+# How often the batched processing metrics are published, in seconds.
+METRICS_FLUSH_INTERVAL = 1.0
+
+
+def metric_value(metric) -> float:
+    """Returns the current value of an unlabelled Counter or Gauge."""
+    for sample in metric.collect()[0].samples:
+        if not sample.name.endswith('_created'):
+            return sample.value
+    return 0.0
+
+
+class RunningStatistics:
+    """Count, mean and standard deviation of a stream of values.
+
+    Kept as Welford's running mean and sum of squared differences from it,
+    which unlike updating a standard deviation from the previous one stays
+    accurate over millions of values. Accumulators over separate values can
+    be merged into one.
+
+    Constructor Attributes:
+        count (int): Number of values seen. Defaults to 0.
+        mean (float): Mean of those values. Defaults to 0.
+        squares (float): Sum of their squared differences from the mean.
+                         Defaults to 0.
+    """
+
+    __slots__ = ("count", "mean", "squares")
+
+    def __init__(self, count: int = 0, mean: float = 0.0,
+                 squares: float = 0.0):
+        self.count = count
+        self.mean = mean
+        self.squares = squares
+
+    @classmethod
+    def from_summary(cls, count: int, mean: float,
+                     stddev: float) -> "RunningStatistics":
+        """Builds an accumulator from a count, mean and standard deviation."""
+        return cls(count, mean, stddev * stddev * count)
+
+    def merge(self, other: "RunningStatistics") -> None:
+        """Adds the values seen by `other` to this accumulator."""
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.squares += other.squares \
+            + delta * delta * self.count * other.count / count
+        self.count = count
+
+    @property
+    def stddev(self) -> float:
+        """The population standard deviation."""
+        return math.sqrt(self.squares / self.count) if self.count else 0.0
+
+
+class _MetricsBatch:
+    """Metric updates made by one thread, read by `ProcessingMetrics.flush`.
+
+    Only the owning thread writes to a batch, and each of its updates is a
+    single step under the GIL, so neither side takes a lock. Counts and the
+    (count, mean, squares) result statistics only grow, and `flush`
+    publishes how much they grew since it last ran; latencies are queued
+    and drained by `flush`.
+    """
+
+    __slots__ = ("counts", "results", "latencies", "published_counts",
+                 "published_results")
+
+    def __init__(self):
+        self.counts = {}
+        self.results = {kind: (0, 0.0, 0.0) for kind in RESULT_STATISTICS}
+        self.latencies = {stage: collections.deque()
+                          for stage in MESSAGE_STAGES}
+        # Values as of the last flush, only used by `flush`.
+        self.published_counts = {}
+        self.published_results = dict.fromkeys(RESULT_STATISTICS, 0)
+
+
+class ProcessingMetrics:
+    """Batches the metric updates made for every processed message.
+
+    Each Prometheus update takes a lock, and keeping the blood test result
+    statistics used to read back and set six gauges per result. Instead,
+    every thread accumulates its updates in a lock-free batch of its own,
+    and `flush` publishes all batches to the Prometheus metrics.
+    `flush_metrics_periodically` flushes every METRICS_FLUSH_INTERVAL
+    seconds, and `save_counters` before saving.
+
+    Counts are named after the metric they add to, in lower case, e.g.
+    'messages_processed' for MESSAGES_PROCESSED.
+
+    Methods:
+        count: Adds to a counter, or to the pending predictions gauge.
+        result: Records a blood test result in one of RESULT_STATISTICS.
+        time: Records the time a message spent in one of MESSAGE_STAGES.
+        flush: Publishes the batched updates to Prometheus.
+        restore: Restores the result statistics saved by `save_counters`.
+        statistics: Returns the result statistics over all batches.
+        take: Hands over this thread's updates, e.g. to another process.
+        merge: Adds updates handed over by `take` to this thread's batch.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._batches = []
+        self._lock = threading.Lock()
+        # Result statistics restored from the previous run.
+        self._restored = {kind: RunningStatistics()
+                          for kind in RESULT_STATISTICS}
+
+    def _batch(self) -> _MetricsBatch:
+        try:
+            return self._local.batch
+        except AttributeError:
+            batch = self._local.batch = _MetricsBatch()
+            with self._lock:
+                self._batches.append(batch)
+            return batch
+
+    def count(self, name: str, amount: int = 1) -> None:
+        counts = self._batch().counts
+        counts[name] = counts.get(name, 0) + amount
+
+    def result(self, kind: str, value: float) -> None:
+        results = self._batch().results
+        count, mean, squares = results[kind]
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        results[kind] = (count, mean, squares + delta * (value - mean))
+
+    def time(self, stage: str, seconds: float) -> None:
+        self._batch().latencies[stage].append(seconds)
+
+    def take(self) -> _MetricsBatch:
+        """Returns the updates made by this thread since the last call.
+
+        The batch is detached, so it is neither published nor counted in
+        `statistics` here; processing shards send it to the parent process,
+        which adds it to its own metrics with `merge`.
+        """
+        batch = self._batch()
+        with self._lock:
+            self._batches.remove(batch)
+        del self._local.batch
+        return batch
+
+    def merge(self, other: _MetricsBatch) -> None:
+        """Adds the updates of a batch returned by `take` to this thread's."""
+        batch = self._batch()
+        for name, amount in other.counts.items():
+            batch.counts[name] = batch.counts.get(name, 0) + amount
+        for kind, (count, mean, squares) in other.results.items():
+            if count:
+                statistics = RunningStatistics(*batch.results[kind])
+                statistics.merge(RunningStatistics(count, mean, squares))
+                batch.results[kind] = (statistics.count, statistics.mean,
+                                       statistics.squares)
+        for stage, seconds in other.latencies.items():
+            batch.latencies[stage].extend(seconds)
+
+    def restore(self, counter_state: dict) -> None:
+        """Restores the result statistics from a saved counter state."""
+        for kind in RESULT_STATISTICS:
+            self._restored[kind] = RunningStatistics.from_summary(
+                int(counter_state.get(f'{kind}_blood_test_results_received',
+                                      0)),
+                counter_state.get(f'{kind}_blood_test_result_mean', 0.0),
+                counter_state.get(f'{kind}_blood_test_result_stddev', 0.0))
+
+    def statistics(self) -> dict[str, RunningStatistics]:
+        """Returns the statistics of each kind of result, over all runs."""
+        with self._lock:
+            batches = list(self._batches)
+        merged = {}
+        for kind, restored in self._restored.items():
+            statistics = merged[kind] = RunningStatistics(
+                restored.count, restored.mean, restored.squares)
+            for batch in batches:
+                statistics.merge(RunningStatistics(*batch.results[kind]))
+        return merged
+
+    def flush(self) -> None:
+        """Publishes the updates batched by every thread to Prometheus."""
+        with self._lock:
+            for batch in self._batches:
+                for name, value in batch.counts.copy().items():
+                    amount = value - batch.published_counts.get(name, 0)
+                    if amount:
+                        globals()[name.upper()].inc(amount)
+                        batch.published_counts[name] = value
+                for kind, (count, _, _) in batch.results.copy().items():
+                    amount = count - batch.published_results[kind]
+                    if amount:
+                        globals()[f'{kind.upper()}_BLOOD_TEST_RESULTS_'
+                                  f'RECEIVED'].inc(amount)
+                        batch.published_results[kind] = count
+                for stage, seconds in batch.latencies.items():
+                    if seconds:
+                        histogram = MESSAGE_STAGE_LATENCY.labels(stage)
+                        for _ in range(len(seconds)):
+                            histogram.observe(seconds.popleft())
+        statistics = self.statistics()
+        for kind, kind_statistics in statistics.items():
+            globals()[f'{kind.upper()}_BLOOD_TEST_RESULT_MEAN'].set(
+                kind_statistics.mean)
+            globals()[f'{kind.upper()}_BLOOD_TEST_RESULT_STDDEV'].set(
+                kind_statistics.stddev)
+        total = statistics['total'].count
+        POSITIVE_PREDICTION_RATE.set(
+            metric_value(POSITIVE_AKI_PREDICTIONS) / total if total else 0)
+
+
+PROCESSING_METRICS = ProcessingMetrics()
+
+
+def flush_metrics_periodically(interval: float = METRICS_FLUSH_INTERVAL):
+    """Flushes PROCESSING_METRICS until the stop event is set."""
+    while not stop_event.wait(interval):
+        PROCESSING_METRICS.flush()
+
+
+# How often `checkpoint_counters_periodically` saves the metrics, in seconds.
+METRICS_CHECKPOINT_INTERVAL = 30.0
+
+# Serialises checkpoint writes, e.g. a periodic one and the one on exit.
+counter_state_lock = threading.Lock()
+
+
+def collect_counter_state() -> dict:
+    """Returns the state of all saved metrics, flushing batched ones first."""
+    PROCESSING_METRICS.flush()
+    counter_state = {name: metric_value(globals()[name.upper()])
+                     for name in SAVED_COUNTERS}
+    for kind, statistics in PROCESSING_METRICS.statistics().items():
+        counter_state[f'{kind}_blood_test_result_mean'] = statistics.mean
+        counter_state[f'{kind}_blood_test_result_stddev'] = \
+            statistics.stddev
+    return counter_state
+
+
+def write_counter_state(save_path: str, counter_state: dict) -> None:
+    """Atomically replaces the metrics checkpoint at `save_path`.
+
+    The state is written and fsynced under a temporary name, the current
+    checkpoint is kept as `<save_path>.prev`, and the new one is renamed
+    into place. Whenever the process dies, one of the two files is a
+    complete checkpoint.
+
+    Args:
+        save_path (str): Path of the checkpoint.
+        counter_state (dict): Metric values by name.
+    """
+    temporary_path = f"{save_path}.tmp"
+    with counter_state_lock:
+        with open(temporary_path, 'w') as f:
+            json.dump(counter_state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(save_path):
+            os.replace(save_path, f"{save_path}.prev")
+        os.replace(temporary_path, save_path)
+        directory = os.open(os.path.dirname(os.path.abspath(save_path)),
+                            os.O_RDONLY)
+        try:
+            os.fsync(directory)  # Make the renames durable
+        finally:
+            os.close(directory)
+
+
+def load_counter_state(save_path: str) -> dict | None:
+    """Returns the newest valid metrics checkpoint.
+
+    Falls back to the previous checkpoint kept by `write_counter_state` if
+    the latest is missing or unreadable.
+
+    Returns:
+        Optional[dict]: Metric values by name, or None if neither
+                        checkpoint could be read.
+    """
+    for path in (save_path, f"{save_path}.prev"):
+        try:
+            with open(path, 'r') as f:
+                counter_state = json.load(f)
+        except FileNotFoundError:
+            continue
+        except ValueError as e:
+            logging.error(f"Ignoring unreadable metrics checkpoint "
+                          f"'{path}': {e}")
+            continue
+        if isinstance(counter_state, dict):
+            return counter_state
+        logging.error(f"Ignoring malformed metrics checkpoint '{path}'")
+    return None
+
+
+def checkpoint_counters(save_path: str,
+                        previous: dict | None = None) -> dict:
+    """Saves the metrics unless they are unchanged since `previous`.
+
+    Args:
+        save_path (str): Path of the checkpoint.
+        previous (dict): The state saved by the last checkpoint, if any.
+
+    Returns:
+        dict: The state of the metrics, now saved.
+    """
+    counter_state = collect_counter_state()
+    if counter_state != previous:
+        write_counter_state(save_path, counter_state)
+    return counter_state
+
+
+def checkpoint_counters_periodically(
+        save_path: str, interval: float = METRICS_CHECKPOINT_INTERVAL,
+        previous: dict | None = None) -> None:
+    """Checkpoints the metrics every `interval` seconds until stopped.
+
+    Runs on its own thread; message processing never waits for it, since
+    batched metrics are flushed without blocking the threads updating them.
+    """
+    while not stop_event.wait(interval):
+        try:
+            previous = checkpoint_counters(save_path, previous)
+        except OSError as e:
+            logging.error(f"Could not checkpoint metrics to "
+                          f"'{save_path}': {e}")
+
+
+# Define save counter states to a file function
+def save_counters(save_path: str = 'state/counter_state.json'):
+    """Saves the current state of all Prometheus metrics to a JSON file.
+    """
+    write_counter_state(save_path, collect_counter_state())
+
+    print(f"Counter states saved to '{save_path}'.")
+
+
+# ======================================
+# === PROMETHEUS METRICS SETUP - END ===
+# ======================================
+
+
+def from_mllp(buffer: bytes) -> list[str]:
+    """Decodes a buffer from MLLP encoding to a list of HL7 message segments.
+
+    MLLP (Minimum Lower Layer Protocol) is used for the transmission of HL7
+    messages over network sockets. This function takes a byte buffer received
+    in MLLP format, including start and end block markers, and decodes it into
+    a list of strings. Each string represents a segment of the decoded HL7
+    message.
+
+    Args:
+        buffer (bytes): The byte buffer received in MLLP format, including the
+                        start and end block markers and the carriage return.
+
+    Returns:
+        list: A list of strings, each representing a segment of the HL7 message.
+    """
+    return str(buffer[1:-3], "ascii").split("\r")
+
+
+def to_mllp(segments: list[str]) -> bytes:
+    """Encodes a list of HL7 message segments into MLLP format for transmission.
+
+    This function takes a list of strings, where each string is a segment of an
+    HL7 message, and encodes it into MLLP format. It adds the start and end
+    block characters as well as a carriage return to conform with the MLLP
+    standard for HL7 message transmission over network sockets.
+
+    Args:
+        segments (list[str]): A list of strings, where each string is a segment
+                              of an HL7 message.
+
+    Returns:
+        bytes: A byte string encoded in MLLP format, ready for transmission
+               over network sockets.
+    """
+    m = bytes(chr(MLLP_START_OF_BLOCK), "ascii")
+    m += bytes("\r".join(segments) + "\r", "ascii")
+    m += bytes(chr(MLLP_END_OF_BLOCK) + chr(MLLP_CARRIAGE_RETURN), "ascii")
+    return m
+
+
+class MLLPFrameDecoder:
+    """Incremental decoder for a stream of MLLP-framed HL7 messages.
+
+    TCP gives no guarantee that one `recv` holds exactly one MLLP frame: a
+    frame may be split across several reads, several frames may arrive in a
+    single read, and a frame may be larger than the read size. The decoder
+    receives straight into a reusable bytearray (via `recv_into` on a
+    memoryview, so no intermediate bytes objects are created), keeps any
+    partial frame until the rest of it arrives, and returns every complete
+    frame available in the buffer.
+
+    Constructor Attributes:
+        buffer_size (int): Initial size of the receive buffer in bytes. The
+                           buffer grows geometrically if a single frame does
+                           not fit. Defaults to MLLP_RECEIVE_BUFFER_SIZE.
+
+    Methods:
+        recv_from: Receives available bytes from a socket into the buffer.
+        feed: Appends already received bytes to the buffer.
+        decode: Returns all complete frames as lists of HL7 segments.
+    """
+
+    _END_OF_FRAME = bytes([MLLP_END_OF_BLOCK, MLLP_CARRIAGE_RETURN])
+
+    def __init__(self, buffer_size: int = MLLP_RECEIVE_BUFFER_SIZE):
+        self._buffer = bytearray(buffer_size)
+        self._start = 0  # Offset of the first byte not yet decoded.
+        self._end = 0  # Offset one past the last received byte.
+
+    def __len__(self) -> int:
+        return self._end - self._start
+
+    def _reserve(self, size: int) -> None:
+        """Ensures at least `size` free bytes after the received data."""
+        if self._start == self._end:
+            self._start = self._end = 0
+        if len(self._buffer) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start > 0:
+            # Move the partial frame to the front of the buffer.
+            self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        if len(self._buffer) - self._end < size:
+            new_size = len(self._buffer)
+            while new_size - self._end < size:
+                new_size *= 2
+            self._buffer.extend(bytes(new_size - len(self._buffer)))
+
+    def recv_from(self, sock: socket.socket) -> int:
+        """Receives available bytes from `sock` directly into the buffer.
+
+        Args:
+            sock (socket.socket): Connected socket to read from.
+
+        Returns:
+            int: Number of bytes received; 0 if the peer closed the connection.
+        """
+        self._reserve(MLLP_MINIMUM_RECEIVE_SIZE)
+        with memoryview(self._buffer) as view:
+            received = sock.recv_into(view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data: bytes) -> None:
+        """Appends `data` to the buffer, e.g. bytes read by other means."""
+        self._reserve(len(data))
+        self._buffer[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def decode(self) -> list[list[str]]:
+        """Decodes every complete frame currently held in the buffer.
+
+        Bytes preceding a start-of-block marker are discarded. A frame cut
+        short by the start-of-block marker of another, e.g. after the sender
+        reconnected mid-frame, is dropped and logged, and decoding resumes
+        at the new frame. An incomplete trailing frame is kept in the buffer
+        until more data is received.
+
+        Returns:
+            list[list[str]]: One list of HL7 segments per complete frame, in
+                             the order the frames were received.
+        """
+        messages = []
+        buffer = self._buffer
+        position = self._start
+        with memoryview(buffer) as view:
+            while position < self._end:
+                start = buffer.find(MLLP_START_OF_BLOCK, position, self._end)
+                if start == -1:
+                    position = self._end  # Nothing but noise left.
+                    break
+                end = buffer.find(self._END_OF_FRAME, start + 1, self._end)
+                restart = buffer.rfind(MLLP_START_OF_BLOCK, start + 1,
+                                       self._end if end == -1 else end)
+                if restart != -1:
+                    logging.error(f"Dropped an MLLP frame of "
+                                  f"{restart - start - 1} bytes without an "
+                                  f"end marker: a new frame started")
+                    start = restart
+                if end == -1:
+                    position = start  # Keep the partial frame.
+                    break
+                # Drop the carriage return terminating the last segment.
+                content_end = end - 1 \
+                    if buffer[end - 1] == MLLP_CARRIAGE_RETURN else end
+                messages.append(
+                    str(view[start + 1:content_end], "ascii").split("\r"))
+                position = end + len(self._END_OF_FRAME)
+        self._start = position
+        return messages
+
+
+def _segment_fields(segments: list[str], segment_type: str) -> list[str]:
+    """Splits the first segment of a type into its fields.
+
+    Returns:
+        list[str]: The segment's fields, or an empty list if the message has
+                   no such segment, so that indexing it raises IndexError.
+    """
+    prefix = segment_type + "|"
+    for segment in segments:
+        if segment.startswith(prefix):
+            return segment.split("|")
+    return []
+
+
+class HL7Message:
+    """The fields the predictor reads from an HL7 message.
+
+    Every segment used is split into its fields once, when the message is
+    created: MSH and PID always, OBX for ORU^R01 results. Each segment is
+    looked for at its usual position first (MSH, PID, OBR, OBX) and by type
+    if another segment is there.
+
+    A missing segment or field raises IndexError, like indexing the segment
+    list directly.
+
+    Constructor Attributes:
+        segments (list[str]): The HL7 message split into string segments.
+        message_type (str): MSH-9, e.g. 'ORU^R01'.
+        timestamp (str): MSH-7, the time the message was created.
+        mrn (str): PID-3, the patient's Medical Record Number.
+        date_of_birth (Optional[str]): PID-7 of ADT^A01 admissions, expected
+                                       as '%Y%m%d'.
+        sex (Optional[str]): PID-8 of ADT^A01 admissions, 'F' or 'M'.
+        test_type (Optional[str]): OBX-3 of ORU^R01 results, e.g.
+                                   'CREATININE'.
+        test_result (Optional[str]): OBX-5 of ORU^R01 results.
+    """
+
+    __slots__ = ("segments", "message_type", "timestamp", "mrn",
+                 "date_of_birth", "sex", "test_type", "test_result")
+
+    def __init__(self, segments: list[str]):
+        self.segments = segments
+        # MSH-1 is the field separator itself, so after splitting on it
+        # MSH-n is at index n - 1.
+        msh = segments[0].split("|")
+        if msh[0] != "MSH":
+            msh = _segment_fields(segments, "MSH")
+        pid = segments[1].split("|")
+        if pid[0] != "PID":
+            pid = _segment_fields(segments, "PID")
+        self.message_type = message_type = msh[8]
+        self.timestamp = msh[6]
+        self.mrn = pid[3]
+        self.date_of_birth = self.sex = None
+        self.test_type = self.test_result = None
+        if message_type == "ORU^R01":
+            obx = _segment_fields(segments, "OBX") if len(segments) < 4 \
+                or not segments[3].startswith("OBX|") \
+                else segments[3].split("|")
+            self.test_type = obx[3]
+            self.test_result = obx[5]
+        elif message_type == "ADT^A01":
+            self.date_of_birth = pid[7]
+            self.sex = pid[8]
+
+
+# Origin of the result timestamps stored in `creatinine_results`. HL7 and
+# history times carry no zone and are compared as they are written.
+RESULT_TIME_EPOCH = datetime(1970, 1, 1)
+
+# Number of HL7 timestamps whose conversion is memoised; a feed carries few
+# distinct ones at a time.
+TIMESTAMP_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_hl7_timestamp(value: str) -> float | None:
+    """Converts an HL7 'YYYYMMDDHHMM[SS]' timestamp to seconds.
+
+    Args:
+        value (str): The timestamp, e.g. MSH-7.
+
+    Returns:
+        Optional[float]: Seconds since RESULT_TIME_EPOCH, or None if the
+                         value is not a valid timestamp.
+    """
+    if len(value) not in (12, 14) or not value.isdigit():
+        return None
+    try:
+        taken_at = datetime(int(value[0:4]), int(value[4:6]),
+                            int(value[6:8]), int(value[8:10]),
+                            int(value[10:12]), int(value[12:14] or 0))
+    except ValueError:
+        return None
+    return (taken_at - RESULT_TIME_EPOCH).total_seconds()
+
+
+# Number of history rows parsed and written per chunk by the bulk preload.
+PRELOAD_CHUNK_SIZE = 100_000
+
+# Connection settings for the one-off bulk preload: no rollback journal or
+# fsync, an exclusive lock and a large page cache. `main` builds the database
+# under a temporary name and renames it into place, so a load that is
+# interrupted never leaves a partial database behind.
+PRELOAD_PRAGMAS = (
+    "PRAGMA journal_mode=OFF",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA locking_mode=EXCLUSIVE",
+    "PRAGMA cache_size=-262144",
+)
+
+PATIENT_HISTORY_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS patient_history (
+        mrn TEXT PRIMARY KEY,
+        age INTEGER,
+        sex INTEGER,
+        test_1 REAL,
+        test_2 REAL,
+        test_3 REAL,
+        test_4 REAL,
+        test_5 REAL
+    )
+"""
+
+# Every creatinine result with the time it was taken, in seconds since
+# RESULT_TIME_EPOCH. Rows are only ever appended; the index serves the
+# per-patient range scans of `CreatinineBaselineCache`.
+CREATININE_RESULTS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS creatinine_results (
+        mrn TEXT NOT NULL,
+        taken_at REAL NOT NULL,
+        value REAL NOT NULL
+    )
+"""
+
+CREATININE_RESULTS_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS creatinine_results_mrn_taken_at
+    ON creatinine_results (mrn, taken_at)
+"""
+
+# Format of the creatinine dates in the history CSV.
+HISTORY_DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def history_timestamps(dates) -> np.ndarray:
+    """Converts history CSV dates to seconds since RESULT_TIME_EPOCH.
+
+    Args:
+        dates: A 2-D pandas DataFrame of dates, NaN marking an empty cell.
+
+    Returns:
+        np.ndarray: A float64 array of the same shape, NaN where the date is
+                    missing.
+    """
+    import pandas as pd
+
+    parsed = pd.to_datetime(dates.to_numpy().ravel(),
+                            format=HISTORY_DATE_FORMAT)
+    seconds = (parsed - pd.Timestamp(RESULT_TIME_EPOCH)) \
+        / pd.Timedelta(seconds=1)
+    return np.asarray(seconds, dtype=np.float64).reshape(dates.shape)
+
+
+def latest_results(results: np.ndarray, number_of_results: int = 5) \
+        -> np.ndarray:
+    """Selects each row's most recent results, padding short histories.
+
+    Args:
+        results (np.ndarray): A 2-D array with one row of creatinine results
+                              per patient, oldest first; NaN marks an empty
+                              cell.
+        number_of_results (int): Number of results to keep per patient.
+
+    Returns:
+        np.ndarray: A (rows, number_of_results) array of the most recent
+                    results, most recent first. A patient with fewer results
+                    is padded with the mean of their results, or with 0 if
+                    they have none.
+    """
+    present = ~np.isnan(results)
+    counts = present.sum(axis=1)
+    # Extended precision keeps the means in step with `statistics.mean`,
+    # which rounds the exact mean once.
+    totals = np.where(present, results, 0).astype(np.longdouble).sum(axis=1)
+    means = np.divide(totals, counts, out=np.zeros(len(counts), np.longdouble),
+                      where=counts > 0).astype(np.float64)
+
+    # Move every row's results to the front, keeping their order.
+    order = np.argsort(~present, axis=1, kind='stable')
+    results = np.take_along_axis(results, order, axis=1)
+
+    positions = counts[:, np.newaxis] - 1 - np.arange(number_of_results)
+    available = positions >= 0
+    if results.shape[1] == 0:
+        latest = np.zeros(available.shape)
+    else:
+        latest = np.take_along_axis(results, np.maximum(positions, 0),
+                                    axis=1)
+    return np.where(available, latest, means[:, np.newaxis])
+
+
+def read_history_chunks(pathname: str, chunk_size: int = PRELOAD_CHUNK_SIZE):
+    """Reads the history CSV in chunks of rows with pandas.
+
+    Args:
+        pathname (str): The file path to the CSV file containing historical
+                        patient data.
+        chunk_size (int): Number of CSV rows per chunk.
+
+    Yields:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The MRNs of a chunk, their
+                                                   creatinine results and the
+                                                   times they were taken, in
+                                                   seconds since
+                                                   RESULT_TIME_EPOCH; NaN
+                                                   marks an empty cell.
+    """
+    import pandas as pd
+
+    with open(pathname, 'r') as file:
+        number_of_columns = len(next(csv.reader(file)))
+    # The MRN, then alternating creatinine dates and results.
+    dtypes = {0: str, **{column: str
+                         for column in range(1, number_of_columns, 2)}}
+    chunks = pd.read_csv(pathname, header=0, dtype=dtypes,
+                         chunksize=chunk_size, float_precision='round_trip')
+    for chunk in chunks:
+        yield (chunk.iloc[:, 0].to_numpy(),
+               chunk.iloc[:, 2::2].to_numpy(dtype=np.float64),
+               history_timestamps(chunk.iloc[:, 1::2]))
+
+
+# Appends the staged results in (MRN, time) order, which keeps each
+# patient's series on adjacent pages, skipping those already in the series.
+CREATININE_RESULTS_MERGE_SQL = """
+    INSERT INTO creatinine_results (mrn, taken_at, value)
+    SELECT DISTINCT mrn, taken_at, value
+    FROM creatinine_results_load AS l
+    WHERE NOT EXISTS (
+        SELECT 1 FROM creatinine_results AS c
+        WHERE c.mrn = l.mrn AND c.taken_at = l.taken_at
+        AND c.value = l.value)
+    ORDER BY mrn, taken_at
+"""
+
+
+def stage_creatinine_results(conn: sqlite3.Connection, mrns: np.ndarray,
+                             values: np.ndarray,
+                             taken_at: np.ndarray) -> None:
+    """Adds a chunk's dated results to the `creatinine_results_load` table.
+
+    Args:
+        conn (sqlite3.Connection): Connection with the temporary table.
+        mrns, values, taken_at: A chunk from `read_history_chunks`.
+    """
+    rows, columns = np.nonzero(~np.isnan(values) & ~np.isnan(taken_at))
+    conn.executemany(
+        "INSERT INTO creatinine_results_load VALUES (?, ?, ?)",
+        zip(mrns[rows].tolist(), taken_at[rows, columns].tolist(),
+            values[rows, columns].tolist()))
+
+
+def preload_history_to_sqlite(db_path: str = 'state/my_database.db',
+                              pathname: str = 'data/hospital-history/history.csv',
+                              chunk_size: int = PRELOAD_CHUNK_SIZE) -> int:
+    """Loads historical patient data from a CSV file into an SQLite database.
+
+    This function processes a specified CSV file to extract patient identifiers
+    (MRN: Medical Record Number) and up to five most recent creatinine test
+    results. It then inserts the data into an SQLite database.
+
+    The CSV file is parsed in chunks of `chunk_size` rows with pandas, and
+    the five most recent results of a chunk are selected with array
+    operations. The rows are appended with `executemany` to an unindexed
+    staging table in a single transaction, with journaling disabled, and
+    only then merged into `patient_history` in MRN order, which builds the
+    MRN index in one sequential pass.
+
+    Every dated result is also appended to the `creatinine_results` time
+    series, in (MRN, time) order. Results already in the series are not
+    added again, so loading a file twice leaves the series unchanged.
+    Results without a date only reach `patient_history`.
+
+    Args:
+        db_path (str): The file path to the SQLite database. Defaults to
+                       'state/my_database.db'.
+        pathname (str): The file path to the CSV file containing historical
+                        patient data. Defaults to 'data/hospital-history/history.csv'.
+        chunk_size (int): Number of CSV rows processed at a time.
+
+    Returns:
+        int: The number of history rows loaded.
+
+    Note:
+        - This function assumes the CSV file has a specific format, with the
+          MRN as the first column, and creatinine test dates and results.
+        - The SQLite database is structured to hold patient records with
+          columns for MRN, age, sex, and the five most recent creatinine test
+          results. It ensures each patient's record is unique with MRN serving
+          as the primary key (index). If an MRN appears more than once, its
+          last row is kept.
+    """
+    start = time.perf_counter()
+    rows_loaded = 0
+    with contextlib.closing(sqlite3.connect(db_path,
+                                            isolation_level=None)) as conn:
+        for pragma in PRELOAD_PRAGMAS:
+            conn.execute(pragma)
+        conn.execute("BEGIN")
+        conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        conn.execute(CREATININE_RESULTS_TABLE_SQL)
+        conn.execute(CREATININE_RESULTS_INDEX_SQL)
+        conn.execute("DROP TABLE IF EXISTS temp.patient_history_load")
+        conn.execute("""
+            CREATE TEMP TABLE patient_history_load (
+                mrn TEXT, test_1 REAL, test_2 REAL, test_3 REAL,
+                test_4 REAL, test_5 REAL
+            )
+        """)
+        conn.execute("DROP TABLE IF EXISTS temp.creatinine_results_load")
+        conn.execute("""
+            CREATE TEMP TABLE creatinine_results_load (
+                mrn TEXT, taken_at REAL, value REAL
+            )
+        """)
+
+        for mrns, values, taken_at in read_history_chunks(pathname,
+                                                          chunk_size):
+            results = latest_results(values)
+            conn.executemany(
+                "INSERT INTO patient_history_load VALUES (?, ?, ?, ?, ?, ?)",
+                zip(mrns.tolist(), *results.T.tolist()))
+            stage_creatinine_results(conn, mrns, values, taken_at)
+            rows_loaded += len(mrns)
+
+        # Merging in MRN order appends to the primary key index instead of
+        # inserting at random positions. Among duplicates the last row wins.
+        conn.execute("""
+            INSERT INTO patient_history (
+                mrn, age, sex, test_1, test_2, test_3, test_4, test_5
+            )
+            SELECT mrn, NULL, NULL, test_1, test_2, test_3, test_4, test_5
+            FROM patient_history_load WHERE true ORDER BY mrn, rowid
+            ON CONFLICT(mrn) DO UPDATE SET
+            age=excluded.age,
+            sex=excluded.sex,
+            test_1=excluded.test_1,
+            test_2=excluded.test_2,
+            test_3=excluded.test_3,
+            test_4=excluded.test_4,
+            test_5=excluded.test_5
+        """)
+        conn.execute("DROP TABLE patient_history_load")
+        conn.execute(CREATININE_RESULTS_MERGE_SQL)
+        conn.execute("DROP TABLE creatinine_results_load")
+        conn.execute("COMMIT")
+
+    elapsed = time.perf_counter() - start
+    print(f"Data preloaded into SQLite database successfully: {rows_loaded} "
+          f"rows in {elapsed:.2f}s ({rows_loaded / max(elapsed, 1e-9):.0f} "
+          f"rows/s).")
+    return rows_loaded
+
+
+def backfill_creatinine_results(db_path: str = 'state/my_database.db',
+                                pathname: str = 'data/hospital-history/history.csv',
+                                chunk_size: int = PRELOAD_CHUNK_SIZE) -> int:
+    """Fills an empty `creatinine_results` series from the history CSV.
+
+    Databases created before the series existed, or by a version that did
+    not fill it, hold no dated results, so the KDIGO rules would find no
+    baseline for any patient. Their history is loaded into the series once;
+    `patient_history` is left as it is, since it has been updated by
+    messages since it was loaded.
+
+    Args:
+        db_path (str): The file path to the SQLite database.
+        pathname (str): The file path to the CSV file containing historical
+                        patient data.
+        chunk_size (int): Number of CSV rows processed at a time.
+
+    Returns:
+        int: The number of results added, 0 if the series was not empty.
+    """
+    with contextlib.closing(open_patient_database(db_path)) as conn:
+        conn.execute(CREATININE_RESULTS_TABLE_SQL)
+        conn.execute(CREATININE_RESULTS_INDEX_SQL)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if conn.execute("SELECT 1 FROM creatinine_results "
+                            "LIMIT 1").fetchone() is not None:
+                conn.execute("ROLLBACK")
+                return 0
+            conn.execute("""
+                CREATE TEMP TABLE creatinine_results_load (
+                    mrn TEXT, taken_at REAL, value REAL
+                )
+            """)
+            for mrns, values, taken_at in read_history_chunks(pathname,
+                                                              chunk_size):
+                stage_creatinine_results(conn, mrns, values, taken_at)
+            added = conn.execute(CREATININE_RESULTS_MERGE_SQL).rowcount
+            conn.execute("DROP TABLE creatinine_results_load")
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+    print(f"Creatinine results backfilled from '{pathname}': {added}.")
+    return added
+
+
+# Tuning applied to every long-lived connection to the patient database:
+# write-ahead logging so readers never block the writer, fsync only at WAL
+# checkpoints, memory-mapped reads and a 64 MiB page cache.
+SQLITE_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# How long a connection waits for the write lock, per connection writing to
+# the database, in seconds. Sharded workers each hold the lock for a whole
+# window, so a writer may queue behind all the others.
+SQLITE_BUSY_TIMEOUT_PER_WRITER = 5.0
+
+# Number of prepared statements each connection keeps compiled.
+SQLITE_STATEMENT_CACHE_SIZE = 64
+
+PATIENT_SELECT_SQL = """
+    SELECT age, sex, test_1, test_2, test_3, test_4, test_5
+    FROM patient_history WHERE mrn = ?
+"""
+
+# Writes the full cached state of a patient through to the database.
+PATIENT_UPSERT_SQL = """
+    INSERT INTO patient_history (
+        mrn, age, sex, test_1, test_2, test_3, test_4, test_5
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(mrn) DO UPDATE SET
+    age=excluded.age,
+    sex=excluded.sex,
+    test_1=excluded.test_1,
+    test_2=excluded.test_2,
+    test_3=excluded.test_3,
+    test_4=excluded.test_4,
+    test_5=excluded.test_5
+"""
+
+# Default number of patients kept in the in-memory patient cache.
+PATIENT_CACHE_SIZE = 500_000
+
+# Number of creatinine results used as model features.
+NUMBER_OF_TEST_RESULTS = 5
+
+
+class PatientRecord:
+    """In-memory state of one patient: demographics and recent results.
+
+    The most recent creatinine results are kept in a fixed-size ring buffer
+    of doubles; `_head` is the slot of the most recent result, so adding a
+    result overwrites the oldest one without shifting the others.
+
+    Attributes:
+        age (int | None): Age of the patient, None until admitted via PAS.
+        sex (int | None): 1 for female, 0 for male, None until admitted.
+    """
+
+    __slots__ = ("age", "sex", "_results", "_head", "_has_results")
+
+    def __init__(self, age: int | None = None, sex: int | None = None,
+                 results: tuple = (None,) * NUMBER_OF_TEST_RESULTS):
+        self.age = age
+        self.sex = sex
+        self._has_results = any(result is not None for result in results)
+        self._results = array.array(
+            "d", (float("nan") if result is None else result
+                  for result in results))
+        self._head = 0
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "PatientRecord":
+        """Builds a record from an (age, sex, test_1, ..., test_5) row."""
+        return cls(row[0], row[1], row[2:])
+
+    def push_result(self, result: float) -> None:
+        """Adds a creatinine result as the most recent one.
+
+        A patient without any results yet has every slot initialised with the
+        new result, mirroring how short histories are padded.
+        """
+        if not self._has_results:
+            for i in range(NUMBER_OF_TEST_RESULTS):
+                self._results[i] = result
+            self._head = 0
+            self._has_results = True
+            return
+        self._head = (self._head - 1) % NUMBER_OF_TEST_RESULTS
+        self._results[self._head] = result
+
+    def results(self) -> tuple:
+        """Returns the results from most to least recent, None if unknown."""
+        ordered = self._results[self._head:] + self._results[:self._head]
+        return tuple(None if result != result else result  # NaN is unknown.
+                     for result in ordered)
+
+    def row(self) -> tuple:
+        """Returns the record as an (age, sex, test_1, ..., test_5) row."""
+        return (self.age, self.sex) + self.results()
+
+    def features(self) -> tuple:
+        """Returns the record's model features, i.e. its row."""
+        return self.row()
+
+
+class PatientCache:
+    """Least-recently-used cache of patient records keyed by MRN.
+
+    The cache sits in front of the `patient_history` table: records are
+    written through to the database on every change, so the table remains the
+    durable copy and evicted records can always be reloaded from it.
+
+    Constructor Attributes:
+        capacity (int): Maximum number of records held. Defaults to
+                        PATIENT_CACHE_SIZE.
+    """
+
+    def __init__(self, capacity: int = PATIENT_CACHE_SIZE):
+        self.capacity = capacity
+        self._records = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __contains__(self, mrn: str) -> bool:
+        return mrn in self._records
+
+    def get(self, mrn: str) -> PatientRecord | None:
+        """Returns the cached record for `mrn`, marking it recently used."""
+        record = self._records.get(mrn)
+        if record is not None:
+            self._records.move_to_end(mrn)
+        return record
+
+    def put(self, mrn: str, record: PatientRecord) -> None:
+        """Caches `record`, evicting the least recently used if full."""
+        self._records[mrn] = record
+        self._records.move_to_end(mrn)
+        while len(self._records) > self.capacity:
+            self._records.popitem(last=False)
+
+    def discard(self, mrn: str) -> None:
+        """Drops `mrn` from the cache, e.g. after a rolled back write."""
+        self._records.pop(mrn, None)
+
+
+# Trailing windows of the KDIGO creatinine baselines, in seconds: the lowest
+# result of the last 7 days and the median result of the last 365 days.
+BASELINE_MINIMUM_WINDOW = 7 * 24 * 3600.0
+BASELINE_MEDIAN_WINDOW = 365 * 24 * 3600.0
+
+
+class RollingMinimum:
+    """Minimum of the values taken within a trailing time window.
+
+    A monotonic deque holds the (time, value) pairs that can still become
+    the minimum, values increasing from the front: a new value first drops
+    every larger one from the back. Each value is appended and removed at
+    most once, so updates take amortised O(1).
+
+    Constructor Attributes:
+        window (float): Length of the window, in seconds.
+    """
+
+    __slots__ = ("window", "_candidates")
+
+    def __init__(self, window: float):
+        self.window = window
+        self._candidates = collections.deque()
+
+    def push(self, taken_at: float, value: float) -> None:
+        """Adds a value; times must not decrease."""
+        candidates = self._candidates
+        while candidates and candidates[-1][1] >= value:
+            candidates.pop()
+        candidates.append((taken_at, value))
+
+    def expire(self, now: float) -> None:
+        """Drops the values taken before `now - window`."""
+        candidates = self._candidates
+        start = now - self.window
+        while candidates and candidates[0][0] < start:
+            candidates.popleft()
+
+    def value(self) -> float | None:
+        """Returns the minimum, or None if the window is empty."""
+        return self._candidates[0][1] if self._candidates else None
+
+
+class RollingMedian:
+    """Median of the values taken within a trailing time window.
+
+    The lower half of the values is kept in a max-heap and the upper half
+    in a min-heap, so the median is read off their tops. Values leaving the
+    window are only counted in `_removed` and popped once they reach a top
+    (lazy deletion); `_sizes` holds the number of live values in each half.
+    Updates take O(log n).
+
+    Constructor Attributes:
+        window (float): Length of the window, in seconds.
+    """
+
+    __slots__ = ("window", "_values", "_lower", "_upper", "_sizes",
+                 "_removed")
+
+    def __init__(self, window: float):
+        self.window = window
+        self._values = collections.deque()  # (time, value), oldest first.
+        self._lower = []  # Negated, so the largest is at the top.
+        self._upper = []
+        self._sizes = [0, 0]
+        self._removed = collections.Counter()
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def push(self, taken_at: float, value: float) -> None:
+        """Adds a value; times must not decrease."""
+        self._values.append((taken_at, value))
+        if not self._sizes[0] or value <= -self._lower[0]:
+            heapq.heappush(self._lower, -value)
+            self._sizes[0] += 1
+        else:
+            heapq.heappush(self._upper, value)
+            self._sizes[1] += 1
+        self._rebalance()
+
+    def expire(self, now: float) -> None:
+        """Drops the values taken before `now - window`."""
+        start = now - self.window
+        values = self._values
+        while values and values[0][0] < start:
+            value = values.popleft()[1]
+            self._removed[value] += 1
+            # Equal values are interchangeable, so a value no larger than
+            # the lower top can be counted out of the lower half.
+            if value <= -self._lower[0]:
+                self._sizes[0] -= 1
+                if value == -self._lower[0]:
+                    self._prune(self._lower, -1)
+            else:
+                self._sizes[1] -= 1
+                if value == self._upper[0]:
+                    self._prune(self._upper, 1)
+            self._rebalance()
+
+    def value(self) -> float | None:
+        """Returns the median, or None if the window is empty."""
+        lower, upper = self._sizes
+        if not lower:
+            return None
+        if lower > upper:
+            return -self._lower[0]
+        return (-self._lower[0] + self._upper[0]) / 2
+
+    def _prune(self, heap: list, sign: int) -> None:
+        """Pops the removed values off the top of a heap."""
+        removed = self._removed
+        while heap and removed.get(sign * heap[0]):
+            value = sign * heapq.heappop(heap)
+            removed[value] -= 1
+            if not removed[value]:
+                del removed[value]
+
+    def _rebalance(self) -> None:
+        """Keeps the lower half equal to or one larger than the upper."""
+        sizes = self._sizes
+        if sizes[0] > sizes[1] + 1:
+            heapq.heappush(self._upper, -heapq.heappop(self._lower))
+            sizes[0] -= 1
+            sizes[1] += 1
+            self._prune(self._lower, -1)
+        elif sizes[0] < sizes[1]:
+            heapq.heappush(self._lower, -heapq.heappop(self._upper))
+            sizes[0] += 1
+            sizes[1] -= 1
+            self._prune(self._upper, 1)
+
+
+class CreatinineBaselines:
+    """Rolling creatinine baselines of one patient.
+
+    Updated in O(log n) as each result arrives; the baselines describe the
+    results before the latest one, as the KDIGO criteria compare a new
+    result against them. A result older than the latest is treated as
+    taken at the latest time, so that the windows only move forward.
+
+    Attributes:
+        latest (float | None): The most recent result.
+        taken_at (float | None): When it was taken, in seconds since
+                                 RESULT_TIME_EPOCH.
+        minimum (float | None): Lowest result of the BASELINE_MINIMUM_WINDOW
+                                before the latest one, None if there is none.
+        median (float | None): Median result of the BASELINE_MEDIAN_WINDOW
+                               before the latest one, None if there is none.
+    """
+
+    __slots__ = ("latest", "taken_at", "minimum", "median", "_minimum",
+                 "_median")
+
+    def __init__(self, minimum_window: float = BASELINE_MINIMUM_WINDOW,
+                 median_window: float = BASELINE_MEDIAN_WINDOW):
+        self.latest = self.taken_at = None
+        self.minimum = self.median = None
+        self._minimum = RollingMinimum(minimum_window)
+        self._median = RollingMedian(median_window)
+
+    def push(self, taken_at: float, value: float) -> None:
+        """Adds a result, updating the baselines it is compared against."""
+        if self.taken_at is not None:
+            taken_at = max(taken_at, self.taken_at)
+            self._minimum.push(self.taken_at, self.latest)
+            self._median.push(self.taken_at, self.latest)
+        self._minimum.expire(taken_at)
+        self._median.expire(taken_at)
+        self.minimum = self._minimum.value()
+        self.median = self._median.value()
+        self.latest, self.taken_at = value, taken_at
+
+    def features(self) -> tuple:
+        """Returns the (latest, 7-day minimum, 365-day median) results."""
+        return self.latest, self.minimum, self.median
+
+
+# Reads the results of the BASELINE_MEDIAN_WINDOW up to a patient's latest.
+CREATININE_SERIES_SQL = """
+    SELECT taken_at, value FROM creatinine_results
+    WHERE mrn = ?1 AND taken_at >= (
+        SELECT MAX(taken_at) FROM creatinine_results WHERE mrn = ?1) - ?2
+    ORDER BY taken_at, rowid
+"""
+
+# The same when a history snapshot is attached as the `history` schema.
+SNAPSHOT_CREATININE_SERIES_SQL = """
+    WITH series AS (
+        SELECT taken_at, value, 0 AS live, rowid
+        FROM history.creatinine_results WHERE mrn = ?1
+        UNION ALL
+        SELECT taken_at, value, 1 AS live, rowid
+        FROM main.creatinine_results WHERE mrn = ?1
+    )
+    SELECT taken_at, value FROM series
+    WHERE taken_at >= (SELECT MAX(taken_at) FROM series) - ?2
+    ORDER BY taken_at, live, rowid
+"""
+
+# Reads every patient's series, for warming the cache.
+CREATININE_RESULTS_SQL = """
+    SELECT mrn, taken_at, value FROM creatinine_results
+    ORDER BY mrn, taken_at, rowid
+"""
+
+SNAPSHOT_CREATININE_RESULTS_SQL = """
+    SELECT mrn, taken_at, value FROM (
+        SELECT mrn, taken_at, value, 0 AS live, rowid
+        FROM history.creatinine_results
+        UNION ALL
+        SELECT mrn, taken_at, value, 1 AS live, rowid
+        FROM main.creatinine_results
+    )
+    ORDER BY mrn, taken_at, live, rowid
+"""
+
+
+class CreatinineBaselineCache:
+    """Least-recently-used cache of `CreatinineBaselines` keyed by MRN.
+
+    Each result is appended to the `creatinine_results` table and pushed
+    to the patient's cached baselines. A patient who is not cached has
+    their baselines rebuilt once from the last year of their series, after
+    which every result updates them incrementally. Without a database
+    cursor only the cache is used.
+
+    Constructor Attributes:
+        capacity (int): Maximum number of patients held. Defaults to
+                        PATIENT_CACHE_SIZE.
+        history_snapshot (bool): Whether a history snapshot is attached as
+                                 the `history` schema, holding the older part
+                                 of every series. Defaults to False.
+
+    Methods:
+        warm: Builds the baselines of many patients in one table scan.
+        add: Records a result and returns the patient's updated baselines.
+        get: Returns a patient's baselines.
+        discard: Drops a patient, e.g. after a rolled back write.
+    """
+
+    def __init__(self, capacity: int = PATIENT_CACHE_SIZE,
+                 history_snapshot: bool = False):
+        self.capacity = capacity
+        self._series_sql = SNAPSHOT_CREATININE_SERIES_SQL \
+            if history_snapshot else CREATININE_SERIES_SQL
+        self._results_sql = SNAPSHOT_CREATININE_RESULTS_SQL \
+            if history_snapshot else CREATININE_RESULTS_SQL
+        self._baselines = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._baselines)
+
+    def __contains__(self, mrn: str) -> bool:
+        return mrn in self._baselines
+
+    def warm(self, cursor, mrns: set) -> int:
+        """Builds the baselines of the given patients from their series.
+
+        Args:
+            cursor: SQLite database cursor.
+            mrns (set): MRNs of the patients to cache, e.g. those just
+                        loaded into the `PatientCache`.
+
+        Returns:
+            int: The number of patients with results.
+        """
+        series = {}
+        cursor.execute(self._results_sql)
+        for mrn, group in itertools.groupby(cursor, key=lambda row: row[0]):
+            if mrn not in mrns:
+                continue
+            series[mrn] = baselines = CreatinineBaselines()
+            for _, taken_at, value in group:
+                baselines.push(taken_at, value)
+        # Patients without a series are cached too, as known to have none.
+        for mrn in mrns:
+            self._baselines[mrn] = series.get(mrn) or CreatinineBaselines()
+        while len(self._baselines) > self.capacity:
+            self._baselines.popitem(last=False)
+        return len(series)
+
+    def add(self, cursor, mrn: str, taken_at: float, value: float,
+            new_patient: bool = False) -> CreatinineBaselines:
+        """Records a creatinine result of a patient.
+
+        Args:
+            cursor: SQLite database cursor, or None to keep the result in
+                    memory only.
+            mrn (str): Medical Record Number of the patient.
+            taken_at (float): When the result was taken, in seconds since
+                              RESULT_TIME_EPOCH.
+            value (float): The creatinine result.
+            new_patient (bool): Whether the patient is unknown, so has no
+                                series to read. Defaults to False.
+
+        Returns:
+            CreatinineBaselines: The patient's updated baselines.
+        """
+        baselines = self.get(None if new_patient else cursor, mrn)
+        if cursor is not None:
+            cursor.execute("INSERT INTO creatinine_results (mrn, taken_at, "
+                           "value) VALUES (?, ?, ?)", (mrn, taken_at, value))
+        baselines.push(taken_at, value)
+        return baselines
+
+    def get(self, cursor, mrn: str) -> CreatinineBaselines:
+        """Returns a patient's baselines, rebuilding them if not cached.
+
+        Args:
+            cursor: SQLite database cursor, or None.
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            CreatinineBaselines: The baselines, empty for a patient without
+                                 results.
+        """
+        baselines = self._baselines.get(mrn)
+        if baselines is not None:
+            self._baselines.move_to_end(mrn)
+            return baselines
+        baselines = CreatinineBaselines()
+        if cursor is not None:
+            cursor.execute(self._series_sql, (mrn, BASELINE_MEDIAN_WINDOW))
+            for taken_at, value in cursor.fetchall():
+                baselines.push(taken_at, value)
+        self._baselines[mrn] = baselines
+        while len(self._baselines) > self.capacity:
+            self._baselines.popitem(last=False)
+        return baselines
+
+    def discard(self, mrn: str) -> None:
+        """Drops `mrn` from the cache, e.g. after a rolled back write."""
+        self._baselines.pop(mrn, None)
+
+
+# Initial number of rows allocated by the columnar patient store.
+COLUMNAR_STORE_INITIAL_CAPACITY = 1024
+
+# Column layout of the columnar patient store's feature matrix, which is also
+# the feature order expected by the model.
+AGE_COLUMN = 0
+SEX_COLUMN = 1
+FIRST_TEST_COLUMN = 2
+
+
+class ColumnarPatientRecord:
+    """Handle on one patient's row of a `ColumnarPatientStore`.
+
+    Offers the same interface as `PatientRecord`, but reads and writes the
+    store's arrays in place. Unknown values are stored as NaN.
+    """
+
+    __slots__ = ("_features",)
+
+    def __init__(self, features: np.ndarray):
+        self._features = features
+
+    @property
+    def age(self) -> int | None:
+        age = self._features[AGE_COLUMN]
+        return None if np.isnan(age) else int(age)
+
+    @age.setter
+    def age(self, value: int | None) -> None:
+        self._features[AGE_COLUMN] = np.nan if value is None else value
+
+    @property
+    def sex(self) -> int | None:
+        sex = self._features[SEX_COLUMN]
+        return None if np.isnan(sex) else int(sex)
+
+    @sex.setter
+    def sex(self, value: int | None) -> None:
+        self._features[SEX_COLUMN] = np.nan if value is None else value
+
+    def push_result(self, result: float) -> None:
+        """Adds a creatinine result as the most recent one."""
+        tests = self._features[FIRST_TEST_COLUMN:]
+        if np.isnan(tests).all():
+            tests[:] = result
+        else:
+            tests[1:] = tests[:-1]  # NumPy handles the overlap.
+            tests[0] = result
+
+    def results(self) -> tuple:
+        """Returns the results from most to least recent, None if unknown."""
+        return tuple(None if np.isnan(result) else float(result)
+                     for result in self._features[FIRST_TEST_COLUMN:])
+
+    def row(self) -> tuple:
+        """Returns the record as an (age, sex, test_1, ..., test_5) row."""
+        return (self.age, self.sex) + self.results()
+
+    def features(self) -> np.ndarray:
+        """Returns the patient's feature row as a view into the store."""
+        return self._features
+
+
+class ColumnarPatientStore:
+    """Patient state held in preallocated NumPy arrays.
+
+    An alternative to the SQLite `patient_history` table. Every patient owns
+    one row of a float64 feature matrix whose columns are age, sex and the
+    five most recent creatinine results, in model feature order; the age and
+    sex columns and the creatinine matrix are views of it. A dict maps each
+    MRN to its row. The arrays grow geometrically when full, and the whole
+    store can be saved to and restored from `.npy` files.
+
+    Because the feature matrix is already in model layout, a patient's
+    features are passed to the model as a view, and all patients can be
+    scored with a single `predict` call (see `rescore`).
+
+    Constructor Attributes:
+        capacity (int): Number of rows to preallocate. Defaults to
+                        COLUMNAR_STORE_INITIAL_CAPACITY.
+    """
+
+    def __init__(self, capacity: int = COLUMNAR_STORE_INITIAL_CAPACITY):
+        self._features = np.full((max(capacity, 1),
+                                  FIRST_TEST_COLUMN + NUMBER_OF_TEST_RESULTS),
+                                 np.nan)
+        self._mrns = []
+        self.index = {}
+
+    def __len__(self) -> int:
+        return len(self._mrns)
+
+    def __contains__(self, mrn: str) -> bool:
+        return mrn in self.index
+
+    @property
+    def age(self) -> np.ndarray:
+        return self._features[:len(self), AGE_COLUMN]
+
+    @property
+    def sex(self) -> np.ndarray:
+        return self._features[:len(self), SEX_COLUMN]
+
+    @property
+    def tests(self) -> np.ndarray:
+        return self._features[:len(self), FIRST_TEST_COLUMN:]
+
+    @property
+    def features(self) -> np.ndarray:
+        return self._features[:len(self)]
+
+    def get(self, mrn: str) -> ColumnarPatientRecord | None:
+        """Returns a handle on the patient's row, or None if unknown."""
+        row = self.index.get(mrn)
+        if row is None:
+            return None
+        return ColumnarPatientRecord(self._features[row])
+
+    def put(self, mrn: str, record) -> ColumnarPatientRecord:
+        """Stores `record` for `mrn`, allocating a row for a new patient.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+            record: A `PatientRecord` or `ColumnarPatientRecord`.
+
+        Returns:
+            ColumnarPatientRecord: A handle on the patient's row.
+        """
+        row = self.index.get(mrn)
+        if row is None:
+            row = len(self._mrns)
+            if row == len(self._features):
+                self._grow()
+            self._mrns.append(mrn)
+            self.index[mrn] = row
+        features = self._features[row]
+        if isinstance(record, ColumnarPatientRecord) \
+                and record.features() is features:
+            return record  # Already updated in place.
+        features[:] = np.array(record.row(), dtype=np.float64)
+        return ColumnarPatientRecord(features)
+
+    def revert(self, mrn: str, features: np.ndarray | None) -> None:
+        """Restores a patient's row to earlier values, e.g. after a rollback.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+            features (np.ndarray): The row's earlier values, or None to
+                                   remove a patient added since. The last
+                                   row takes the place of a removed one.
+        """
+        if features is not None:
+            if mrn not in self.index:
+                self.put(mrn, PatientRecord())
+            self._features[self.index[mrn]] = features
+            return
+        row = self.index.pop(mrn, None)
+        if row is None:
+            return
+        last = len(self._mrns) - 1
+        if row != last:
+            self._features[row] = self._features[last]
+            self._mrns[row] = self._mrns[last]
+            self.index[self._mrns[row]] = row
+        self._mrns.pop()
+        self._features[last] = np.nan
+
+    def _grow(self) -> None:
+        """Doubles the number of allocated rows."""
+        grown = np.full((len(self._features) * 2, self._features.shape[1]),
+                        np.nan)
+        grown[:len(self._features)] = self._features
+        self._features = grown
+
+    def rescore(self, model) -> tuple[np.ndarray, np.ndarray]:
+        """Scores every patient with known demographics in one call.
+
+        Args:
+            model: Model with a scikit-learn style `predict` method.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The MRNs scored and their
+                                           predictions.
+        """
+        features = self.features
+        scorable = ~np.isnan(features).any(axis=1)
+        mrns = np.array(self._mrns, dtype=str)[scorable]
+        if not len(mrns):
+            return mrns, np.empty(0)
+        return mrns, model.predict(features[scorable])
+
+    def snapshot(self, directory: str) -> None:
+        """Saves the store as `mrns.npy` and `features.npy` in `directory`.
+
+        Each file is written to a temporary name first and then renamed, so
+        an interrupted snapshot never leaves a truncated file behind.
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name, values in (("mrns", np.array(self._mrns, dtype=str)),
+                             ("features", self.features)):
+            path = os.path.join(directory, f"{name}.npy")
+            with open(f"{path}.tmp", "wb") as f:
+                np.save(f, values)
+            os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def restore(cls, directory: str) -> "ColumnarPatientStore":
+        """Loads a store saved by `snapshot` from `directory`."""
+        mrns = np.load(os.path.join(directory, "mrns.npy"))
+        features = np.load(os.path.join(directory, "features.npy"))
+        store = cls(capacity=max(len(mrns), COLUMNAR_STORE_INITIAL_CAPACITY))
+        store._features[:len(mrns)] = features
+        store._mrns = mrns.tolist()
+        store.index = {mrn: row for row, mrn in enumerate(store._mrns)}
+        return store
+
+    @classmethod
+    def from_sqlite(cls, db_path: str,
+                    history_snapshot: str | None = None) \
+            -> "ColumnarPatientStore":
+        """Builds a store from the `patient_history` table of a database,
+        and from the history snapshot attached to it, if any."""
+        with contextlib.closing(
+                open_patient_database(db_path, history_snapshot)) as conn:
+            rows = conn.execute(
+                "SELECT mrn, age, sex, test_1, test_2, test_3, test_4, test_5 "
+                "FROM patient_history" if history_snapshot is None
+                else SNAPSHOT_PATIENTS_SQL).fetchall()
+        store = cls(capacity=max(len(rows), COLUMNAR_STORE_INITIAL_CAPACITY))
+        if rows:
+            store._mrns = [row[0] for row in rows]
+            store.index = {mrn: row for row, mrn in enumerate(store._mrns)}
+            store._features[:len(rows)] = np.array(
+                [row[1:] for row in rows], dtype=np.float64)
+        return store
+
+
+# Default locations of the trained model: the compiled scoring arrays written
+# by the `export-model` command, and the scikit-learn pickle they come from.
+COMPILED_MODEL_PATH = 'models/trained_model.npz'
+PICKLED_MODEL_PATH = 'models/trained_model.pkl'
+
+
+class CompiledModel:
+    """Pure-NumPy scorer reproducing the predictions of a trained model.
+
+    A tree ensemble (a decision tree or a random or extra-trees forest) is
+    flattened into node arrays shared by all trees. Leaves point at
+    themselves, so every sample walks `depth` steps and the class
+    probabilities of the leaves it lands on are averaged, as scikit-learn
+    does. A linear classifier is kept as its weight matrix and intercepts.
+    Neither needs scikit-learn to load or to score.
+
+    Constructor Attributes:
+        kind (str): 'trees' or 'linear'.
+        classes (np.ndarray): The class labels, in the model's order.
+        arrays: The scoring arrays of the model kind, see `compile`.
+    """
+
+    def __init__(self, kind: str, classes: np.ndarray, **arrays):
+        if kind not in ('trees', 'linear'):
+            raise ValueError(f"Unknown compiled model kind: {kind}")
+        self.kind = kind
+        self.classes = classes
+        self.arrays = arrays
+        self.n_features = int(arrays['n_features'])
+
+    @classmethod
+    def compile(cls, model) -> "CompiledModel":
+        """Flattens a fitted scikit-learn classifier into scoring arrays.
+
+        Args:
+            model: A fitted decision tree, tree ensemble or linear classifier.
+
+        Returns:
+            CompiledModel: A scorer making the same predictions as `model`.
+
+        Raises:
+            TypeError: If the model is not of a supported kind.
+        """
+        n_features = model.n_features_in_
+        if hasattr(model, 'tree_') or hasattr(model, 'estimators_'):
+            trees = [estimator.tree_ for estimator
+                     in getattr(model, 'estimators_', [model])]
+            offsets = np.cumsum([0] + [tree.node_count for tree in trees])
+            feature, threshold, left, right, missing_left, value = \
+                [], [], [], [], [], []
+            for offset, tree in zip(offsets, trees):
+                nodes = np.arange(tree.node_count)
+                leaf = tree.children_left < 0
+                feature.append(np.where(leaf, 0, tree.feature))
+                threshold.append(np.where(leaf, np.inf, tree.threshold))
+                left.append(np.where(leaf, nodes, tree.children_left) + offset)
+                right.append(np.where(leaf, nodes, tree.children_right)
+                             + offset)
+                missing_left.append(
+                    leaf | getattr(tree, 'missing_go_to_left',
+                                   np.zeros(tree.node_count, bool)).astype(bool))
+                # Leaf values are class weights; scikit-learn normalises them.
+                counts = tree.value[:, 0, :]
+                totals = counts.sum(axis=1, keepdims=True)
+                value.append(counts / np.where(totals == 0, 1, totals))
+            return cls('trees', np.asarray(model.classes_),
+                       n_features=n_features,
+                       roots=offsets[:-1],
+                       depth=max(tree.max_depth for tree in trees),
+                       feature=np.concatenate(feature).astype(np.int32),
+                       threshold=np.concatenate(threshold),
+                       left=np.concatenate(left).astype(np.int32),
+                       right=np.concatenate(right).astype(np.int32),
+                       missing_left=np.concatenate(missing_left),
+                       value=np.concatenate(value))
+        if hasattr(model, 'coef_') and hasattr(model, 'classes_'):
+            return cls('linear', np.asarray(model.classes_),
+                       n_features=n_features,
+                       coef=np.asarray(model.coef_, dtype=np.float64),
+                       intercept=np.asarray(model.intercept_,
+                                            dtype=np.float64))
+        raise TypeError(f"Cannot compile a model of type "
+                        f"{type(model).__name__}")
+
+    def predict(self, X) -> np.ndarray:
+        """Predicts the class of each row of `X`.
+
+        Args:
+            X: A 2-D array of feature rows; NaN marks a missing value.
+
+        Returns:
+            np.ndarray: The predicted class label of each row.
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != self.n_features:
+            raise ValueError(f"Expected rows of {self.n_features} features, "
+                             f"got an array of shape {X.shape}")
+        if self.kind == 'linear':
+            scores = X @ self.arrays['coef'].T + self.arrays['intercept']
+            if scores.shape[1] == 1:
+                return self.classes[(scores[:, 0] > 0).astype(np.intp)]
+            return self.classes[scores.argmax(axis=1)]
+
+        a = self.arrays
+        # Trees compare single-precision features against their thresholds.
+        X = X.astype(np.float32).astype(np.float64)
+        rows = np.arange(len(X))
+        nodes = np.repeat(a['roots'][:, np.newaxis], len(X), axis=1)
+        for _ in range(int(a['depth'])):
+            x = X[rows, a['feature'][nodes]]
+            go_left = (x <= a['threshold'][nodes]) | \
+                (np.isnan(x) & a['missing_left'][nodes])
+            nodes = np.where(go_left, a['left'][nodes], a['right'][nodes])
+        probabilities = a['value'][nodes].sum(axis=0)
+        return self.classes[probabilities.argmax(axis=1)]
+
+    def save(self, path: str) -> None:
+        """Writes the scoring arrays to an .npz file, replacing it atomically."""
+        temporary_path = f"{path}.tmp.npz"
+        np.savez(temporary_path, kind=self.kind, classes=self.classes,
+                 **self.arrays)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "CompiledModel":
+        """Loads a scorer saved by `save`."""
+        with np.load(path, allow_pickle=False) as data:
+            arrays = {name: data[name] for name in data.files}
+        return cls(str(arrays.pop('kind')), arrays.pop('classes'), **arrays)
+
+
+def export_model(pickle_path: str = PICKLED_MODEL_PATH,
+                 output_path: str = COMPILED_MODEL_PATH) -> CompiledModel:
+    """Compiles a pickled scikit-learn model into an .npz scoring file.
+
+    Args:
+        pickle_path (str): Path to the pickled model.
+        output_path (str): Path of the compiled model to write.
+
+    Returns:
+        CompiledModel: The compiled model.
+    """
+    with open(pickle_path, "rb") as file:
+        compiled = CompiledModel.compile(pickle.load(file))
+    compiled.save(output_path)
+    return compiled
+
+
+def load_model(path: str):
+    """Loads a model for scoring: a compiled .npz file or a pickle.
+
+    Args:
+        path (str): Path to the model file.
+
+    Returns:
+        A model object with a `predict` method.
+    """
+    if path.endswith('.npz'):
+        return CompiledModel.load(path)
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+# Seconds between checks of the model file for a new version, and the F3
+# score a new model must reach on the validation set to be swapped in.
+MODEL_RELOAD_INTERVAL = 5.0
+MODEL_VALIDATION_F3 = 0.7
+
+
+def model_version(path: str) -> int:
+    """Returns the CRC-32 of a model file, identifying its version."""
+    checksum = 0
+    with open(path, "rb") as file:
+        while data := file.read(1024 * 1024):
+            checksum = zlib.crc32(data, checksum)
+    return checksum
+
+
+def load_validation_set(data_path: str, labels_path: str) -> tuple | None:
+    """Reads a labelled test_f3.csv-style validation set for new models.
+
+    Returns:
+        tuple: The model features and the labels as booleans, or None if
+               either file does not exist.
+    """
+    if not (os.path.exists(data_path) and os.path.exists(labels_path)):
+        return None
+    rows = [row for chunk in read_csv_chunks(data_path) for row in chunk]
+    with open(labels_path, 'r', newline='') as file:
+        labels = csv.reader(file)
+        next(labels, None)
+        labels = np.array([row[0].lower() == 'y' for row in labels])
+    return csv_chunk_features(rows)[0], labels
+
+
+class ModelReloader:
+    """Watches the model file and hot-swaps new versions into the service.
+
+    When the file's modification time or size changes, the new model is
+    loaded, warmed up and scored on the validation set, all on the calling
+    thread, while processing carries on with the current model. A model
+    that fails to load or scores below `min_f3` is rejected. Otherwise it
+    is handed to every registered target's `swap_model`: an `AKIPredictor`
+    swaps it with one assignment, and a `ProcessingShard` sends it to its
+    worker ahead of the next window.
+
+    With a `source`, the pickle a compiled .npz `path` is exported from is
+    watched too. When it changes and is newer than `path`, it is compiled
+    and validated the same way, and only written to `path` once accepted,
+    so that a restart loads it as well.
+
+    Constructor Attributes:
+        path (str): The model file to watch.
+        model: The model loaded from `path`, currently in use.
+        validation (tuple): Optional (features, labels) validation set, see
+                            `load_validation_set`. Without one, new models
+                            are only checked to score a row.
+        interval (float): Seconds between checks of the file.
+        min_f3 (float): Minimum F3 score on the validation set.
+        source (str): Optional pickle `path` is compiled from, see
+                      `export_model`.
+
+    Methods:
+        register: Adds a target to swap new models into.
+        request: Asks for the file to be checked now.
+        check: Loads, validates and swaps in the file if it has changed.
+        run: Checks the file every `interval` until the program stops.
+    """
+
+    def __init__(self, path: str, model, validation: tuple | None = None,
+                 interval: float = MODEL_RELOAD_INTERVAL,
+                 min_f3: float = MODEL_VALIDATION_F3,
+                 source: str | None = None):
+        self.path = path
+        self.model = model
+        self.validation = validation
+        self.interval = interval
+        self.min_f3 = min_f3
+        self.source = source
+        self._targets = []
+        self._lock = threading.Lock()
+        self._requested = threading.Event()
+        self._signature = self._file_signature(path)
+        # A pickle already newer than `path` is compiled at the first check.
+        self._source_signature = None
+        MODEL_VERSION.set(model_version(path))
+
+    @staticmethod
+    def _file_signature(path: str) -> tuple | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _changed_file(self) -> str | None:
+        """Returns `path` or `source` if it holds a model not yet tried."""
+        signature = self._file_signature(self.path)
+        # A file rejected now is retried once it changes again.
+        if signature is not None and signature != self._signature:
+            self._signature = signature
+            return self.path
+        if self.source is None:
+            return None
+        source_signature = self._file_signature(self.source)
+        if source_signature is None \
+                or source_signature == self._source_signature:
+            return None
+        self._source_signature = source_signature
+        if signature is not None and source_signature[0] <= signature[0]:
+            return None  # Already exported.
+        return self.source
+
+    def register(self, target, model) -> None:
+        """Adds a target to swap new models into.
+
+        Args:
+            target: An object with a `swap_model` method.
+            model: The model the target was created with; it is swapped
+                   at once if a newer one has been loaded since.
+        """
+        with self._lock:
+            self._targets.append(target)
+            if model is not self.model:
+                target.swap_model(self.model)
+
+    def request(self) -> None:
+        """Asks `run` to check the file now; safe in a signal handler."""
+        self._requested.set()
+
+    def check(self) -> bool:
+        """Loads, validates and swaps in the model file if it has changed.
+
+        Returns:
+            bool: True if a new model was swapped in.
+        """
+        path = self._changed_file()
+        if path is None:
+            return False
+        started = time.perf_counter()
+        try:
+            model = load_model(path)
+            if path == self.source:
+                model = CompiledModel.compile(model)
+            f3 = self._validate(model)
+            version = model_version(path)
+        except Exception as e:
+            logging.error(f"The model '{path}' could not be loaded: {e}")
+            MODEL_RELOADS.labels('failed').inc()
+            return False
+        MODEL_RELOAD_LATENCY.labels('load').observe(
+            time.perf_counter() - started)
+        if f3 is not None and f3 < self.min_f3:
+            logging.error(f"The model '{path}' was rejected: F3 score "
+                          f"{f3:.4f} is below {self.min_f3}")
+            MODEL_RELOADS.labels('rejected').inc()
+            return False
+        if path == self.source:
+            try:
+                model.save(self.path)
+            except OSError as e:
+                logging.error(f"The model '{path}' could not be saved to "
+                              f"'{self.path}': {e}")
+                MODEL_RELOADS.labels('failed').inc()
+                return False
+            self._signature = self._file_signature(self.path)
+            version = model_version(self.path)
+
+        started = time.perf_counter()
+        with self._lock:
+            self.model = model
+            for target in self._targets:
+                target.swap_model(model)
+        MODEL_RELOAD_LATENCY.labels('swap').observe(
+            time.perf_counter() - started)
+        MODEL_VERSION.set(version)
+        MODEL_RELOADS.labels('swapped').inc()
+        print(f"Model '{path}' reloaded (version {version:08x}"
+              f"{'' if f3 is None else f', F3 score {f3:.4f}'}).")
+        return True
+
+    def _validate(self, model) -> float | None:
+        """Warms a model up and returns its F3 score on the validation set."""
+        if self.validation is None:
+            model.predict(np.zeros((1, 2 + NUMBER_OF_TEST_RESULTS)))
+            return None
+        features, labels = self.validation
+        scores = BatchScores()
+        scores.update(np.asarray(model.predict(features), dtype=bool), labels)
+        return scores.f_score()
+
+    def run(self) -> None:
+        """Checks the file every `interval` seconds until the program stops."""
+        while not stop_event.is_set():
+            self._requested.wait(self.interval)
+            self._requested.clear()
+            try:
+                self.check()
+            except Exception as e:
+                logging.error(f"Model reload failed: {e}")
+
+
+# Lookups when a history snapshot is attached as the `history` schema: the
+# live table holds every patient written since, and takes precedence.
+SNAPSHOT_PATIENT_SELECT_SQL = """
+    SELECT age, sex, test_1, test_2, test_3, test_4, test_5
+    FROM main.patient_history WHERE mrn = ?1
+    UNION ALL
+    SELECT age, sex, test_1, test_2, test_3, test_4, test_5
+    FROM history.patient_history WHERE mrn = ?1
+    LIMIT 1
+"""
+
+SNAPSHOT_PATIENTS_SQL = """
+    SELECT mrn, age, sex, test_1, test_2, test_3, test_4, test_5
+    FROM main.patient_history
+    UNION ALL
+    SELECT mrn, age, sex, test_1, test_2, test_3, test_4, test_5
+    FROM history.patient_history AS h
+    WHERE NOT EXISTS (SELECT 1 FROM main.patient_history AS m
+                      WHERE m.mrn = h.mrn)
+"""
+
+
+def build_history_snapshot(pathname: str, output_path: str) -> int:
+    """Compiles the history CSV into a finished, read-only SQLite snapshot.
+
+    Args:
+        pathname (str): The file path to the CSV file containing historical
+                        patient data.
+        output_path (str): Path of the snapshot to write. It is replaced
+                           atomically once complete.
+
+    Returns:
+        int: The number of history rows in the snapshot.
+    """
+    temporary_path = f"{output_path}.loading"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    rows = preload_history_to_sqlite(temporary_path, pathname)
+    with contextlib.closing(sqlite3.connect(temporary_path)) as conn:
+        # Reclaim the staging table's pages so the file is densely packed.
+        conn.execute("VACUUM")
+    os.replace(temporary_path, output_path)
+    return rows
+
+
+def open_patient_database(db_path: str, history_snapshot: str | None = None,
+                          writers: int = 1) -> sqlite3.Connection:
+    """Opens a long-lived, tuned connection to the patient database.
+
+    Args:
+        db_path (str): The file path to the SQLite database.
+        history_snapshot (str): Optional history snapshot written by
+                                `build_history_snapshot`, attached read-only
+                                as the `history` schema. It is opened as
+                                immutable and memory-mapped, so processes
+                                sharing it share its pages in the OS page
+                                cache.
+        writers (int): Number of connections that write to the database
+                       concurrently, sizing how long this one waits for the
+                       write lock (SQLITE_BUSY_TIMEOUT_PER_WRITER each).
+
+    Returns:
+        sqlite3.Connection: A connection with SQLITE_CONNECTION_PRAGMAS
+                            applied, in autocommit mode so that callers
+                            control transaction boundaries explicitly. It
+                            may be closed from any thread.
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False,
+                           timeout=SQLITE_BUSY_TIMEOUT_PER_WRITER * writers,
+                           isolation_level=None,
+                           cached_statements=SQLITE_STATEMENT_CACHE_SIZE,
+                           uri=db_path.startswith("file:"))
+    for pragma in SQLITE_CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    if history_snapshot is not None:
+        snapshot_uri = (f"file:{urllib.parse.quote(os.path.abspath(history_snapshot))}"
+                        f"?mode=ro&immutable=1")
+        conn.execute("ATTACH DATABASE ? AS history", (snapshot_uri,))
+        conn.execute("PRAGMA history.mmap_size=268435456")
+    return conn
+
+
+def is_database_locked(error: sqlite3.Error) -> bool:
+    """Returns whether an error is another connection holding a lock.
+
+    Such an error says nothing about the statement, so retrying it once the
+    lock is released can succeed.
+    """
+    code = getattr(error, "sqlite_errorcode", None)  # Python 3.11+
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return str(error).startswith(("database is locked",
+                                  "database table is locked"))
+
+
+# Number of (date of birth, day) pairs whose age is memoised.
+AGE_CACHE_SIZE = 65_536
+
+
+class ReferenceDate:
+    """Today's date, reread from the calendar once a day.
+
+    Ages only change at midnight, so instead of building a `datetime` for
+    every message, `today` compares the time with the next midnight and only
+    reads the date again once it has passed.
+    """
+
+    def __init__(self):
+        self._today = None
+        self._next_midnight = 0.0
+
+    def today(self) -> date:
+        if time.time() >= self._next_midnight:
+            self._today = datetime.now().date()
+            tomorrow = self._today + timedelta(days=1)
+            self._next_midnight = datetime.combine(
+                tomorrow, datetime.min.time()).timestamp()
+        return self._today
+
+
+REFERENCE_DATE = ReferenceDate()
+
+
+@functools.lru_cache(maxsize=AGE_CACHE_SIZE)
+def age_on(date_of_birth: str, today: date) -> int | None:
+    """Calculates an age in years from a "%Y%m%d" date of birth.
+
+    Patients share dates of birth and are admitted repeatedly, so results
+    are memoised and each date of birth is parsed once a day at most.
+
+    Args:
+        date_of_birth (str): The date of birth, e.g. '19800312'.
+        today (date): The date the age is calculated on.
+
+    Returns:
+        Optional[int]: The age in years, or None if `date_of_birth` is not
+                       a valid "%Y%m%d" date.
+    """
+    try:
+        born = datetime.strptime(date_of_birth, "%Y%m%d")
+    except ValueError:
+        return None
+    return today.year - born.year - (
+            (today.month, today.day) < (born.month, born.day))
+
+
+# Creatinine results waiting for their patient's PAS admission, written in
+# the same transaction as the results themselves.
+PENDING_PREDICTIONS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS pending_predictions (
+    mrn TEXT PRIMARY KEY,
+    received_at REAL NOT NULL
+)
+"""
+
+# How long a creatinine result waits for its patient's admission before it
+# is dropped unscored, in seconds.
+PENDING_PREDICTION_TTL = 7 * 24 * 3600.0
+
+
+class PendingPredictions:
+    """Patients whose latest creatinine result awaits their PAS admission.
+
+    An ordered dict maps each MRN to the arrival time of its latest result,
+    oldest first, so that membership checks are O(1) and expired entries
+    are popped off the front. Given a database cursor, every change is
+    also written to the `pending_predictions` table within the message's
+    transaction, and `load` restores the backlog after a restart.
+
+    Constructor Attributes:
+        ttl (float): Seconds after which a pending prediction expires.
+                     Defaults to PENDING_PREDICTION_TTL.
+
+    Methods:
+        load: Replaces the entries with those of the database table.
+        add: Records that a patient's latest result awaits admission.
+        pop: Removes a patient, returning whether it was pending.
+        expire: Removes the entries older than the TTL.
+        reload: Resynchronises one patient with the database table.
+    """
+
+    def __init__(self, ttl: float = PENDING_PREDICTION_TTL):
+        self.ttl = ttl
+        self._received = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._received)
+
+    def __contains__(self, mrn: str) -> bool:
+        return mrn in self._received
+
+    def __iter__(self):
+        return iter(list(self._received))
+
+    def load(self, cursor, shard: tuple[int, int] | None = None) -> int:
+        """Replaces the entries with those of the database table.
+
+        Args:
+            cursor: SQLite database cursor.
+            shard (tuple[int, int]): Optional (index, count) restricting the
+                                     entries to the patients of one
+                                     `mrn_shard`.
+
+        Returns:
+            int: The number of entries loaded.
+        """
+        self._received.clear()
+        cursor.execute("SELECT mrn, received_at FROM pending_predictions "
+                       "ORDER BY received_at")
+        for mrn, received_at in cursor:
+            if shard is None or mrn_shard(mrn, shard[1]) == shard[0]:
+                self._received[mrn] = received_at
+        return len(self._received)
+
+    def add(self, cursor, mrn: str, received_at: float) -> bool:
+        """Records that a patient's latest result awaits admission.
+
+        Returns:
+            bool: True if the patient was not pending already.
+        """
+        new = self._received.pop(mrn, None) is None
+        self._received[mrn] = received_at
+        if cursor is not None:
+            cursor.execute("INSERT INTO pending_predictions (mrn, received_at) "
+                           "VALUES (?, ?) ON CONFLICT (mrn) DO UPDATE SET "
+                           "received_at = excluded.received_at",
+                           (mrn, received_at))
+        return new
+
+    def pop(self, cursor, mrn: str) -> bool:
+        """Removes a patient, returning whether it was pending."""
+        if self._received.pop(mrn, None) is None:
+            return False
+        if cursor is not None:
+            cursor.execute("DELETE FROM pending_predictions WHERE mrn = ?",
+                           (mrn,))
+        return True
+
+    def expire(self, cursor, now: float) -> int:
+        """Removes the entries that arrived more than `ttl` before `now`.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        cutoff = now - self.ttl
+        expired = 0
+        while self._received:
+            mrn, received_at = next(iter(self._received.items()))
+            if received_at >= cutoff:
+                break
+            del self._received[mrn]
+            expired += 1
+        if expired and cursor is not None:
+            cursor.execute("DELETE FROM pending_predictions "
+                           "WHERE received_at < ?", (cutoff,))
+        return expired
+
+    def reload(self, cursor, mrn: str) -> None:
+        """Resynchronises one patient with the table, e.g. after a rollback."""
+        cursor.execute("SELECT received_at FROM pending_predictions "
+                       "WHERE mrn = ?", (mrn,))
+        row = cursor.fetchone()
+        if row is None:
+            self._received.pop(mrn, None)
+        else:
+            self._received[mrn] = row[0]
+
+
+# How AKI is decided: by the model alone, by the KDIGO rules alone, or by
+# the rules with the model consulted for ratios in the ambiguous band.
+DECISION_MODES = ('model', 'rules', 'hybrid')
+
+# Ratio of a result to its baseline from which the KDIGO rules detect AKI.
+KDIGO_AKI_RATIO = 1.5
+
+# Ratios left to the model in 'hybrid' mode: from the lower bound and below
+# the upper one. Chosen by `evaluate_decision_modes.py --tune` on a random
+# half of data/test_data/test_f3.csv (seed 0); on the other half, the rules
+# decide 94.8% of the results at an F3 of 0.999, against 1.0 for the model.
+HYBRID_AMBIGUOUS_BAND = (1.5, 2.2)
+
+
+class KDIGORules:
+    """NHS/KDIGO AKI rules on the ratio of a result to the patient's baseline.
+
+    The ratio is the larger of the latest result over the lowest result of
+    the previous 7 days and over the median result of the previous 365
+    days (see `CreatinineBaselines`); a patient without earlier results has
+    none. `decide` evaluates one patient with a few float comparisons and
+    `decide_all` evaluates arrays of patients at once, with the same
+    outcome.
+
+    Constructor Attributes:
+        mode (str): One of DECISION_MODES. In 'rules' mode AKI is detected
+                    from a ratio of `threshold`, and never without a
+                    baseline. In 'hybrid' mode a ratio below the band is no
+                    AKI, one at or above it is AKI, and the model decides
+                    the others, including patients without a baseline. In
+                    'model' mode the rules decide nothing.
+        threshold (float): Ratio detecting AKI in 'rules' mode. Defaults to
+                           KDIGO_AKI_RATIO.
+        band (tuple[float, float]): Ambiguous ratios in 'hybrid' mode.
+                                    Defaults to HYBRID_AMBIGUOUS_BAND.
+
+    Methods:
+        decide: Decides one patient, or returns None to ask the model.
+        decide_all: Decides arrays of patients, NaN where the model is asked.
+        predict: Decides arrays of patients, calling the model once for
+                 those the rules leave undecided.
+    """
+
+    def __init__(self, mode: str = 'model',
+                 threshold: float = KDIGO_AKI_RATIO,
+                 band: tuple[float, float] = HYBRID_AMBIGUOUS_BAND):
+        if mode not in DECISION_MODES:
+            raise ValueError(f"Unknown decision mode {mode!r}, expected one "
+                             f"of {', '.join(DECISION_MODES)}")
+        self.mode = mode
+        self.threshold = threshold
+        self.band = band
+
+    def decide(self, baselines: CreatinineBaselines | None) -> bool | None:
+        """Applies the rules to a patient's latest result.
+
+        Args:
+            baselines (CreatinineBaselines): The patient's baselines, or
+                                             None if unknown.
+
+        Returns:
+            Optional[bool]: Whether the patient has AKI, or None if the
+                            model has to decide.
+        """
+        if self.mode == 'model':
+            return None
+        ratio = None
+        if baselines is not None and baselines.latest is not None:
+            latest = baselines.latest
+            if baselines.minimum:
+                ratio = latest / baselines.minimum
+            if baselines.median:
+                ratio = max(ratio or 0.0, latest / baselines.median)
+        if self.mode == 'rules':
+            return ratio is not None and ratio >= self.threshold
+        if ratio is None:
+            return None
+        lower, upper = self.band
+        if ratio < lower:
+            return False
+        if ratio >= upper:
+            return True
+        return None
+
+    def decide_all(self, latest: np.ndarray, minimum: np.ndarray,
+                   median: np.ndarray) -> np.ndarray:
+        """Applies the rules to many patients at once.
+
+        Args:
+            latest (np.ndarray): Each patient's latest result.
+            minimum (np.ndarray): Their 7-day minimums, NaN if unknown.
+            median (np.ndarray): Their 365-day medians, NaN if unknown.
+
+        Returns:
+            np.ndarray: 1.0 for AKI, 0.0 for no AKI and NaN where the model
+                        has to decide.
+        """
+        latest = np.asarray(latest, dtype=np.float64)
+        baselines = np.array([minimum, median], dtype=np.float64)
+        baselines[baselines == 0] = np.nan  # No ratio, as in `decide`.
+        with np.errstate(invalid='ignore'):
+            ratios = np.fmax(latest / baselines[0], latest / baselines[1])
+        decisions = np.full(latest.shape, np.nan)
+        if self.mode == 'rules':
+            decisions[:] = ratios >= self.threshold
+        elif self.mode == 'hybrid':
+            lower, upper = self.band
+            decisions[ratios < lower] = 0.0
+            decisions[ratios >= upper] = 1.0
+        return decisions
+
+    def predict(self, model, features: np.ndarray, latest: np.ndarray,
+                minimum: np.ndarray, median: np.ndarray) -> np.ndarray:
+        """Predicts AKI for many patients, as `AKIPredictor` would.
+
+        Args:
+            model: Model scoring the patients the rules leave undecided.
+            features (np.ndarray): The patients' model features, one row
+                                   each.
+            latest (np.ndarray): Each patient's latest result.
+            minimum (np.ndarray): Their 7-day minimums, NaN if unknown.
+            median (np.ndarray): Their 365-day medians, NaN if unknown.
+
+        Returns:
+            np.ndarray: A boolean array, True where AKI is predicted.
+        """
+        decisions = self.decide_all(latest, minimum, median)
+        undecided = np.isnan(decisions)
+        if undecided.any():
+            decisions[undecided] = model.predict(
+                np.asarray(features, dtype=np.float64)[undecided])
+        return decisions.astype(bool)
+
+
+def series_baselines(taken_at: np.ndarray, values: np.ndarray) -> tuple:
+    """Computes the `CreatinineBaselines` of many series at once.
+
+    Args:
+        taken_at (np.ndarray): A (series, results) array of result times in
+                               seconds since RESULT_TIME_EPOCH, each row
+                               oldest first; NaN marks an empty cell.
+        values (np.ndarray): The results, NaN marking an empty cell.
+
+    Returns:
+        tuple: The latest result of each series, the lowest result of the
+               BASELINE_MINIMUM_WINDOW before it and the median result of the
+               BASELINE_MEDIAN_WINDOW before it, as float arrays with NaN
+               where unknown.
+    """
+    if values.shape[1] == 0:
+        return (np.full(len(values), np.nan),) * 3
+    present = ~np.isnan(values) & ~np.isnan(taken_at)
+    rows = np.arange(len(values))
+    last = values.shape[1] - 1 - np.argmax(present[:, ::-1], axis=1)
+    has_results = present.any(axis=1)
+    latest = np.where(has_results, values[rows, last], np.nan)
+    latest_at = taken_at[rows, last]
+    earlier = present & (np.arange(values.shape[1]) < last[:, np.newaxis])
+    with np.errstate(invalid='ignore'):
+        week = earlier & (taken_at >= (latest_at - BASELINE_MINIMUM_WINDOW)
+                          [:, np.newaxis])
+        year = earlier & (taken_at >= (latest_at - BASELINE_MEDIAN_WINDOW)
+                          [:, np.newaxis])
+    lowest = np.where(week, values, np.inf).min(axis=1, initial=np.inf)
+    minimum = np.where(week.any(axis=1), lowest, np.nan)
+    median = np.full(len(values), np.nan)
+    with_year = year.any(axis=1)
+    if with_year.any():
+        median[with_year] = np.nanmedian(
+            np.where(year, values, np.nan)[with_year], axis=1)
+    return latest, minimum, median
+
+
+class CommitError(Exception):
+    """Raised when the writes of a batch of messages could not be committed.
+
+    They have been rolled back, so the messages must not be acknowledged or
+    their predictions paged; processing them again is safe.
+    """
+
+
+class AKIPredictor:
+    """Class for processing HL7 messages to update patient data and predict AKI.
+
+    Constructor Attributes:
+        db_path (str): Path to the SQLite database.
+                       Defaults to 'state/my_database.db'.
+        model: Machine learning model for AKI prediction.
+        metrics_count_flag (bool): Flag to enable or disable Prometheus metrics
+                                   counting. Useful for disabling metrics
+                                   updates during unit testing to prevent side
+                                   effects. Defaults to True, enabling metrics
+                                   counting.
+        cache_size (int): Maximum number of patients held in the in-memory
+                          patient cache. Defaults to PATIENT_CACHE_SIZE.
+        patient_store (ColumnarPatientStore): Optional columnar engine for
+                                              patient state, read instead of
+                                              the cache. Writes still go
+                                              through to the database unless
+                                              `db_path` is None, keeping all
+                                              state in memory only.
+                                              Defaults to None.
+        history_snapshot (str): Optional read-only history snapshot. Patients
+                                missing from the database are looked up in
+                                it, so the database only needs to hold the
+                                patients written since. Defaults to None.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES (see
+                             `KDIGORules`). Defaults to 'model'.
+        writers (int): Number of connections writing to the database at the
+                       same time, sizing the wait for its write lock (see
+                       `open_patient_database`). Defaults to 1.
+        pending_predictions (PendingPredictions): MRNs pending AKI
+                                   prediction. Specifically for cases where
+                                   LIMS test results messages have been
+                                   received before their corresponding PAS
+                                   admission messages. Kept in the database
+                                   unless the predictor has none.
+        creatinine_baselines (CreatinineBaselineCache): Rolling creatinine
+                                   baselines of recently seen patients,
+                                   updated as each result is recorded in the
+                                   `creatinine_results` time series.
+
+    Database connections are opened lazily, one per calling thread, and kept
+    open for the lifetime of the predictor; call `close` to release them.
+    Patient state is read from a write-through `PatientCache`; the database
+    is only read for patients that are not cached.
+
+    Methods:
+        close: Closes every database connection opened by the predictor.
+        commit: Commits the writes of the messages examined so far.
+        rollback: Undoes the writes of the messages examined so far.
+        swap_model: Replaces the model, from any thread.
+        warm_cache: Loads patient records into the cache in bulk.
+        resume_pending_predictions: Reloads the pending predictions after a
+                                    restart and scores those now possible.
+        process_lims_message: Processes lab results from LIMS messages.
+        process_pas_message: Processes patient admission data from PAS messages.
+        _calculate_age: Calculates age from date of birth.
+        _is_valid_dob: Validates the format of the date of birth.
+        attempt_aki_prediction: Attempts to predict AKI based on patient data.
+        examine_message_and_predict_aki: Main method to process HL7 messages.
+        examine_messages_and_predict_aki: Processes a batch of HL7 messages,
+                                          scoring them in one model call.
+    """
+
+    def __init__(self, model, db_path: str = 'state/my_database.db',
+                 metrics_count_flag=True,
+                 cache_size: int = PATIENT_CACHE_SIZE,
+                 patient_store: ColumnarPatientStore | None = None,
+                 history_snapshot: str | None = None,
+                 decision_mode: str = 'model',
+                 writers: int = 1):
+        self.db_path = db_path
+        self.history_snapshot = history_snapshot
+        self.writers = writers
+        self._select_sql = PATIENT_SELECT_SQL if history_snapshot is None \
+            else SNAPSHOT_PATIENT_SELECT_SQL
+        self.model = model
+        self.rules = KDIGORules(decision_mode)
+        self.metrics_count_flag = metrics_count_flag
+        self.patient_store = patient_store
+        self.pending_predictions = PendingPredictions()
+        self.cache = PatientCache(cache_size)
+        self.creatinine_baselines = CreatinineBaselineCache(
+            cache_size, history_snapshot is not None)
+        # MRNs written in the open transaction, and in the current message.
+        self._transaction_mrns = set()
+        self._message_mrns = []
+        # Patient store rows as they were before the open transaction, and
+        # before the current message (None for new patients), to undo them.
+        self._transaction_rows = {}
+        self._message_rows = {}
+        # Predictions deferred while a batch of messages is examined.
+        self._scoring_batch = None
+        self._message_index = 0
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Returns the calling thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = open_patient_database(self.db_path, self.history_snapshot,
+                                         self.writers)
+            conn.execute(PENDING_PREDICTIONS_TABLE_SQL)
+            conn.execute(CREATININE_RESULTS_TABLE_SQL)
+            conn.execute(CREATININE_RESULTS_INDEX_SQL)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self) -> None:
+        """Closes every database connection opened by the predictor."""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def swap_model(self, model) -> None:
+        """Replaces the model used for predictions made from now on.
+
+        Every model call reads `model` once, so it may be swapped from
+        another thread: a batch being scored finishes with the old model.
+        """
+        self.model = model
+
+    def warm_cache(self, shard: tuple[int, int] | None = None) -> int:
+        """Loads patient records from the database until the cache is full.
+
+        The creatinine baselines of the loaded patients are built too, so
+        that their next results need no database reads either.
+
+        Args:
+            shard (tuple[int, int]): Optional (index, count) restricting the
+                                     records loaded to the patients of one
+                                     `mrn_shard`.
+
+        Returns:
+            int: The number of records loaded.
+        """
+        if self.history_snapshot is None:
+            query = ("SELECT mrn, age, sex, test_1, test_2, test_3, test_4, "
+                     "test_5 FROM patient_history")
+        else:
+            query = SNAPSHOT_PATIENTS_SQL
+        if shard is None:
+            cursor = self._connection().execute(f"{query} LIMIT ?",
+                                                (self.cache.capacity,))
+        else:
+            cursor = self._connection().execute(query)
+        loaded = set()
+        for row in cursor:
+            if len(loaded) >= self.cache.capacity:
+                break
+            if shard is not None and mrn_shard(row[0], shard[1]) != shard[0]:
+                continue
+            self.cache.put(row[0], PatientRecord.from_row(row[1:]))
+            loaded.add(row[0])
+        self.creatinine_baselines.warm(self._connection().cursor(), loaded)
+        return len(loaded)
+
+    def resume_pending_predictions(
+            self, shard: tuple[int, int] | None = None) -> list[str]:
+        """Reloads the pending predictions saved before a restart.
+
+        Expired entries are dropped, and the patients whose demographics
+        have become known meanwhile are scored together in one model call
+        rather than waiting for another message. Without a database (a
+        patient store with no `db_path`) there is nothing to reload.
+
+        Args:
+            shard (tuple[int, int]): Optional (index, count) restricting the
+                                     backlog to the patients of one
+                                     `mrn_shard`.
+
+        Returns:
+            list[str]: The MRNs of the patients predicted to have AKI.
+        """
+        if self.db_path is None:
+            return []
+        conn = self._connection()
+        loaded = self.pending_predictions.load(conn.cursor(), shard)
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.count('pending_predictions', loaded)
+        self._scoring_batch = batch = []
+        decided = []
+        try:
+            with self._message_savepoint(conn) as cursor:
+                self._expire_pending_predictions(cursor)
+                for mrn in self.pending_predictions:
+                    record = self._load_patient(cursor, mrn)
+                    if record is None or record.age is None \
+                            or record.sex is None:
+                        continue
+                    self.pending_predictions.pop(cursor, mrn)
+                    if self.metrics_count_flag:
+                        PROCESSING_METRICS.count('pending_predictions', -1)
+                    self._message_index = len(batch)
+                    decided.append(self.attempt_aki_prediction(
+                        mrn, record.features(),
+                        f"\n[MRN: {mrn} (pending prediction)]",
+                        self.creatinine_baselines.get(cursor, mrn)))
+            self._scoring_batch = None
+            results = [None] * len(batch)
+            self._score_batch(batch, results)
+        finally:
+            self._scoring_batch = None
+            self.commit()
+        print(f"Resumed {loaded} pending predictions, scored "
+              f"{len(batch)} with the model and {len(decided)} in all.")
+        return [mrn for mrn in decided + results if mrn]
+
+    def _load_patient(self, cursor, mrn: str) -> PatientRecord | None:
+        """Returns the patient's record, from the cache when possible.
+
+        Args:
+            cursor: SQLite database cursor, used on a cache miss.
+            mrn (str): Medical Record Number of the patient.
+
+        Returns:
+            Optional[PatientRecord]: The record, or None for a new patient.
+        """
+        if self.patient_store is not None:
+            if cursor is not None:
+                self._remember_store_row(mrn)
+            return self.patient_store.get(mrn)
+        record = self.cache.get(mrn)
+        if record is None:
+            started = time.perf_counter()
+            cursor.execute(self._select_sql, (mrn,))
+            row = cursor.fetchone()
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.time('database',
+                                        time.perf_counter() - started)
+            if row is not None:
+                record = PatientRecord.from_row(row)
+                self.cache.put(mrn, record)
+        return record
+
+    def _remember_store_row(self, mrn: str) -> None:
+        """Keeps a patient store row as it was before the current message,
+        so that `_revert_store_rows` can undo the message's changes."""
+        if mrn not in self._message_rows:
+            record = self.patient_store.get(mrn)
+            self._message_rows[mrn] = None if record is None \
+                else record.features().copy()
+
+    def _revert_store_rows(self, rows: dict) -> None:
+        """Restores patient store rows saved by `_remember_store_row`."""
+        for mrn, features in reversed(rows.items()):
+            self.patient_store.revert(mrn, features)
+
+    def _store_patient(self, cursor, mrn: str,
+                       record: PatientRecord) -> PatientRecord:
+        """Caches the patient's record and writes it through to the database.
+
+        Args:
+            cursor: SQLite database cursor.
+            mrn (str): Medical Record Number of the patient.
+            record (PatientRecord): The patient's updated record.
+
+        Returns:
+            PatientRecord: The stored record.
+        """
+        if self.patient_store is not None:
+            if cursor is None:
+                return self.patient_store.put(mrn, record)
+            self._remember_store_row(mrn)
+            record = self.patient_store.put(mrn, record)
+        else:
+            self.cache.put(mrn, record)
+        self._message_mrns.append(mrn)
+        started = time.perf_counter()
+        cursor.execute(PATIENT_UPSERT_SQL, (mrn, *record.row()))
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.time('database', time.perf_counter() - started)
+        return record
+
+    def process_lims_message(self, cursor, mrn: str, message: HL7Message,
+                             msg_identifier: str) -> str | None:
+        """Processes a LIMS (Laboratory Information Management System) message.
+
+        The LIMS message contains lab test results; we are interested in
+        creatinine blood test results -- message type "ORU^R01".
+        The function updates the patient's test results in the database,
+        appends the result to their creatinine time series, taken at the
+        message's MSH-7 time, and attempts an AKI prediction if possible.
+
+        Args:
+            cursor: SQLite database cursor.
+            mrn (str): Medical Record Number of the patient.
+            message (HL7Message): The HL7 message.
+            msg_identifier (str): Identifier for logging purposes.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None.
+        """
+        test_type = message.test_type
+        if test_type != "CREATININE":
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count(
+                    'non_creatinine_lims_messages_received')
+            logging.error(f"{msg_identifier}\n>> Invalid test type: "
+                          f"{test_type}")
+            return None
+        creatinine_result_str = message.test_result
+        if not creatinine_result_str.replace('.', '', 1).isdigit():
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count(
+                    'invalid_creatinine_lims_messages_received')
+            logging.error(f"{msg_identifier}\n>> Invalid test result format: "
+                          f"{creatinine_result_str}")
+            return None
+
+        creatinine_result = float(creatinine_result_str)
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.result('total', creatinine_result)
+
+        record = self._load_patient(cursor, mrn)
+        new_patient = record is None
+        if new_patient:  # occurs if LIMS received before PAS for a new MRN
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('new_patients')
+                PROCESSING_METRICS.count('lims_received_before_pas')
+            record = PatientRecord()
+
+        taken_at = parse_hl7_timestamp(message.timestamp)
+        if taken_at is None:
+            taken_at = time.time()
+        started = time.perf_counter()
+        baselines = self.creatinine_baselines.add(
+            cursor, mrn, taken_at, creatinine_result, new_patient)
+        if self.metrics_count_flag and cursor is not None:
+            PROCESSING_METRICS.time('database', time.perf_counter() - started)
+
+        record.push_result(creatinine_result)
+        record = self._store_patient(cursor, mrn, record)
+
+        if record.age is None or record.sex is None:
+            # Score the result once the patient's admission arrives.
+            self._expire_pending_predictions(cursor)
+            if self.pending_predictions.add(cursor, mrn, time.time()) \
+                    and self.metrics_count_flag:
+                PROCESSING_METRICS.count('pending_predictions')
+            return None
+        return self.attempt_aki_prediction(mrn, record.features(),
+                                           msg_identifier, baselines)
+
+    def process_pas_message(self, cursor, mrn: str, message: HL7Message,
+                            msg_identifier: str) -> str | None:
+        """ Processes a PAS (Patient Administration System) message.
+
+        The PAS message contains demographic (age and sex) information; we are
+        interested in admission messages -- message type "ADT^A01".
+        The function updates or inserts the patient's demographic data into the
+        database. It also attempts an AKI prediction in case of pending ones
+        stored for LIMS messages received for a new patient where the
+        corresponding admission PAS message was still not received.
+
+        Args:
+            cursor: SQLite database cursor.
+            mrn (str): Medical Record Number of the patient.
+            message (HL7Message): The HL7 message.
+            msg_identifier (str): Identifier for logging purposes.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None.
+        """
+        date_of_birth = message.date_of_birth
+        age = age_on(date_of_birth, REFERENCE_DATE.today())
+        if age is None:
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('invalid_dob_received')
+            logging.error(f"{msg_identifier}\n>> Invalid DOB format: "
+                          f"{date_of_birth}")
+            return None
+        sex_str = message.sex
+        if sex_str not in ["F", "M"]:
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('invalid_sex_received')
+            logging.error(f"{msg_identifier}\n>> Invalid sex value: "
+                          f"{sex_str}")
+            return None
+
+        sex = 1 if sex_str == "F" else 0
+
+        record = self._load_patient(cursor, mrn)
+        if record is None:
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('new_patients')
+            record = PatientRecord()
+
+        # Update or insert the demographic information
+        record.age = age
+        record.sex = sex
+        record = self._store_patient(cursor, mrn, record)
+
+        self._expire_pending_predictions(cursor)
+        if self.pending_predictions.pop(cursor, mrn):
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('pending_predictions', -1)
+            return self.attempt_aki_prediction(
+                mrn, record.features(), msg_identifier,
+                self.creatinine_baselines.get(cursor, mrn))
+        return None
+
+    def _expire_pending_predictions(self, cursor) -> None:
+        """Drops the pending predictions older than their TTL."""
+        expired = self.pending_predictions.expire(cursor, time.time())
+        if expired:
+            logging.info(f"{expired} pending predictions expired without "
+                         f"an admission")
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('pending_predictions', -expired)
+                PROCESSING_METRICS.count('pending_predictions_expired',
+                                         expired)
+
+    @staticmethod
+    def _calculate_age(dob: str) -> int:
+        """Calculates a person's age in years based on their date of birth.
+
+        The age is computed by comparing today's date with the provided
+        date of birth (dob).
+
+        Args:
+            dob (str): The date of birth in "%Y%m%d" format.
+
+        Returns:
+            int: The calculated age in years.
+        """
+        age = age_on(dob, REFERENCE_DATE.today())
+        if age is None:
+            raise ValueError(f"time data {dob!r} does not match format "
+                             f"'%Y%m%d'")
+        return age
+
+    @staticmethod
+    def _is_valid_dob(dob: str) -> bool:
+        """Check if the date of birth is in the correct format "%Y%m%d".
+
+        Args:
+            dob (str): The date of birth.
+
+        Returns:
+            bool: True if dob is in the "%Y%m%d" format, False otherwise.
+        """
+        return age_on(dob, REFERENCE_DATE.today()) is not None
+
+    def attempt_aki_prediction(self, mrn: str, patient_data,
+                               msg_identifier: str,
+                               baselines: CreatinineBaselines | None = None) \
+            -> str | None:
+        """
+        Attempts to predict AKI based on available patient data.
+
+        Unless the decision mode is 'model', the KDIGO rules are applied to
+        the patient's baselines first, and the model is only called for the
+        results they leave undecided.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+            patient_data: The patient's age, sex and five most recent
+                          creatinine results, either as a tuple with None
+                          for unknown values or as a float array with NaN.
+            msg_identifier (str): Identifier for logging purposes.
+            baselines (CreatinineBaselines): The patient's creatinine
+                                             baselines, if known.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None. While a batch of
+                           messages is being examined, a prediction left to
+                           the model is deferred until the whole batch is
+                           scored, and None is returned here.
+        """
+        # A float64 array (e.g. a columnar store row) is used without a copy.
+        patient_data = np.asarray(patient_data, dtype=np.float64)
+
+        # Ensure age and sex are known (not the case if LIMS received before PAS)
+        if np.isnan(patient_data[:FIRST_TEST_COLUMN]).any():
+            return None
+
+        aki = self.rules.decide(baselines)
+        if aki is not None:
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('rule_based_predictions')
+            return mrn if self._record_prediction(mrn, aki, patient_data,
+                                                  msg_identifier) else None
+
+        if self._scoring_batch is not None:
+            # Later messages of the batch may update the same row: copy it.
+            self._scoring_batch.append((self._message_index, mrn,
+                                        patient_data.copy(), msg_identifier))
+            return None
+        started = time.perf_counter()
+        aki = self.model.predict(patient_data.reshape(1, -1))[0]
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.time('inference', time.perf_counter() - started)
+        return mrn if self._record_prediction(mrn, aki, patient_data,
+                                              msg_identifier) else None
+
+    def _record_prediction(self, mrn: str, aki, patient_data: np.ndarray,
+                           msg_identifier: str) -> bool:
+        """Logs a prediction and updates the metrics.
+
+        Args:
+            mrn (str): Medical Record Number of the patient.
+            aki: The model's prediction for the patient.
+            patient_data (np.ndarray): The features the prediction was made on.
+            msg_identifier (str): Identifier for logging purposes.
+
+        Returns:
+            bool: True if AKI was predicted.
+        """
+        last_result = patient_data[FIRST_TEST_COLUMN]
+        if aki:
+            logging.info(f"{msg_identifier}\n>> AKI predicted for "
+                         f"MRN: {mrn}")
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('positive_aki_predictions')
+                PROCESSING_METRICS.result('aki', last_result)
+            return True
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.result('normal', last_result)
+        return False
+
+    def _score_batch(self, batch: list, results: list) -> None:
+        """Scores deferred predictions with a single model call.
+
+        If that call fails, the predictions are made one at a time instead,
+        so that only those the model cannot make are lost.
+
+        Args:
+            batch (list): (message index, MRN, features, message identifier)
+                          tuples queued by `attempt_aki_prediction`.
+            results (list): Per-message results, updated in place with the
+                            MRN of every positive prediction.
+        """
+        if not batch:
+            return
+        model = self.model
+        try:
+            started = time.perf_counter()
+            predictions = model.predict(
+                np.vstack([features for _, _, features, _ in batch]))
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.time('inference',
+                                        time.perf_counter() - started)
+        except Exception as e:
+            logging.error(f"An unexpected error occurred during AKI "
+                          f"prediction of {len(batch)} patients, predicting "
+                          f"them one at a time: {e}")
+            predictions = [self._predict_one(model, features, msg_identifier)
+                           for _, _, features, msg_identifier in batch]
+        for (index, mrn, features, msg_identifier), aki \
+                in zip(batch, predictions):
+            if aki is None:
+                continue
+            if self._record_prediction(mrn, aki, features, msg_identifier):
+                results[index] = mrn
+
+    def _predict_one(self, model, features: np.ndarray,
+                     msg_identifier: str):
+        """Predicts AKI for one patient, logging any error of the model.
+
+        Args:
+            model: The model to predict with.
+            features (np.ndarray): The patient's features.
+            msg_identifier (str): Identifier for logging purposes.
+
+        Returns:
+            The model's prediction, or None if it raised.
+        """
+        try:
+            started = time.perf_counter()
+            aki = model.predict(features.reshape(1, -1))[0]
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.time('inference',
+                                        time.perf_counter() - started)
+            return aki
+        except Exception as e:
+            logging.error(f"{msg_identifier}\n>> An unexpected error occurred "
+                          f"during AKI prediction: {e}")
+            return None
+
+    @contextlib.contextmanager
+    def _message_savepoint(self, conn: sqlite3.Connection):
+        """Scopes the writes of one message within the open transaction.
+
+        A transaction is started if none is open. If processing the message
+        raises, only that message's writes are rolled back; writes of earlier
+        messages in the same transaction are kept. Cached records changed by
+        a rolled back message are dropped so they are reloaded from the
+        database.
+        """
+        if not conn.in_transaction:
+            # Take the write lock up front: a read snapshot could not be
+            # upgraded once another connection (the pager's) has written.
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute("SAVEPOINT message")
+        self._message_mrns = []
+        self._message_rows = {}
+        try:
+            yield conn.cursor()
+        except BaseException:
+            conn.execute("ROLLBACK TO message")
+            if self.patient_store is not None:
+                self._revert_store_rows(self._message_rows)
+            for mrn in self._message_mrns:
+                self.cache.discard(mrn)
+                self.creatinine_baselines.discard(mrn)
+                self.pending_predictions.reload(conn.cursor(), mrn)
+            raise
+        else:
+            self._transaction_mrns.update(self._message_mrns)
+            for mrn, features in self._message_rows.items():
+                self._transaction_rows.setdefault(mrn, features)
+        finally:
+            conn.execute("RELEASE message")
+
+    def commit(self) -> bool:
+        """Commits the open transaction of the calling thread's connection.
+
+        Returns:
+            bool: True if the writes are durable (or there was nothing to
+                  commit), False if the commit failed and was rolled back.
+        """
+        conn = getattr(self._local, "conn", None)
+        mrns, self._transaction_mrns = self._transaction_mrns, set()
+        rows, self._transaction_rows = self._transaction_rows, {}
+        if conn is None or not conn.in_transaction:
+            return True
+        try:
+            started = time.perf_counter()
+            conn.execute("COMMIT")
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.time('database',
+                                        time.perf_counter() - started)
+            return True
+        except sqlite3.Error as e:
+            logging.error(f"Database error on commit: {e}")
+            self._undo_transaction(conn, mrns, rows)
+            return False
+
+    def rollback(self) -> None:
+        """Rolls back the open transaction of the calling thread's connection.
+
+        Cached patient state written in it is dropped, to be reloaded from
+        the database.
+        """
+        conn = getattr(self._local, "conn", None)
+        mrns, self._transaction_mrns = self._transaction_mrns, set()
+        rows, self._transaction_rows = self._transaction_rows, {}
+        if conn is not None:
+            self._undo_transaction(conn, mrns, rows)
+
+    def _undo_transaction(self, conn: sqlite3.Connection, mrns: set,
+                          rows: dict) -> None:
+        """Rolls back `conn` and the in-memory state written with it."""
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        if self.patient_store is not None:
+            self._revert_store_rows(rows)
+        for mrn in mrns:  # The cache is ahead of the database now.
+            self.cache.discard(mrn)
+            self.creatinine_baselines.discard(mrn)
+            self.pending_predictions.reload(conn.cursor(), mrn)
+
+    def load_ingest_position(self) -> tuple[int, int] | None:
+        """Returns the ingest log position saved by `record_ingest_position`.
+
+        Returns:
+            Optional[tuple[int, int]]: The (segment, offset) up to which the
+                                       log has been processed, or None.
+        """
+        conn = self._connection()
+        conn.execute(INGEST_POSITION_TABLE_SQL)
+        return conn.execute("SELECT segment, offset FROM ingest_position "
+                            "WHERE id = 1").fetchone()
+
+    def record_ingest_position(self, position: tuple[int, int]) -> None:
+        """Saves an ingest log position in the open transaction.
+
+        Committed together with the writes of the messages before it.
+
+        Args:
+            position (tuple[int, int]): The (segment, offset) up to which the
+                                        log has been processed.
+        """
+        conn = self._connection()
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute("INSERT INTO ingest_position (id, segment, offset) "
+                     "VALUES (1, ?, ?) ON CONFLICT (id) DO UPDATE SET "
+                     "segment = excluded.segment, offset = excluded.offset",
+                     position)
+
+    def record_pages(self, mrns: list[str]) -> None:
+        """Stores pages in the `pending_pages` table in the open transaction.
+
+        Committed together with the writes of the messages that triggered
+        them, so a `PagerDispatcher` on the same database resumes them
+        after a crash, even if they were never submitted to it.
+
+        Args:
+            mrns (list[str]): MRNs of the patients to page.
+        """
+        if not mrns:
+            return
+        conn = self._connection()
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
+        conn.execute(PENDING_PAGES_TABLE_SQL)
+        queued_at = time.time()
+        conn.executemany(
+            "INSERT OR IGNORE INTO pending_pages (mrn, queued_at) "
+            "VALUES (?, ?)", [(mrn, queued_at) for mrn in mrns])
+
+    def examine_message_and_predict_aki(self, message: list[str],
+                                        commit: bool = True) -> str | None:
+        """Examines an HL7 message for patient data updates or AKI prediction.
+
+        This function handles HL7 messages, updating the patient database with
+        demographic information from ADT^A01 (PAS Admission) messages, or
+        creatinine test results from ORU^R01 (LIMS) messages.
+        For creatinine updates, it may trigger a prediction for acute kidney
+        injury (AKI) using the provided pretrained machine learning model.
+
+        Args:
+            message (list[str]): The HL7 message split into string segments.
+            commit (bool): Whether to commit the message's writes before
+                           returning. Pass False to group several messages
+                           into one transaction, then call `commit`.
+                           Defaults to True.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None.
+
+        Raises:
+            CommitError: If the message's writes could not be committed.
+        """
+        return self.examine_messages_and_predict_aki([message], commit)[0]
+
+    def examine_messages_and_predict_aki(self, messages: list[list[str]],
+                                         commit: bool = True) -> list:
+        """Examines a batch of HL7 messages, scoring them with one model call.
+
+        Every message is applied in arrival order, exactly as by
+        `examine_message_and_predict_aki`, but the AKI predictions they
+        trigger are collected and made with a single `predict` call once
+        the whole batch has been applied. Each prediction uses the patient's
+        features as they were when its message was applied.
+
+        Args:
+            messages (list[list[str]]): HL7 messages, each split into string
+                                        segments.
+            commit (bool): Whether to commit the batch's writes before
+                           returning. Defaults to True.
+
+        Returns:
+            list: For each message, the MRN of the patient if an AKI
+                  prediction is positive; otherwise, None.
+
+        Raises:
+            CommitError: If the batch's writes could not be committed, or
+                         the database stayed locked by another writer; they
+                         have been rolled back.
+        """
+        self._scoring_batch = batch = []
+        try:
+            results = []
+            for self._message_index, message in enumerate(messages):
+                results.append(self._examine_message(message))
+            self._scoring_batch = None
+            self._score_batch(batch, results)
+        except BaseException:
+            # Committing part of the batch would apply the rest twice when
+            # it is processed again.
+            self.rollback()
+            raise
+        finally:
+            self._scoring_batch = None
+        committed = not commit or self.commit()
+        if not committed:
+            raise CommitError(f"the writes of {len(messages)} messages were "
+                              f"rolled back")
+        return results
+
+    def _examine_message(self, message: list[str]) -> str | None:
+        """Applies one HL7 message, logging any error it raises.
+
+        Args:
+            message (list[str]): The HL7 message split into string segments.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None.
+
+        Raises:
+            CommitError: If the database stayed locked by another writer
+                         for longer than the busy timeout.
+        """
+        try:
+            if self.db_path is None:
+                return self._process_message(None, message)
+            conn = self._connection()
+            with self._message_savepoint(conn) as c:
+                return self._process_message(c, message)
+
+        except IndexError as e:
+            logging.error(f"Error processing message due to invalid message "
+                          f"format: {e}")
+        except sqlite3.Error as e:
+            if is_database_locked(e):
+                # Not the message's fault: the window must be retried rather
+                # than acknowledged without it.
+                raise CommitError(f"the database is locked: {e}") from e
+            logging.error(f"Database error: {e}")
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {e}")
+        return None
+
+    def _process_message(self, cursor, message: list[str]) -> str | None:
+        """Dispatches an HL7 message to the LIMS or PAS handler.
+
+        Args:
+            cursor: SQLite database cursor.
+            message (list[str]): The HL7 message split into string segments.
+
+        Returns:
+            Optional[str]: The MRN of a patient if an AKI prediction is
+                           positive; otherwise, None.
+        """
+        if self.metrics_count_flag:
+            PROCESSING_METRICS.count('messages_processed')
+            started = time.perf_counter()
+            hl7_message = HL7Message(message)
+            PROCESSING_METRICS.time('parse', time.perf_counter() - started)
+        else:
+            hl7_message = HL7Message(message)
+        message_type = hl7_message.message_type
+        mrn = hl7_message.mrn
+        timestamp = hl7_message.timestamp
+        msg_identifier = f"\n[MRN: {mrn} " \
+                         f"\nmessage_type <{message_type}>" \
+                         f"\ntimestamp: {timestamp}]"
+        if not mrn.isdigit():
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('invalid_mrn_received')
+            logging.error(f"{msg_identifier}\n>> "
+                          f"Invalid MRN format: {mrn}")
+            return None
+
+        if message_type == "ORU^R01":
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('lims_messages_processed')
+            return self.process_lims_message(cursor, mrn, hl7_message,
+                                             msg_identifier)
+        elif message_type == "ADT^A01":
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('pas_messages_processed')
+            return self.process_pas_message(cursor, mrn, hl7_message,
+                                            msg_identifier)
+        else:
+            if self.metrics_count_flag:
+                PROCESSING_METRICS.count('non_relevant_messages_processed')
+            return None
+
+
+class QueuedMessage:
+    """An HL7 message handed over from the receiver to the processor.
+
+    Attributes:
+        segments (list[str]): The HL7 message split into string segments.
+        processed (threading.Event): Set by the processor once the message has
+                                     been fully handled and may be ACKed.
+    """
+
+    __slots__ = ("segments", "processed")
+
+    def __init__(self, segments: list[str]):
+        self.segments = segments
+        self.processed = threading.Event()
+
+
+class ProcessingOptions:
+    """Settings shared by the processors of every engine.
+
+    Constructor Attributes:
+        db_path (str): Path to the SQLite database.
+        max_retries (int): Maximum number of attempts per page.
+        retry_delay (float): Delay before the first paging retry in seconds;
+                             later retries back off exponentially.
+        batch_size (int): Maximum number of messages per window. Defaults
+                          to 1, committing and scoring every message.
+        batch_latency (float): Maximum time in seconds to hold a window open
+                               waiting for further messages. Defaults to 0.0,
+                               only batching messages already queued.
+        cache_size (int): Maximum number of patients held in memory, by
+                          each worker when sharded.
+        patient_store (ColumnarPatientStore): Optional columnar patient state
+                                              engine used instead of SQLite,
+                                              by the single processors only.
+        history_snapshot (str): Optional read-only history snapshot read
+                                for patients missing from the database.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES.
+        model_reloader (ModelReloader): Optional reloader swapping new
+                                        models into the predictors.
+        metrics_count_flag (bool): Whether to update Prometheus metrics.
+    """
+
+    def __init__(self, db_path: str = 'state/my_database.db',
+                 max_retries: int = 15, retry_delay: float = 1.0,
+                 batch_size: int = 1, batch_latency: float = 0.0,
+                 cache_size: int = PATIENT_CACHE_SIZE,
+                 patient_store: ColumnarPatientStore | None = None,
+                 history_snapshot: str | None = None,
+                 decision_mode: str = 'model',
+                 model_reloader: ModelReloader | None = None,
+                 metrics_count_flag: bool = True):
+        self.db_path = db_path
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.batch_size = batch_size
+        self.batch_latency = batch_latency
+        self.cache_size = cache_size
+        self.patient_store = patient_store
+        self.history_snapshot = history_snapshot
+        self.decision_mode = decision_mode
+        self.model_reloader = model_reloader
+        self.metrics_count_flag = metrics_count_flag
+
+
+def process_window(aki_predictor: AKIPredictor,
+                   messages: list[list[str]]) -> list | None:
+    """Processes a window of messages until its writes are committed.
+
+    A window whose commit fails has been rolled back entirely, so it is
+    processed again after a pause rather than acknowledged.
+
+    Args:
+        aki_predictor (AKIPredictor): The predictor to process it with.
+        messages (list[list[str]]): HL7 messages, each split into segments.
+
+    Returns:
+        Optional[list]: The results of `examine_messages_and_predict_aki`,
+                        or None if the program stopped before the window
+                        could be committed.
+    """
+    while True:
+        try:
+            return aki_predictor.examine_messages_and_predict_aki(messages)
+        except CommitError as e:
+            logging.error(f"Processing the window again: {e}")
+            if stop_event.wait(STOP_POLL_INTERVAL):
+                return None
+
+
+# Windows of messages a processing shard may hold before the processor waits.
+SHARD_WINDOWS_IN_FLIGHT = 4
+
+
+def mrn_shard(mrn: str, shards: int) -> int:
+    """Returns the processing shard that owns a patient.
+
+    Args:
+        mrn (str): Medical Record Number of the patient.
+        shards (int): Number of shards.
+
+    Returns:
+        int: The shard index, stable across runs and processes.
+    """
+    return zlib.crc32(mrn.encode('utf-8')) % shards
+
+
+def message_shard(message: list[str], shards: int) -> int:
+    """Returns the processing shard of an HL7 message's patient.
+
+    Messages without an MRN all go to shard 0, which reports them.
+
+    Args:
+        message (list[str]): The HL7 message split into string segments.
+        shards (int): Number of shards.
+
+    Returns:
+        int: The shard index.
+    """
+    try:
+        mrn = HL7Message(message).mrn
+    except IndexError:
+        return 0
+    return mrn_shard(mrn, shards)
+
+
+def shard_worker(requests, results, shard: int, shards: int, model,
+                 db_path: str, cache_size: int,
+                 history_snapshot: str | None,
+                 decision_mode: str) -> None:
+    """Entry point of a processing shard's worker process.
+
+    Once its cache is warm and its pending predictions are resumed, sends
+    the MRNs those predicted positive, then receives windows of messages,
+    all belonging to the shard's patients, and sends back the result of
+    `examine_messages_and_predict_aki` for each, until `requests` is
+    closed. A new model may be sent instead of a window; it is swapped in
+    for the windows that follow, and no result is sent back for it.
+
+    Every reply is a pair of the result and the metric updates made since
+    the previous reply (see `ProcessingMetrics.take`), for the parent
+    process to publish.
+
+    Args:
+        requests (multiprocessing.connection.Connection): Windows to process.
+        results (multiprocessing.connection.Connection): Their results,
+                                                         with metrics.
+        shard (int): Index of this shard.
+        shards (int): Number of shards.
+        model: The shard's copy of the model.
+        db_path (str): Path to the SQLite database.
+        cache_size (int): Maximum number of patients held in memory.
+        history_snapshot (str): Optional read-only history snapshot.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES.
+    """
+    # The parent process decides when to stop and then closes `requests`.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    # Every shard and the parent's pager write to the database.
+    aki_predictor = AKIPredictor(model, db_path, cache_size=cache_size,
+                                 history_snapshot=history_snapshot,
+                                 decision_mode=decision_mode,
+                                 writers=shards + 1)
+    try:
+        if history_snapshot is None:
+            aki_predictor.warm_cache(shard=(shard, shards))
+        results.send((aki_predictor.resume_pending_predictions(
+            shard=(shard, shards)), PROCESSING_METRICS.take()))
+        while True:
+            try:
+                messages = requests.recv()
+            except EOFError:
+                break
+            if not isinstance(messages, list):
+                aki_predictor.swap_model(messages)
+                continue
+            # Results are only sent back, and ACKed, once committed.
+            results.send((process_window(aki_predictor, messages),
+                          PROCESSING_METRICS.take()))
+    finally:
+        aki_predictor.close()
+        results.close()
+
+
+class ProcessingShard:
+    """A worker process owning the state of one shard of the patients.
+
+    The worker has its own `AKIPredictor`, model copy and patient cache.
+    Windows are handed to it in order and their results come back in the
+    same order on a collector thread, which pages positive predictions and
+    releases the messages for acknowledgement.
+
+    Constructor Attributes:
+        context: The multiprocessing context to start the worker with.
+        shard (int): Index of this shard.
+        shards (int): Number of shards.
+        model: Pretrained Machine learning model, copied to the worker.
+        dispatcher (PagerDispatcher): Receives the positive predictions.
+        db_path (str): Path to the SQLite database.
+        cache_size (int): Maximum number of patients held by the worker.
+        history_snapshot (str): Optional read-only history snapshot.
+        decision_mode (str): How AKI is decided, one of DECISION_MODES.
+
+    Methods:
+        submit: Hands a window of messages to the worker.
+        swap_model: Sends the worker a new model for the windows to come.
+        close: Waits for outstanding windows and stops the worker.
+    """
+
+    def __init__(self, context, shard: int, shards: int, model,
+                 dispatcher, db_path: str, cache_size: int,
+                 history_snapshot: str | None,
+                 decision_mode: str = 'model'):
+        self.shard = shard
+        self.dispatcher = dispatcher
+        requests_reader, self._requests = context.Pipe(duplex=False)
+        # Windows and models are sent from different threads.
+        self._requests_lock = threading.Lock()
+        self._results, results_writer = context.Pipe(duplex=False)
+        self.process = context.Process(
+            target=shard_worker, name=f"aki-shard-{shard}", daemon=True,
+            args=(requests_reader, results_writer, shard, shards, model,
+                  db_path, cache_size, history_snapshot,
+                  decision_mode))
+        self.process.start()
+        # Only the worker uses these ends; closing them here lets each side
+        # see end-of-file once the other side is done.
+        requests_reader.close()
+        results_writer.close()
+        self._in_flight = collections.deque()
+        self._started = False
+        self._slots = threading.BoundedSemaphore(SHARD_WINDOWS_IN_FLIGHT)
+        self._collector = threading.Thread(target=self._collect,
+                                           name=f"aki-shard-{shard}-results",
+                                           daemon=True)
+
+    def wait_started(self) -> bool:
+        """Waits until the worker is ready to process messages.
+
+        Returns:
+            bool: False if the worker exited while starting.
+        """
+        try:
+            resumed, metrics = self._results.recv()
+        except EOFError:
+            resumed = None
+        self._started = resumed is not None
+        if self._started:
+            PROCESSING_METRICS.merge(metrics)
+            for mrn in resumed:  # Positive resumed pending predictions
+                self.dispatcher.submit(mrn)
+            self._collector.start()
+        return self._started
+
+    def submit(self, window: list[QueuedMessage]) -> bool:
+        """Hands a window of messages to the worker.
+
+        Blocks while the worker already holds `SHARD_WINDOWS_IN_FLIGHT`
+        windows.
+
+        Args:
+            window (list[QueuedMessage]): Messages of this shard's patients,
+                                          in arrival order.
+
+        Returns:
+            bool: False if the program is stopping and the window was not
+                  handed over; otherwise, True.
+        """
+        while not self._slots.acquire(timeout=STOP_POLL_INTERVAL):
+            if stop_event.is_set() or not self._collector.is_alive():
+                return False
+        with self._requests_lock:
+            self._in_flight.append(window)
+            self._requests.send([queued.segments for queued in window])
+        return True
+
+    def swap_model(self, model) -> None:
+        """Sends the worker a new model, used from the next window on."""
+        with self._requests_lock:
+            try:
+                self._requests.send(model)
+            except OSError:
+                pass  # Closed: the worker is stopping.
+
+    def close(self) -> None:
+        """Lets the worker finish the windows it holds, then stops it."""
+        self._requests.close()
+        if self._started:
+            self._collector.join()
+        self.process.join(timeout=10)
+        if self.process.is_alive():
+            self.process.terminate()
+        self._results.close()
+
+    def _collect(self) -> None:
+        """Pages and releases each window once its results come back."""
+        while True:
+            try:
+                results, metrics = self._results.recv()
+            except EOFError:
+                break
+            window = self._in_flight.popleft()
+            try:
+                PROCESSING_METRICS.merge(metrics)
+                for mrn in results:
+                    if mrn:
+                        self.dispatcher.submit(mrn)
+            finally:
+                for queued in window:
+                    queued.processed.set()
+                self._slots.release()
+        if self._in_flight:
+            # The worker died with messages outstanding; they can no longer
+            # be processed in order, so stop rather than skip them.
+            logging.error(f"Processing shard {self.shard} exited with "
+                          f"{len(self._in_flight)} windows outstanding")
+            stop_event.set()
+
+# Pages not yet delivered, kept in the patient database so that they are
+# retried after a restart.
+PENDING_PAGES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS pending_pages (
+    mrn TEXT PRIMARY KEY,
+    queued_at REAL NOT NULL
+)
+"""
+
+
+# Rows of a CSV input, or messages of an MLLP input, scored together by the
+# `batch` command.
+BATCH_CHUNK_SIZE = 10_000
+
+
+class BatchScores:
+    """Confusion counts of batch predictions against their labels.
+
+    Methods:
+        update: Counts a chunk of predictions and labels.
+        precision: Share of positive predictions that are correct.
+        recall: Share of positive labels that are predicted.
+        f_score: Weighted harmonic mean of precision and recall.
+    """
+
+    __slots__ = ("true_positives", "false_positives", "false_negatives",
+                 "true_negatives")
+
+    def __init__(self):
+        self.true_positives = self.false_positives = 0
+        self.false_negatives = self.true_negatives = 0
+
+    def update(self, predictions: np.ndarray, labels: np.ndarray) -> None:
+        """Counts boolean predictions against boolean labels."""
+        self.true_positives += int(np.sum(predictions & labels))
+        self.false_positives += int(np.sum(predictions & ~labels))
+        self.false_negatives += int(np.sum(~predictions & labels))
+        self.true_negatives += int(np.sum(~predictions & ~labels))
+
+    def precision(self) -> float:
+        """Returns the share of positive predictions that are correct."""
+        predicted = self.true_positives + self.false_positives
+        return self.true_positives / predicted if predicted else 0.0
+
+    def recall(self) -> float:
+        """Returns the share of positive labels that are predicted."""
+        actual = self.true_positives + self.false_negatives
+        return self.true_positives / actual if actual else 0.0
+
+    def f_score(self, beta: float = 3.0) -> float:
+        """Returns the F-beta score, F3 by default as for the model."""
+        precision, recall = self.precision(), self.recall()
+        if not precision and not recall:
+            return 0.0
+        return (1 + beta ** 2) * precision * recall \
+            / (beta ** 2 * precision + recall)
+
+
+def read_csv_chunks(path: str, chunk_size: int = BATCH_CHUNK_SIZE):
+    """Yields the rows of a CSV file after its header, `chunk_size` at a time.
+
+    Rows may be longer than the header, so the file is read with `csv`
+    rather than pandas.
+    """
+    with open(path, 'r', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        while True:
+            rows = list(itertools.islice(reader, chunk_size))
+            if not rows:
+                return
+            yield rows
+
+
+def csv_chunk_features(rows: list[list[str]]) -> tuple:
+    """Builds the model features and baselines of test_f3.csv-style rows.
+
+    Each row holds the age, the sex ('m' or 'f'), then alternating
+    creatinine dates and results, oldest first.
+
+    Args:
+        rows (list[list[str]]): The rows, as read by `read_csv_chunks`.
+
+    Returns:
+        tuple: The (rows, 7) model features, then the latest results and
+               their 7-day minimum and 365-day median baselines.
+    """
+    rows = [[value for value in row if value != ''] for row in rows]
+    width = max((len(row) - 2) // 2 for row in rows)
+    dates = np.full((len(rows), width), 'NaT', dtype=object)
+    results = np.full((len(rows), width), 'nan', dtype=object)
+    for i, row in enumerate(rows):
+        count = (len(row) - 2) // 2
+        dates[i, :count] = row[2:2 + 2 * count:2]
+        results[i, :count] = row[3:3 + 2 * count:2]
+    values = results.astype(np.float64)
+    dates = dates.astype('datetime64[s]')
+    taken_at = np.where(
+        np.isnat(dates), np.nan,
+        (dates - np.datetime64(RESULT_TIME_EPOCH, 's')).astype(np.float64))
+
+    demographics = np.array(
+        [(row[0], 0 if row[1].lower() == 'm' else 1) for row in rows],
+        dtype=np.float64)
+    features = np.hstack([demographics,
+                          latest_results(values, NUMBER_OF_TEST_RESULTS)])
+    return (features, *series_baselines(taken_at, values))
@@ -1,871 +1,359 @@
+"""AKI detection service: receives HL7 messages over MLLP and pages AKI.
+
+The entry point and the default threads engine. The rest of the system is
+in `prediction_core` (patient state, scoring and message processing),
+`pager`, `ingest_log`, `async_engine` and `batch_scoring`.
+"""
+
 import os
 import socket
 import time
+import asyncio
+import multiprocessing
 import signal
-import urllib.error
-import urllib.request
 import threading
-import csv
-import statistics
-from datetime import datetime
-import pickle
+import queue
+import contextlib
 import warnings
 import argparse
 import sqlite3
-import numpy as np
 import logging
-from prometheus_client import start_http_server, Gauge
-import json
-
-
-# SIGTERM handling
-def sigterm_handler(signum, frame):
-    print("SIGTERM received, signaling threads to stop...")
-    stop_event.set()
-
-
-signal.signal(signal.SIGTERM, sigterm_handler)
-
-# Configure logging.
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-
-# Global event to signal threads when to exit, used for graceful shutdown.
-stop_event = threading.Event()
-
-# ACK messages formatted for HL7 protocol responses.
-ACK = [
-    "MSH|^~\&|||||20240129093837||ACK|||2.5",  # Header
-    "MSA|AA",  # Acknowledgment Success
-]
-
-# Constants defining the MLLP (Minimum Lower Layer Protocol) framing.
-MLLP_START_OF_BLOCK = 0x0b
-MLLP_END_OF_BLOCK = 0x1c
-MLLP_CARRIAGE_RETURN = 0x0d
-
-# Shared state for message processing and acknowledgment signaling.
-global messages, send_ack
-
-# Model for processing messages. Load with appropriate model before use.
-model = None
-
-# Synchronisation lock for managing access to shared resources.
-lock = threading.Lock()
-
-
-# ========================================
-# === PROMETHEUS METRICS SETUP - START ===
-# ========================================
-
-def initialise_or_load_counters(save_path: str = 'state/counter_state.json'):
-    # Initialise gauges with no values
-    global MESSAGES_RECEIVED, MESSAGES_PROCESSED, MESSAGES_ACKNOWLEDGED, \
-        TOTAL_BLOOD_TEST_RESULTS_RECEIVED, NORMAL_BLOOD_TEST_RESULTS_RECEIVED, \
-        AKI_BLOOD_TEST_RESULTS_RECEIVED, POSITIVE_AKI_PREDICTIONS
-    global UNSUCCESSFUL_PAGER_REQUESTS, MLLP_SOCKET_CONNECTIONS, \
-        POSITIVE_PREDICTION_RATE
-    global TOTAL_BLOOD_TEST_RESULT_MEAN, TOTAL_BLOOD_TEST_RESULT_STDDEV, \
-        NORMAL_BLOOD_TEST_RESULT_MEAN, NORMAL_BLOOD_TEST_RESULT_STDDEV, \
-        AKI_BLOOD_TEST_RESULT_MEAN, AKI_BLOOD_TEST_RESULT_STDDEV
-    global NON_CREATININE_LIMS_MESSAGES_RECEIVED, \
-        INVALID_CREATININE_LIMS_MESSAGES_RECEIVED, NEW_PATIENTS, \
-        LIMS_RECEIVED_BEFORE_PAS, PENDING_PREDICTIONS, LIMS_MESSAGES_PROCESSED, \
-        PAS_MESSAGES_PROCESSED, INVALID_MRN_RECEIVED, INVALID_DOB_RECEIVED, \
-        INVALID_SEX_RECEIVED, NON_RELEVANT_MESSAGES_PROCESSED
-
-    MESSAGES_RECEIVED = \
-        Gauge('messages_received',
-              'Number of messages received')
-    MESSAGES_ACKNOWLEDGED = \
-        Gauge('messages_acknowledged',
-              'Number of messages acknowledged')
-    MESSAGES_PROCESSED = \
-        Gauge('messages_processed',
-              'Number of messages processed')
-    INVALID_MRN_RECEIVED = \
-        Gauge('invalid_mrn_received',
-              'Number of invalid MRN received')
-    LIMS_MESSAGES_PROCESSED = \
-        Gauge('lims_messages_processed',
-              'Total number of LIMS messages processed')
-    PAS_MESSAGES_PROCESSED = \
-        Gauge('pas_messages_processed',
-              'Total number of PAS messages processed')
-    NON_RELEVANT_MESSAGES_PROCESSED = \
-        Gauge('non_relevant_messages_processed',
-              'Total number of non-relevant messages processed')
-    NEW_PATIENTS = \
-        Gauge('new_patients',
-              'Number of new patients')
-    LIMS_RECEIVED_BEFORE_PAS = \
-        Gauge('lims_received_before_pas',
-              'Number of LIMS messages received before PAS messages')
-    PENDING_PREDICTIONS = \
-        Gauge('pending_predictions',
-              'Number of pending predictions')
-    NON_CREATININE_LIMS_MESSAGES_RECEIVED = \
-        Gauge('non_creatinine_lims_messages_received',
-              'Number of non-creatinine LIMS messages received')
-    INVALID_CREATININE_LIMS_MESSAGES_RECEIVED = \
-        Gauge('invalid_creatinine_lims_messages_received',
-              'Number of invalid creatinine LIMS messages received')
-    INVALID_DOB_RECEIVED = \
-        Gauge('invalid_dob_received',
-              'Number of invalid DOB received')
-    INVALID_SEX_RECEIVED = \
-        Gauge('invalid_sex_received',
-              'Number of invalid sex information received')
-    TOTAL_BLOOD_TEST_RESULTS_RECEIVED = \
-        Gauge('total_blood_test_results_received',
-              'Total number of blood test results received')
-    TOTAL_BLOOD_TEST_RESULT_MEAN = \
-        Gauge('total_blood_test_result_mean',
-              'Mean of all blood test results')
-    TOTAL_BLOOD_TEST_RESULT_STDDEV = \
-        Gauge('total_blood_test_result_stddev',
-              'Standard deviation of all blood test results')
-    NORMAL_BLOOD_TEST_RESULTS_RECEIVED = \
-        Gauge('normal_blood_test_results_received',
-              'Number of norma blood test results received')
-    NORMAL_BLOOD_TEST_RESULT_MEAN = \
-        Gauge('normal_blood_test_result_mean',
-              'Mean of normal blood test results')
-    NORMAL_BLOOD_TEST_RESULT_STDDEV = \
-        Gauge('normal_blood_test_result_stddev',
-              'Standard deviation of normal blood test results')
-    AKI_BLOOD_TEST_RESULTS_RECEIVED = \
-        Gauge('aki_blood_test_results_received',
-              'Number of AKI blood test results received')
-    AKI_BLOOD_TEST_RESULT_MEAN = \
-        Gauge('aki_blood_test_result_mean',
-              'Mean of AKI blood test results')
-    AKI_BLOOD_TEST_RESULT_STDDEV = \
-        Gauge('aki_blood_test_result_stddev',
-              'Standard deviation of AKI blood test results')
-    POSITIVE_AKI_PREDICTIONS = \
-        Gauge('positive_aki_predictions',
-              'Number of positive AKI predictions')
-    POSITIVE_PREDICTION_RATE = \
-        Gauge('positive_prediction_rate',
-              'Rate of positive AKI predictions')
-    UNSUCCESSFUL_PAGER_REQUESTS = \
-        Gauge('unsuccessful_pager_requests',
-              'Number of unsuccessful pager HTTP requests')
-    MLLP_SOCKET_CONNECTIONS = \
-        Gauge('mllp_socket_connections',
-              'Number of connections to the MLLP socket')
-
-    try:  # Load saved counter states
-        with open(save_path, 'r') as f:
-            counter_state = json.load(f)
-
-        print("Counter state file found, loading counters from file.")
-
-        MESSAGES_RECEIVED.set(
-            counter_state.get('messages_received', 0))
-        MESSAGES_ACKNOWLEDGED.set(
-            counter_state.get('messages_acknowledged', 0))
-        MESSAGES_PROCESSED.set(
-            counter_state.get('messages_processed', 0))
-        NON_CREATININE_LIMS_MESSAGES_RECEIVED.set(
-            counter_state.get('non_creatinine_lims_messages_received', 0))
-        INVALID_CREATININE_LIMS_MESSAGES_RECEIVED.set(
-            counter_state.get('invalid_creatinine_lims_messages_received', 0))
-        NEW_PATIENTS.set(
-            counter_state.get('new_patients', 0))
-        LIMS_RECEIVED_BEFORE_PAS.set(
-            counter_state.get('lims_received_before_pas', 0))
-        PENDING_PREDICTIONS.set(
-            counter_state.get('pending_predictions', 0))
-        LIMS_MESSAGES_PROCESSED.set(
-            counter_state.get('lims_messages_processed', 0))
-        PAS_MESSAGES_PROCESSED.set(
-            counter_state.get('pas_messages_processed', 0))
-        NON_RELEVANT_MESSAGES_PROCESSED.set(
-            counter_state.get('non_relevant_messages_processed', 0))
-        INVALID_MRN_RECEIVED.set(
-            counter_state.get('invalid_mrn_received', 0))
-        INVALID_DOB_RECEIVED.set(
-            counter_state.get('invalid_dob_received', 0))
-        INVALID_SEX_RECEIVED.set(
-            counter_state.get('invalid_sex_received', 0))
-        TOTAL_BLOOD_TEST_RESULTS_RECEIVED.set(
-            counter_state.get('total_blood_test_results_received', 0))
-        TOTAL_BLOOD_TEST_RESULT_MEAN.set(
-            counter_state.get('total_blood_test_result_mean', 0))
-        TOTAL_BLOOD_TEST_RESULT_STDDEV.set(
-            counter_state.get('total_blood_test_result_stddev', 0))
-        NORMAL_BLOOD_TEST_RESULTS_RECEIVED.set(
-            counter_state.get('normal_blood_test_results_received', 0))
-        NORMAL_BLOOD_TEST_RESULT_MEAN.set(
-            counter_state.get('normal_blood_test_result_mean', 0))
-        NORMAL_BLOOD_TEST_RESULT_STDDEV.set(
-            counter_state.get('normal_blood_test_result_stddev', 0))
-        AKI_BLOOD_TEST_RESULTS_RECEIVED.set(
-            counter_state.get('aki_blood_test_results_received', 0))
-        AKI_BLOOD_TEST_RESULT_MEAN.set(
-            counter_state.get('aki_blood_test_result_mean', 0))
-        AKI_BLOOD_TEST_RESULT_STDDEV.set(
-            counter_state.get('aki_blood_test_result_stddev', 0))
-        POSITIVE_AKI_PREDICTIONS.set(
-            counter_state.get('positive_aki_predictions', 0))
-        UNSUCCESSFUL_PAGER_REQUESTS.set(
-            counter_state.get('unsuccessful_pager_requests', 0))
-        MLLP_SOCKET_CONNECTIONS.set(
-            counter_state.get('mllp_socket_connections', 0))
-
-        # Calculate and set positive prediction rate based on the loaded values
-        if MESSAGES_PROCESSED._value.get() > 0:  # Avoid division by zero
-            rate = POSITIVE_AKI_PREDICTIONS._value.get() \
-                   / MESSAGES_PROCESSED._value.get()
-            POSITIVE_PREDICTION_RATE.set(rate)
-            print("positive prediction rate set to: ", rate)
-
-    except FileNotFoundError:
-        # Create new counters if the state file doesn't exist
-        print("No counter state file found, initialising counters at zero.")
-
-
-def update_total_blood_test_result_mean(new_result):
-    old_mean = TOTAL_BLOOD_TEST_RESULT_MEAN._value.get()
-    number_of_results = TOTAL_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    TOTAL_BLOOD_TEST_RESULT_MEAN.set(new_mean)
-
-
-def update_total_blood_test_result_stddev(new_result):
-    old_mean = TOTAL_BLOOD_TEST_RESULT_MEAN._value.get()
-    old_stddev = TOTAL_BLOOD_TEST_RESULT_STDDEV._value.get()
-    number_of_results = TOTAL_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    new_stddev = np.sqrt(((old_stddev ** 2 * (number_of_results - 1)) +
-                          (new_result - new_mean) ** 2) / number_of_results)
-    TOTAL_BLOOD_TEST_RESULT_STDDEV.set(new_stddev)
-
-
-def update_normal_blood_test_result_mean(new_result):
-    old_mean = NORMAL_BLOOD_TEST_RESULT_MEAN._value.get()
-    number_of_results = NORMAL_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    NORMAL_BLOOD_TEST_RESULT_MEAN.set(new_mean)
-
-
-def update_normal_blood_test_result_stddev(new_result):
-    old_mean = NORMAL_BLOOD_TEST_RESULT_MEAN._value.get()
-    old_stddev = NORMAL_BLOOD_TEST_RESULT_STDDEV._value.get()
-    number_of_results = NORMAL_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    new_stddev = np.sqrt(((old_stddev ** 2 * (number_of_results - 1)) +
-                          (new_result - new_mean) ** 2) / number_of_results)
-    NORMAL_BLOOD_TEST_RESULT_STDDEV.set(new_stddev)
-
-
-def update_aki_blood_test_result_mean(new_result):
-    old_mean = AKI_BLOOD_TEST_RESULT_MEAN._value.get()
-    number_of_results = AKI_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    AKI_BLOOD_TEST_RESULT_MEAN.set(new_mean)
-
-
-def update_aki_blood_test_result_stddev(new_result):
-    old_mean = AKI_BLOOD_TEST_RESULT_MEAN._value.get()
-    old_stddev = AKI_BLOOD_TEST_RESULT_STDDEV._value.get()
-    number_of_results = AKI_BLOOD_TEST_RESULTS_RECEIVED._value.get()
-    new_mean = ((old_mean * (number_of_results - 1)) + new_result) \
-               / number_of_results
-    new_stddev = np.sqrt(((old_stddev ** 2 * (number_of_results - 1)) +
-                          (new_result - new_mean) ** 2) / number_of_results)
-    AKI_BLOOD_TEST_RESULT_STDDEV.set(new_stddev)
-
-
-# Global gauge for positive prediction rate
-def update_positive_prediction_rate():
-    global TOTAL_BLOOD_TEST_RESULTS_RECEIVED, POSITIVE_AKI_PREDICTIONS, \
-        POSITIVE_PREDICTION_RATE
-    current_rate = POSITIVE_AKI_PREDICTIONS._value.get() \
-                   / TOTAL_BLOOD_TEST_RESULTS_RECEIVED._value.get() \
-        if TOTAL_BLOOD_TEST_RESULTS_RECEIVED._value.get() > 0 else 0
-    POSITIVE_PREDICTION_RATE.set(current_rate)
-
-
-# Define save counter states to a file function
-def save_counters(save_path: str = 'state/counter_state.json'):
-    """Saves the current state of all Prometheus gauges to a JSON file.
-    """
-    counter_state = {
-        'messages_received':
-            MESSAGES_RECEIVED._value.get(),
-        'messages_acknowledged':
-            MESSAGES_ACKNOWLEDGED._value.get(),
-        'messages_processed':
-            MESSAGES_PROCESSED._value.get(),
-        'non_creatinine_lims_messages_received':
-            NON_CREATININE_LIMS_MESSAGES_RECEIVED._value.get(),
-        'invalid_creatinine_lims_messages_received':
-            INVALID_CREATININE_LIMS_MESSAGES_RECEIVED._value.get(),
-        'new_patients':
-            NEW_PATIENTS._value.get(),
-        'lims_received_before_pas':
-            LIMS_RECEIVED_BEFORE_PAS._value.get(),
-        'pending_predictions':
-            PENDING_PREDICTIONS._value.get(),
-        'lims_messages_processed':
-            LIMS_MESSAGES_PROCESSED._value.get(),
-        'pas_messages_processed':
-            PAS_MESSAGES_PROCESSED._value.get(),
-        'non_relevant_messages_processed':
-            NON_RELEVANT_MESSAGES_PROCESSED._value.get(),
-        'invalid_mrn_received':
-            INVALID_MRN_RECEIVED._value.get(),
-        'invalid_sex_received':
-            INVALID_SEX_RECEIVED._value.get(),
-        'invalid_dob_received':
-            INVALID_DOB_RECEIVED._value.get(),
-        'total_blood_test_results_received':
-            TOTAL_BLOOD_TEST_RESULTS_RECEIVED._value.get(),
-        'total_blood_test_result_mean':
-            TOTAL_BLOOD_TEST_RESULT_MEAN._value.get(),
-        'total_blood_test_result_stddev':
-            TOTAL_BLOOD_TEST_RESULT_STDDEV._value.get(),
-        'normal_blood_test_results_received':
-            NORMAL_BLOOD_TEST_RESULTS_RECEIVED._value.get(),
-        'normal_blood_test_result_mean':
-            NORMAL_BLOOD_TEST_RESULT_MEAN._value.get(),
-        'normal_blood_test_result_stddev':
-            NORMAL_BLOOD_TEST_RESULT_STDDEV._value.get(),
-        'aki_blood_test_results_received':
-            AKI_BLOOD_TEST_RESULTS_RECEIVED._value.get(),
-        'aki_blood_test_result_mean':
-            AKI_BLOOD_TEST_RESULT_MEAN._value.get(),
-        'aki_blood_test_result_stddev':
-            AKI_BLOOD_TEST_RESULT_STDDEV._value.get(),
-        'positive_aki_predictions':
-            POSITIVE_AKI_PREDICTIONS._value.get(),
-        'unsuccessful_pager_requests':
-            UNSUCCESSFUL_PAGER_REQUESTS._value.get(),
-        'mllp_socket_connections':
-            MLLP_SOCKET_CONNECTIONS._value.get()
-    }
-
-    with open(save_path, 'w') as f:
-        json.dump(counter_state, f)
-
-    print("Counter states saved to 'state/counter_state.json'.")
-
-
-# ======================================
-# === PROMETHEUS METRICS SETUP - END ===
-# ======================================
-
-
-def from_mllp(buffer: bytes) -> list[str]:
-    """Decodes a buffer from MLLP encoding to a list of HL7 message segments.
-
-    MLLP (Minimum Lower Layer Protocol) is used for the transmission of HL7
-    messages over network sockets. This function takes a byte buffer received
-    in MLLP format, including start and end block markers, and decodes it into
-    a list of strings. Each string represents a segment of the decoded HL7
-    message.
+from prometheus_client import start_http_server
+
+import prediction_core
+from prediction_core import (ACK, AKIPredictor, BATCH_CHUNK_SIZE,
+                             COMPILED_MODEL_PATH, ColumnarPatientStore,
+                             CommitError, DECISION_MODES, MESSAGE_QUEUE_SIZE,
+                             METRICS_CHECKPOINT_INTERVAL, MLLPFrameDecoder,
+                             MLLP_RECEIVE_BUFFER_SIZE, MODEL_RELOAD_INTERVAL,
+                             ModelReloader, PATIENT_CACHE_SIZE,
+                             PATIENT_HISTORY_TABLE_SQL, PICKLED_MODEL_PATH,
+                             ProcessingOptions, ProcessingShard, QueuedMessage,
+                             STOP_POLL_INTERVAL, backfill_creatinine_results,
+                             build_history_snapshot,
+                             checkpoint_counters_periodically, export_model,
+                             flush_metrics_periodically,
+                             initialise_or_load_counters, load_model,
+                             load_validation_set, message_shard,
+                             preload_history_to_sqlite, process_window,
+                             save_counters, stop_event, to_mllp)
+from ingest_log import IngestLog
+from pager import PagerDispatcher, parse_pager_address
+from async_engine import run_async_engine
+from batch_scoring import run_batch
+
+# Bounded hand-off between the message receiver threads and the processor.
+message_queue = queue.Queue(maxsize=MESSAGE_QUEUE_SIZE)
+
+
+def wait_unless_stopped(event: threading.Event) -> bool:
+    """Blocks until `event` is set or the global stop event is set.
 
     Args:
-        buffer (bytes): The byte buffer received in MLLP format, including the
-                        start and end block markers and the carriage return.
+        event (threading.Event): The event to wait for.
 
     Returns:
-        list: A list of strings, each representing a segment of the HL7 message.
+        bool: True if `event` was set, False if shutdown was requested first.
     """
-    return str(buffer[1:-3], "ascii").split("\r")
+    while not event.wait(STOP_POLL_INTERVAL):
+        if stop_event.is_set():
+            return False
+    return True
 
 
-def to_mllp(segments: list[str]) -> bytes:
-    """Encodes a list of HL7 message segments into MLLP format for transmission.
+def collect_window(first: QueuedMessage, max_size: int,
+                   max_latency: float) -> list[QueuedMessage]:
+    """Gathers a window of queued messages to be handled together.
 
-    This function takes a list of strings, where each string is a segment of an
-    HL7 message, and encodes it into MLLP format. It adds the start and end
-    block characters as well as a carriage return to conform with the MLLP
-    standard for HL7 message transmission over network sockets.
+    The window starts with `first` and is closed once it holds `max_size`
+    messages or once `max_latency` seconds have passed since it was opened.
+    Messages that are already queued are always taken, up to `max_size`.
 
     Args:
-        segments (list[str]): A list of strings, where each string is a segment
-                              of an HL7 message.
+        first (QueuedMessage): The message that opens the window.
+        max_size (int): Maximum number of messages in the window.
+        max_latency (float): Maximum time to wait for further messages, in
+                             seconds.
 
     Returns:
-        bytes: A byte string encoded in MLLP format, ready for transmission
-               over network sockets.
+        list[QueuedMessage]: The messages in arrival order.
     """
-    m = bytes(chr(MLLP_START_OF_BLOCK), "ascii")
-    m += bytes("\r".join(segments) + "\r", "ascii")
-    m += bytes(chr(MLLP_END_OF_BLOCK) + chr(MLLP_CARRIAGE_RETURN), "ascii")
-    return m
+    window = [first]
+    deadline = time.monotonic() + max_latency
+    while len(window) < max_size:
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining > 0:
+                window.append(message_queue.get(timeout=remaining))
+            else:
+                window.append(message_queue.get_nowait())
+        except queue.Empty:
+            break
+    return window
+
+
+def processor(address: str, model,
+              options: ProcessingOptions | None = None) -> None:
+    """Processes messages, updates database or makes predictions, and hands
+    notifications to a `PagerDispatcher` that sends them in the background.
+
+    Messages are taken from `message_queue`; the thread sleeps while the queue
+    is empty. Each message's `processed` event is set once it has been handled
+    so that the receiver can acknowledge it.
+
+    With batching enabled (`options.batch_size` > 1), a window of messages
+    is applied inside a single database transaction and the predictions it
+    triggers are scored with a single model call. Each result then fans
+    back out to its own message for paging. The messages of a window are only paged and
+    released for acknowledgement once that transaction has been committed,
+    so an ACK still implies the message's writes are durable; a window
+    whose commit fails is processed again (see `process_window`).
+
+    Args:
+        address (str): Address to send notifications to, if necessary.
+        model: Pretrained Machine learning model for predictions.
+        options (ProcessingOptions): Database, paging, batching and patient
+                                     state settings; the defaults if None.
+    """
+    options = options or ProcessingOptions()
+    aki_predictor = AKIPredictor(
+        model, options.db_path, cache_size=options.cache_size,
+        patient_store=options.patient_store,
+        history_snapshot=options.history_snapshot,
+        decision_mode=options.decision_mode,
+        metrics_count_flag=options.metrics_count_flag)
+    if options.model_reloader is not None:
+        options.model_reloader.register(aki_predictor, model)
+    dispatcher = PagerDispatcher(address, options.db_path,
+                                 options.max_retries, options.retry_delay,
+                                 metrics_count_flag=options.metrics_count_flag)
+    dispatcher.start()
+    # Patients in a memory-mapped history snapshot are cheap to read on
+    # demand, so the cache is not warmed up front.
+    if options.patient_store is None and options.history_snapshot is None:
+        print(f"Patient cache warmed with {aki_predictor.warm_cache()} "
+              f"records.")
+    for mrn in aki_predictor.resume_pending_predictions():
+        dispatcher.submit(mrn)
+
+    try:
+        while not stop_event.is_set():
+            try:
+                item = message_queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            window = collect_window(item, options.batch_size,
+                                    options.batch_latency)
+            results = process_window(
+                aki_predictor, [queued.segments for queued in window])
+            if results is None:
+                break  # Stopping: the window is never acknowledged.
+            try:
+                for mrn in results:
+                    if mrn:
+                        dispatcher.submit(mrn)
+            finally:
+                # When the process ends, inform message_receiver to acknowledge.
+                for queued in window:
+                    queued.processed.set()
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        dispatcher.close()
+        aki_predictor.close()
 
 
-def preload_history_to_sqlite(db_path: str = 'state/my_database.db',
-                              pathname: str = 'data/hospital-history/history.csv'):
-    """Loads historical patient data from a CSV file into an SQLite database.
+def sharded_processor(address: str, model, workers: int,
+                      options: ProcessingOptions | None = None) -> None:
+    """Processes messages on `workers` processes, sharded by MRN.
 
-    This function processes a specified CSV file to extract patient identifiers
-    (MRN: Medical Record Number) and up to five most recent creatinine test
-    results. It then inserts the data into an SQLite database.
+    Replaces `processor` when prediction work should use several cores.
+    Windows are taken from `message_queue` as in `processor` and split by
+    `message_shard`, so each patient's messages always go to the same
+    worker and are processed there in arrival order. Workers run
+    concurrently; the receiver still acknowledges in arrival order.
 
-    Args:
-        db_path (str): The file path to the SQLite database. Defaults to
-                       'state/my_database.db'.
-        pathname (str): The file path to the CSV file containing historical
-                        patient data. Defaults to 'data/hospital-history/history.csv'.
+    Each worker keeps its own cache of its patients; they share the SQLite
+    database, and paging stays in this process. Workers do not update the
+    Prometheus metrics themselves: they send their processing metrics back
+    with each window's results, and this process merges them into
+    PROCESSING_METRICS.
 
-    Returns:
-        None: This function does not return a value but inserts data into the
-              SQLite database.
-
-    Note:
-        - This function assumes the CSV file has a specific format, with the
-          MRN as the first column, and creatinine test dates and results.
-        - The SQLite database is structured to hold patient records with
-          columns for MRN, age, sex, and the five most recent creatinine test
-          results. It ensures each patient's record is unique with MRN serving
-          as the primary key (index).
-    """
-    # Connect to the SQLite database.
-    with sqlite3.connect(db_path) as conn:
-        c = conn.cursor()
-
-        # Create the table if it doesn't exist.
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS patient_history (
-                mrn TEXT PRIMARY KEY,
-                age INTEGER,
-                sex INTEGER,
-                test_1 REAL,
-                test_2 REAL,
-                test_3 REAL,
-                test_4 REAL,
-                test_5 REAL
-            )
-        ''')
-
-        with open(pathname, 'r') as file:
-            csv_reader = csv.reader(file)
-            next(csv_reader)  # Skip the header row.
-
-            for row in csv_reader:
-                cleaned_row = [value for value in row if value != '']
-                mrn = cleaned_row[0]
-                age = None
-                sex = None
-                test_results = list(map(float, cleaned_row[2::2]))
-                test_results.reverse()  # Get tests from most to least recent.
-
-                required_number_of_tests = 5
-
-                # Ensure exactly 5 test results per patient.
-                if len(test_results) < required_number_of_tests:
-                    average_result = statistics.mean(test_results) \
-                        if test_results else 0
-                    test_results += [average_result] * (required_number_of_tests
-                                                        - len(test_results))
-
-                test_results = test_results[:required_number_of_tests]
-
-                # Insert data into the database.
-                c.execute('''
-                    INSERT INTO patient_history (
-                        mrn, age, sex, test_1, test_2, test_3, test_4, test_5
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    ON CONFLICT(mrn) DO UPDATE SET
-                    age=excluded.age,
-                    sex=excluded.sex,
-                    test_1=excluded.test_1,
-                    test_2=excluded.test_2,
-                    test_3=excluded.test_3,
-                    test_4=excluded.test_4,
-                    test_5=excluded.test_5
-                ''', (mrn, age, sex, *test_results))
-
-    # Connection is automatically committed & closed when exiting 'with' block.
-    print("Data preloaded into SQLite database successfully.")
-
-
-class AKIPredictor:
-    """Class for processing HL7 messages to update patient data and predict AKI.
-
-    Constructor Attributes:
-        db_path (str): Path to the SQLite database.
-                       Defaults to 'state/my_database.db'.
-        model: Machine learning model for AKI prediction.
-        metrics_count_flag (bool): Flag to enable or disable Prometheus metrics
-                                   counting. Useful for disabling metrics
-                                   updates during unit testing to prevent side
-                                   effects. Defaults to True, enabling metrics
-                                   counting.
-        pending_predictions (set): Set of MRNs pending AKI prediction.
-                                   Specifically for cases where LIMS test
-                                   results messages have been received before
-                                   their corresponding PAS admission messages.
-
-    Methods:
-        process_lims_message: Processes lab results from LIMS messages.
-        process_pas_message: Processes patient admission data from PAS messages.
-        _calculate_age: Calculates age from date of birth.
-        _is_valid_dob: Validates the format of the date of birth.
-        attempt_aki_prediction: Attempts to predict AKI based on patient data.
-        examine_message_and_predict_aki: Main method to process HL7 messages.
+    Args:
+        address (str): Address to send notifications to, if necessary.
+        model: Pretrained Machine learning model, copied to every worker.
+        workers (int): Number of worker processes.
+        options (ProcessingOptions): Database, paging, batching and patient
+                                     state settings; the defaults if None.
+                                     Its `model_reloader` sends new models
+                                     to the workers.
     """
+    options = options or ProcessingOptions()
+    dispatcher = PagerDispatcher(address, options.db_path,
+                                 options.max_retries, options.retry_delay,
+                                 metrics_count_flag=options.metrics_count_flag,
+                                 writers=workers + 1)
+    dispatcher.start()
+    # Threads are already running, so the workers must not be forked.
+    context = multiprocessing.get_context("spawn")
+    shards = [ProcessingShard(context, shard, workers, model, dispatcher,
+                              options.db_path, options.cache_size,
+                              options.history_snapshot, options.decision_mode)
+              for shard in range(workers)]
 
-    def __init__(self, model, db_path: str = 'state/my_database.db',
-                 metrics_count_flag=True):
-        self.db_path = db_path
-        self.model = model
-        self.metrics_count_flag = metrics_count_flag
-        self.pending_predictions = set()
-
-    def process_lims_message(self, cursor, mrn: str, message: list[str],
-                             msg_identifier: str) -> str | None:
-        """Processes a LIMS (Laboratory Information Management System) message.
-
-        The LIMS message contains lab test results; we are interested in
-        creatinine blood test results -- message type "ORU^R01".
-        The function updates the patient's test results in the database, and
-        attempts an AKI prediction if possible.
-
-        Args:
-            cursor: SQLite database cursor.
-            mrn (str): Medical Record Number of the patient.
-            message (list[str]): HL7 message segments.
-            msg_identifier (str): Identifier for logging purposes.
-
-        Returns:
-            Optional[str]: The MRN of a patient if an AKI prediction is
-                           positive; otherwise, None.
-        """
-        test_type = message[3].split("|")[3]
-        if test_type != "CREATININE":
-            if self.metrics_count_flag:
-                NON_CREATININE_LIMS_MESSAGES_RECEIVED.inc()
-            logging.error(f"{msg_identifier}\n>> Invalid test type: "
-                          f"{test_type}")
-            return None
-        creatinine_result_str = message[3].split("|")[5]
-        if not creatinine_result_str.replace('.', '', 1).isdigit():
-            if self.metrics_count_flag:
-                INVALID_CREATININE_LIMS_MESSAGES_RECEIVED.inc()
-            logging.error(f"{msg_identifier}\n>> Invalid test result format: "
-                          f"{creatinine_result_str}")
-            return None
-
-        creatinine_result = float(creatinine_result_str)
-        if self.metrics_count_flag:
-            TOTAL_BLOOD_TEST_RESULTS_RECEIVED.inc()
-            update_total_blood_test_result_mean(creatinine_result)
-            update_total_blood_test_result_stddev(creatinine_result)
-            update_positive_prediction_rate()
-
-        # Check if MRN exists in the database
-        cursor.execute("SELECT 1 FROM patient_history WHERE mrn = ?", (mrn,))
-        exists = cursor.fetchone()
-        if not exists:  # occurs if LIMS received before PAS for a specific MRN
-            if self.metrics_count_flag:
-                NEW_PATIENTS.inc()
-                LIMS_RECEIVED_BEFORE_PAS.inc()
-            cursor.execute("INSERT INTO patient_history (mrn) VALUES (?)",
-                           (mrn,))
-
-        cursor.execute("""SELECT test_1, test_2, test_3, test_4, test_5 
-                          FROM patient_history WHERE mrn = ?""", (mrn,))
-        tests = cursor.fetchone()
-
-        # Determine if any test results are already recorded
-        if any(test is not None for test in tests):
-            # Shift existing results to make room for the new one at 'test_1'.
-            cursor.execute("""UPDATE patient_history 
-                              SET test_5=test_4, test_4=test_3, test_3=test_2, 
-                                  test_2=test_1, test_1=?
-                              WHERE mrn=?""", (creatinine_result, mrn))
-        else:
-            # Initialise all test results with the current test result
-            cursor.execute("""UPDATE patient_history
-                              SET test_1=?, test_2=?, test_3=?, test_4=?, 
-                                  test_5=?
-                              WHERE mrn=?""",
-                           (creatinine_result, creatinine_result,
-                            creatinine_result, creatinine_result,
-                            creatinine_result, mrn))
-
-        self.pending_predictions.add(mrn)
-        if self.metrics_count_flag:
-            PENDING_PREDICTIONS.inc()
-        return self.attempt_aki_prediction(cursor, mrn, msg_identifier)
-
-    def process_pas_message(self, cursor, mrn: str, message: list[str],
-                            msg_identifier: str) -> str | None:
-        """ Processes a PAS (Patient Administration System) message.
-
-        The PAS message contains demographic (age and sex) information; we are
-        interested in admission messages -- message type "ADT^A01".
-        The function updates or inserts the patient's demographic data into the
-        database. It also attempts an AKI prediction in case of pending ones
-        stored for LIMS messages received for a new patient where the
-        corresponding admission PAS message was still not received.
-
-        Args:
-            cursor: SQLite database cursor.
-            mrn (str): Medical Record Number of the patient.
-            message (list[str]): HL7 message segments.
-            msg_identifier (str): Identifier for logging purposes.
-
-        Returns:
-            Optional[str]: The MRN of a patient if an AKI prediction is
-                           positive; otherwise, None.
-        """
-        date_of_birth = message[1].split("|")[7]
-        if not self._is_valid_dob(date_of_birth):
-            if self.metrics_count_flag:
-                INVALID_DOB_RECEIVED.inc()
-            logging.error(f"{msg_identifier}\n>> Invalid DOB format: "
-                          f"{date_of_birth}")
-            return None
-        sex_str = message[1].split("|")[8]
-        if sex_str not in ["F", "M"]:
-            if self.metrics_count_flag:
-                INVALID_SEX_RECEIVED.inc()
-            logging.error(f"{msg_identifier}\n>> Invalid sex value: "
-                          f"{sex_str}")
-            return None
-
-        age = self._calculate_age(date_of_birth)
-        sex = 1 if sex_str == "F" else 0
-
-        # Check if MRN exists in the database
-        cursor.execute("SELECT 1 FROM patient_history WHERE mrn = ?", (mrn,))
-        exists = cursor.fetchone()
-        if not exists and self.metrics_count_flag:
-            NEW_PATIENTS.inc()
-
-        # Update or insert the demographic information
-        cursor.execute("""INSERT INTO patient_history (mrn, age, sex) 
-                          VALUES (?, ?, ?) ON CONFLICT(mrn) DO 
-                          UPDATE SET age=excluded.age, sex=excluded.sex""",
-                       (mrn, age, sex))
-
-        if mrn in self.pending_predictions:
-            return self.attempt_aki_prediction(cursor, mrn, msg_identifier)
-        return None
-
-    @staticmethod
-    def _calculate_age(dob: str) -> int:
-        """Calculates a person's age in years based on their date of birth.
-
-        The age is computed by comparing the current date with the provided
-        date of birth (dob).
-
-        Args:
-            dob (str): The date of birth in "%Y%m%d" format.
-
-        Returns:
-            int: The calculated age in years.
-        """
-        dob_datetime = datetime.strptime(dob, "%Y%m%d")
-        current_datetime = datetime.now()
-
-        age = current_datetime.year - dob_datetime.year - (
-                (current_datetime.month, current_datetime.day) <
-                (dob_datetime.month, dob_datetime.day))
-
-        return age
-
-    @staticmethod
-    def _is_valid_dob(dob: str) -> bool:
-        """Check if the date of birth is in the correct format "%Y%m%d".
-
-        Args:
-            dob (str): The date of birth.
-
-        Returns:
-            bool: True if dob is in the "%Y%m%d" format, False otherwise.
-        """
-        try:
-            datetime.strptime(dob, "%Y%m%d")
-            return True
-        except ValueError:
-            return False
+    try:
+        if not all([shard.wait_started() for shard in shards]):
+            raise RuntimeError("a processing shard failed to start")
+        print(f"Started {workers} processing shards.")
+        if options.model_reloader is not None:
+            for shard in shards:
+                options.model_reloader.register(shard, model)
+        while not stop_event.is_set():
+            try:
+                item = message_queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+
+            window = collect_window(item, options.batch_size,
+                                    options.batch_latency)
+            parts = [[] for _ in shards]
+            for queued in window:
+                parts[message_shard(queued.segments, workers)].append(queued)
+            for shard, part in zip(shards, parts):
+                if part and not shard.submit(part):
+                    # Stopping; messages not handed over are never ACKed.
+                    break
+
+    except Exception as e:
+        print(f"An error occurred: {e}")
+    finally:
+        for shard in shards:
+            shard.close()
+        dispatcher.close()
 
-    def attempt_aki_prediction(self, cursor, mrn: str,
-                               msg_identifier: str) -> str | None:
-        """
-        Attempts to predict AKI based on available patient data.
-
-        Args:
-            cursor: SQLite database cursor.
-            mrn (str): Medical Record Number of the patient.
-            msg_identifier (str): Identifier for logging purposes.
-
-        Returns:
-            Optional[str]: The MRN of a patient if an AKI prediction is
-                           positive; otherwise, None.
-        """
-        cursor.execute("SELECT age, sex, test_1, test_2, test_3, test_4, test_5 "
-                       "FROM patient_history WHERE mrn=?", (mrn,))
-        patient_data = cursor.fetchone()
-        last_result = patient_data[2]
-
-        # Ensure age and sex are not None (occurs if LIMS received before PAS)
-        if patient_data and not any(val is None for val in patient_data[:2]):
-            features = np.array(patient_data).reshape(1, -1)
-            aki = self.model.predict(features)
-            self.pending_predictions.remove(mrn)
-            if self.metrics_count_flag:
-                PENDING_PREDICTIONS.dec()
-            if aki:
-                logging.info(f"{msg_identifier}\n>> AKI predicted for "
-                             f"MRN: {mrn}")
-                if self.metrics_count_flag:
-                    POSITIVE_AKI_PREDICTIONS.inc()
-                    AKI_BLOOD_TEST_RESULTS_RECEIVED.inc()
-                    update_aki_blood_test_result_mean(last_result)
-                    update_aki_blood_test_result_stddev(last_result)
-                    update_positive_prediction_rate()
-                return mrn
-            if self.metrics_count_flag:
-                NORMAL_BLOOD_TEST_RESULTS_RECEIVED.inc()
-                update_normal_blood_test_result_mean(last_result)
-                update_normal_blood_test_result_stddev(last_result)
-        return None
-
-    def examine_message_and_predict_aki(self, message: list[str]) -> str | None:
-        """Examines an HL7 message for patient data updates or AKI prediction.
-
-        This function handles HL7 messages, updating the patient database with
-        demographic information from ADT^A01 (PAS Admission) messages, or
-        creatinine test results from ORU^R01 (LIMS) messages.
-        For creatinine updates, it may trigger a prediction for acute kidney
-        injury (AKI) using the provided pretrained machine learning model.
-
-        Args:
-            message (list[str]): The HL7 message split into string segments.
-
-        Returns:
-            Optional[str]: The MRN of a patient if an AKI prediction is
-                           positive; otherwise, None.
-        """
-        try:
-            with sqlite3.connect(self.db_path) as conn:
-                c = conn.cursor()
-
-                if self.metrics_count_flag:
-                    MESSAGES_PROCESSED.inc()
-
-                message_type = message[0].split("|")[8]
-                mrn = message[1].split("|")[3]
-                timestamp = message[0].split("|")[6]
-                msg_identifier = f"\n[MRN: {mrn} " \
-                                 f"\nmessage_type <{message_type}>" \
-                                 f"\ntimestamp: {timestamp}]"
-                if not mrn.isdigit():
-                    if self.metrics_count_flag:
-                        INVALID_MRN_RECEIVED.inc()
-                    logging.error(f"{msg_identifier}\n>> "
-                                  f"Invalid MRN format: {mrn}")
-                    return None
-
-                if message_type == "ORU^R01":
-                    if self.metrics_count_flag:
-                        LIMS_MESSAGES_PROCESSED.inc()
-                    result = self.process_lims_message(c, mrn, message,
-                                                       msg_identifier)
-                elif message_type == "ADT^A01":
-                    if self.metrics_count_flag:
-                        PAS_MESSAGES_PROCESSED.inc()
-                    result = self.process_pas_message(c, mrn, message,
-                                                      msg_identifier)
-                else:
-                    if self.metrics_count_flag:
-                        NON_RELEVANT_MESSAGES_PROCESSED.inc()
-                    result = None
-
-                conn.commit()
-                return result
-
-        except IndexError as e:
-            logging.error(f"Error processing message due to invalid message "
-                          f"format: {e}")
-        except sqlite3.Error as e:
-            logging.error(f"Database error: {e}")
-        except Exception as e:
-            logging.error(f"An unexpected error occurred: {e}")
-        finally:
-            if conn:
-                conn.close()
-        return None
 
+def log_processor(address: str, model, ingest_log: IngestLog,
+                  options: ProcessingOptions | None = None) -> None:
+    """Processes messages drained from an `IngestLog`.
 
-def processor(address: str, model, db_path: str = 'state/my_database.db',
-              max_retries: int = 15, retry_delay: float = 1.0) -> None:
-    """Processes messages, updates database or makes predictions, and sends
-    notifications with retry logic for paging failures.
+    Replaces `processor` when messages are acknowledged as soon as they are
+    logged. Windows of records are read from the last processed position
+    and applied like in `processor`; the position following a window is
+    saved in the same transaction as the window's writes, so after a crash
+    every logged message is processed exactly once. The window's pages are
+    stored in that transaction too, so none is lost between the commit and
+    their hand-over to the dispatcher, which resumes them on restart.
 
     Args:
         address (str): Address to send notifications to, if necessary.
         model: Pretrained Machine learning model for predictions.
-        db_path (str): Path to the SQLite database.
-        max_retries (int): Maximum number of retry attempts for paging.
-        retry_delay (float): Delay between retry attempts in seconds.
+        ingest_log (IngestLog): The log the receivers append to.
+        options (ProcessingOptions): Database, paging, batching and patient
+                                     state settings; the defaults if None.
     """
-    global messages, send_ack
-    # Flag variables.
-    run_code = False
-    message = None
-
-    aki_predictor = AKIPredictor(model, db_path)
+    options = options or ProcessingOptions()
+    aki_predictor = AKIPredictor(
+        model, options.db_path, cache_size=options.cache_size,
+        history_snapshot=options.history_snapshot,
+        decision_mode=options.decision_mode,
+        metrics_count_flag=options.metrics_count_flag)
+    if options.model_reloader is not None:
+        options.model_reloader.register(aki_predictor, model)
+    dispatcher = PagerDispatcher(address, options.db_path,
+                                 options.max_retries, options.retry_delay,
+                                 metrics_count_flag=options.metrics_count_flag)
+    dispatcher.start()
+    if options.history_snapshot is None:
+        print(f"Patient cache warmed with {aki_predictor.warm_cache()} "
+              f"records.")
+    for mrn in aki_predictor.resume_pending_predictions():
+        dispatcher.submit(mrn)
+    position = max(aki_predictor.load_ingest_position() or (0, 0),
+                   ingest_log.start())
+    print(f"Processing the ingest log from segment {position[0]}, "
+          f"offset {position[1]}.")
 
     try:
         while not stop_event.is_set():
-            with lock:
-                if len(messages) > 0:
-                    message = messages.pop(0)
-                    run_code = True
-
-            if run_code:
-                mrn = aki_predictor.examine_message_and_predict_aki(message)
-                if mrn:
-                    for attempt in range(max_retries):
-                        try:
-                            r = urllib.request.urlopen(f"http://{address}/page",
-                                                       data=mrn.encode('utf-8'))
-                            if r.status == 200:
-                                # Successful paging, break out of the retry loop
-                                break
-                        except urllib.error.URLError as e:
-                            print(f"Paging failed on attempt {attempt + 1}: {e}")
-                        if attempt < max_retries - 1:
-                            # Wait before retrying, unless it's the last attempt
-                            time.sleep(retry_delay)
-                        else:
-                            # Final attempt failed
-                            UNSUCCESSFUL_PAGER_REQUESTS.inc()
-
-                # When the process ends, inform message_receiver to acknowledge.
-                with lock:
-                    send_ack = True
-                    # MESSAGES_PROCESSED.inc()
-                run_code = False
+            records = ingest_log.read(position, options.batch_size,
+                                      STOP_POLL_INTERVAL,
+                                      options.batch_latency)
+            if not records:
+                continue
+            try:
+                results = aki_predictor.examine_messages_and_predict_aki(
+                    [segments for segments, _ in records], commit=False)
+            except CommitError as e:
+                logging.error(f"Processing the window again: {e}")
+                time.sleep(STOP_POLL_INTERVAL)
+                continue
+            mrns = [mrn for mrn in results if mrn]
+            aki_predictor.record_ingest_position(records[-1][1])
+            aki_predictor.record_pages(mrns)
+            if not aki_predictor.commit():
+                # Nothing of the window was kept; process it again.
+                time.sleep(STOP_POLL_INTERVAL)
+                continue
+            position = records[-1][1]
+            for mrn in mrns:
+                dispatcher.submit(mrn)
+            ingest_log.discard_before(position)
 
     except Exception as e:
         print(f"An error occurred: {e}")
+    finally:
+        dispatcher.close()
+        aki_predictor.close()
+
+
+def parse_mllp_addresses(value: str) -> list[tuple[str, int]]:
+    """Parses a comma-separated list of MLLP feeds.
+
+    Args:
+        value (str): Feeds as 'hostname:port', separated by commas, e.g.
+                     'lims-a:8440,lims-b:8440,pas:8450'.
+
+    Returns:
+        list[tuple[str, int]]: Hostname and port of every distinct feed, in
+                               the order given.
+
+    Raises:
+        ValueError: If an entry is not 'hostname:port' or no feed is given.
+    """
+    addresses = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        hostname, _, port = entry.rpartition(':')
+        if not hostname or not port.isdigit():
+            raise ValueError(f"Invalid MLLP address '{entry}', expected "
+                             f"'hostname:port'")
+        address = (hostname, int(port))
+        if address not in addresses:
+            addresses.append(address)
+    if not addresses:
+        raise ValueError("No MLLP address given")
+    return addresses
 
 
 def message_receiver(address: tuple[str, int], max_retries: int = 1100,
-                     base_delay: float = 1.0, max_delay: float = 30.0) -> None:
+                     base_delay: float = 1.0, max_delay: float = 30.0,
+                     feed: str | None = None,
+                     ingest_log: IngestLog | None = None) -> None:
     """Receives HL7 messages over a socket, decodes, and queues them for
     processing.
 
+    Every message decoded from a read is queued straight away; the messages
+    are then acknowledged in arrival order as the processor completes them.
+    One receiver runs per MLLP feed, all sharing `message_queue`.
+
+    With an `ingest_log`, the messages of a read are instead appended to the
+    log and acknowledged as soon as they are on disk, leaving their
+    processing to `log_processor`.
+
     Args:
         address (tuple[str, int]): Hostname and port number for the socket
                                    connection.
@@ -874,49 +362,92 @@ def message_receiver(address: tuple[str, int], max_retries: int = 1100,
                             in seconds.
         max_delay (float): Maximum delay between reconnection attempts
                            in seconds.
+        feed (str): Name of the feed in logs and metrics. Defaults to
+                    'hostname:port'.
+        ingest_log (IngestLog): Optional log to acknowledge messages from.
     """
-    global message, send_ack
     attempt_count = 0
     delay = base_delay
+    ack = to_mllp(ACK)
+    feed = feed or f"{address[0]}:{address[1]}"
+    received = prediction_core.FEED_MESSAGES_RECEIVED.labels(feed)
+    acknowledged = prediction_core.FEED_MESSAGES_ACKNOWLEDGED.labels(feed)
+    lag = prediction_core.FEED_ACKNOWLEDGEMENT_LAG.labels(feed)
 
     while not stop_event.is_set() and attempt_count < max_retries:
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                print("Attempting to connect...")
+                print(f"Attempting to connect to {feed}...")
                 s.connect(address)
-                print("Connected!")
-                MLLP_SOCKET_CONNECTIONS.inc()
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                             MLLP_RECEIVE_BUFFER_SIZE)
+                # ACKs are small writes; do not hold them back (Nagle).
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                print(f"Connected to {feed}!")
+                prediction_core.MLLP_SOCKET_CONNECTIONS.inc()
                 attempt_count = 0  # Reset attempt_count
                 delay = base_delay
 
+                decoder = MLLPFrameDecoder()
                 while not stop_event.is_set():
-                    buffer = s.recv(1024)
-                    if len(buffer) == 0:
+                    if decoder.recv_from(s) == 0:
+                        raise ConnectionError("MLLP connection closed by peer")
+                    received_at = time.monotonic()
+                    if ingest_log is not None:
+                        messages = decoder.decode()
+                        if messages:
+                            ingest_log.append(messages)
+                            prediction_core.MESSAGES_RECEIVED.inc(
+                                len(messages))
+                            received.inc(len(messages))
+                            s.sendall(ack * len(messages))
+                            prediction_core.MESSAGES_ACKNOWLEDGED.inc(
+                                len(messages))
+                            acknowledged.inc(len(messages))
+                            lag.observe(time.monotonic() - received_at)
                         continue
-                    message = from_mllp(buffer)
-                    with lock:
-                        messages.append(message)
-                        MESSAGES_RECEIVED.inc()
-                    # Wait to receive heads-up to acknowledge from processor
-                    wait_flag = True
-                    while wait_flag:
-                        with lock:
-                            if send_ack:
-                                wait_flag = False
-                                send_ack = False
-                    ack = to_mllp(ACK)
-                    s.sendall(ack)
-                    MESSAGES_ACKNOWLEDGED.inc()
+                    # A single read may hold several messages, or none yet.
+                    in_flight = []
+                    for segments in decoder.decode():
+                        item = QueuedMessage(segments)
+                        while not stop_event.is_set():
+                            try:
+                                message_queue.put(item,
+                                                  timeout=STOP_POLL_INTERVAL)
+                                break
+                            except queue.Full:
+                                continue
+                        prediction_core.MESSAGES_RECEIVED.inc()
+                        received.inc()
+                        in_flight.append(item)
+                    # Acknowledge in arrival order once each one is processed,
+                    # sending the ACKs of all messages already done together.
+                    acked = 0
+                    while acked < len(in_flight):
+                        if not wait_unless_stopped(in_flight[acked].processed):
+                            break
+                        ready = acked + 1
+                        while ready < len(in_flight) and \
+                                in_flight[ready].processed.is_set():
+                            ready += 1
+                        s.sendall(ack * (ready - acked))
+                        prediction_core.MESSAGES_ACKNOWLEDGED.inc(
+                            ready - acked)
+                        acknowledged.inc(ready - acked)
+                        lag.observe(time.monotonic() - received_at)
+                        acked = ready
 
         except Exception as e:
-            print(f"An error occurred: {e}")
+            print(f"An error occurred on {feed}: {e}")
             time.sleep(delay)
             delay = min(delay * 2, max_delay)  # Exponential backoff with a max
             attempt_count += 1
-            print(f"Attempting to reconnect, attempt {attempt_count}.")
+            prediction_core.FEED_RECONNECTIONS.labels(feed).inc()
+            print(f"Attempting to reconnect to {feed}, attempt "
+                  f"{attempt_count}.")
 
     if attempt_count == max_retries:
-        print("Maximum reconnection attempts reached, stopping.")
+        print(f"Maximum reconnection attempts to {feed} reached, stopping.")
         stop_event.set()
     print("Closing server socket.")
 
@@ -939,7 +470,8 @@ def main() -> None:
 
     Environment Variables:
         MLLP_ADDRESS: Specifies the address and port of the MLLP server in the
-                      format 'hostname:port'.
+                      format 'hostname:port', or of several feeds separated
+                      by commas, each read over its own connection.
                       If not set, defaults to 'localhost:8440'.
         PAGER_ADDRESS: Specifies the address of the pager service for sending
                        notifications.
@@ -950,18 +482,96 @@ def main() -> None:
                     Defaults to 'data/hospital-history/history.csv'.
         --db_path: Path to the SQLite database file. Defaults to
                    'state/my_database.db'.
+        --metrics_path: Path to the saved metrics state. Defaults to
+                        'state/counter_state.json'.
+        --metrics_checkpoint_interval: Seconds between checkpoints of the
+                                       metrics state. Defaults to 30; 0
+                                       only saves it on exit.
+        --batch_size: Maximum number of messages applied in one database
+                      transaction and scored in one model call. Defaults
+                      to 1 (off). Also accepted as --group_commit_size.
+        --batch_latency_ms: Time budget for filling a batch, in milliseconds.
+                            Defaults to 0. Also accepted as
+                            --group_commit_latency_ms.
+        --patient_cache_size: Maximum number of patients kept in the
+                              in-memory cache. Defaults to 500000.
+        --state_engine: 'sqlite' (default) keeps patient state in the SQLite
+                        database; 'numpy' reads it from a
+                        ColumnarPatientStore instead of the patient cache.
+                        Writes still go through to the database, so
+                        acknowledged updates survive a crash and a message
+                        rolled back is undone in the store as well. The
+                        store is saved to --state_snapshot_dir
+                        ('state/patient_state') on a clean exit only and
+                        that snapshot is consumed on the next start; after
+                        a crash the store is rebuilt from the database.
+        --model_path: Model used for scoring. Defaults to the compiled model
+                      'models/trained_model.npz', falling back to the pickle
+                      'models/trained_model.pkl' if it has not been exported.
+        --history_snapshot: History snapshot written by build-snapshot. When
+                            given, a new database starts empty instead of
+                            being loaded from --pathname, and patients not
+                            yet in it are read from the snapshot.
+        --model_reload_interval: Seconds between checks of the model file.
+                                 A new version is loaded, validated and
+                                 swapped in without a restart, and SIGHUP
+                                 checks at once. For a compiled model, the
+                                 .pkl of the same name is checked too and,
+                                 once newer, compiled over it. Defaults to
+                                 5; 0 disables reloading.
+        --validation_data, --validation_labels: Test set a reloaded model
+                                                must reach an F3 score of
+                                                MODEL_VALIDATION_F3 on.
+                                                Default to TEST_DATA_PATH
+                                                and LABELS_PATH, or
+                                                'data/test_data/'.
+        --decision_mode: 'model' (default) scores every result with the
+                         model; 'rules' decides with the KDIGO ratio to the
+                         patient's baseline alone; 'hybrid' applies the
+                         rules and calls the model only for ratios in
+                         HYBRID_AMBIGUOUS_BAND or without a baseline.
+        --engine: 'threads' (default) runs the receiver and processor as
+                  threads; 'asyncio' runs them as tasks on one event loop
+                  with non-blocking MLLP and pager I/O.
+        --workers: Number of processes scoring messages, each owning the
+                   patients of one MRN shard. Defaults to 1, processing in
+                   a thread of the main process. Only with the threads
+                   engine and the sqlite state engine.
+        --ingest_log: Directory of a write-ahead log of received messages.
+                      When given, messages are acknowledged once fsynced to
+                      the log and processed from it afterwards, resuming
+                      after a crash. Only with the threads engine, one
+                      worker and the sqlite state engine.
+
+    Commands:
+        export-model: Compiles the pickled model (--pickle_path) into the
+                      pure-NumPy scoring file (--output) and exits.
+        build-snapshot: Compiles --pathname into a read-only SQLite history
+                        snapshot (--output) and exits.
+        batch: Scores a test_f3.csv-style CSV file (input) on --processes
+               processes, --chunk_size rows per model call, writing 'y'/'n'
+               predictions to --output and reporting F3, precision and
+               recall against --labels if given. A '.mllp' input is instead
+               replayed through shard worker processes on top of
+               --history_snapshot (or --pathname), without paging, and
+               the messages predicted positive are written to --output.
 
     Notes:
-        - The programme relies on a globally shared state for managing incoming
-          messages and signaling acknowledgments.
+        - The receiver and processor threads hand messages over through a
+          bounded queue and signal acknowledgments with per-message events.
+          With several feeds, each receiver acknowledges its own connection
+          while the single processor handles messages in arrival order, so
+          the messages of each patient keep their order.
         - It uses a Prometheus server started on port 8000 for monitoring
           various metrics.
-        - Upon exit, the state of Prometheus counters is saved for persistence
-          across program restarts.
+        - The state of Prometheus counters is checkpointed periodically and
+          upon exit for persistence across program restarts.
     """
-    # Initialise threads to None
-    t1 = None
+    # Initialise threads and the optional columnar patient state to None
+    receivers = []
     t2 = None
+    patient_store = None
+    ingest_log = None
 
     warnings.filterwarnings("ignore")
 
@@ -969,47 +579,246 @@ def main() -> None:
     parser.add_argument("--pathname", default="data/hospital-history/history.csv")
     parser.add_argument("--db_path", default="state/my_database.db")
     parser.add_argument("--metrics_path", default="state/counter_state.json")
+    parser.add_argument("--metrics_checkpoint_interval",
+                        default=METRICS_CHECKPOINT_INTERVAL, type=float,
+                        help="Seconds between checkpoints of the metrics "
+                             "state; 0 only saves it on exit")
+    parser.add_argument("--batch_size", "--group_commit_size", default=1,
+                        type=int, dest="batch_size",
+                        help="Maximum number of messages committed in one "
+                             "transaction and scored in one model call; "
+                             "1 handles every message on its own")
+    parser.add_argument("--batch_latency_ms", "--group_commit_latency_ms",
+                        default=0.0, type=float, dest="batch_latency_ms",
+                        help="Maximum time to wait for further messages "
+                             "before handling a batch, in milliseconds")
+    parser.add_argument("--patient_cache_size", default=PATIENT_CACHE_SIZE,
+                        type=int,
+                        help="Maximum number of patients kept in memory")
+    # Both engines write every update through to SQLite before it is
+    # acknowledged; the numpy engine trades start-up time and memory for
+    # reads from arrays, and its snapshot is only a start-up shortcut.
+    parser.add_argument("--state_engine", default="sqlite",
+                        choices=["sqlite", "numpy"],
+                        help="Patient state engine: the SQLite database, or "
+                             "NumPy arrays written through to it and "
+                             "snapshotted on a clean exit")
+    parser.add_argument("--state_snapshot_dir", default="state/patient_state",
+                        help="Snapshot directory of the numpy state engine")
+    parser.add_argument("--model_path", default=COMPILED_MODEL_PATH,
+                        help="Compiled (.npz) or pickled model to score with")
+    parser.add_argument("--model_reload_interval",
+                        default=MODEL_RELOAD_INTERVAL, type=float,
+                        help="Seconds between checks of --model_path for a "
+                             "new model to swap in; 0 disables reloading")
+    parser.add_argument("--validation_data",
+                        default=os.getenv("TEST_DATA_PATH",
+                                          "data/test_data/test_f3.csv"),
+                        help="Test set a reloaded model is validated on")
+    parser.add_argument("--validation_labels",
+                        default=os.getenv("LABELS_PATH",
+                                          "data/test_data/labels_f3.csv"),
+                        help="Labels of --validation_data")
+    parser.add_argument("--history_snapshot", default=None,
+                        help="Read-only history snapshot to use instead of "
+                             "loading --pathname into the database")
+    parser.add_argument("--decision_mode", default="model",
+                        choices=DECISION_MODES,
+                        help="Decide AKI with the model, the KDIGO rules, "
+                             "or the rules with the model for ambiguous "
+                             "results")
+    parser.add_argument("--engine", default="threads",
+                        choices=["threads", "asyncio"],
+                        help="Runtime: receiver and processor threads, or "
+                             "an asyncio event loop")
+    parser.add_argument("--workers", default=1, type=int,
+                        help="Number of worker processes, each processing "
+                             "the messages of one shard of the MRNs")
+    parser.add_argument("--ingest_log", default=None,
+                        help="Directory of a write-ahead log; messages are "
+                             "acknowledged once logged and processed from "
+                             "the log")
+    commands = parser.add_subparsers(dest="command")
+    export_parser = commands.add_parser(
+        "export-model", help="Compile the pickled model for NumPy scoring")
+    export_parser.add_argument("--pickle_path", default=PICKLED_MODEL_PATH)
+    export_parser.add_argument("--output", default=COMPILED_MODEL_PATH)
+    snapshot_parser = commands.add_parser(
+        "build-snapshot", help="Compile the history CSV into a snapshot")
+    snapshot_parser.add_argument("--pathname", default=argparse.SUPPRESS)
+    snapshot_parser.add_argument("--output",
+                                 default="state/history_snapshot.db")
+    batch_parser = commands.add_parser(
+        "batch", help="Score a CSV or MLLP file offline")
+    batch_parser.add_argument("input",
+                              help="test_f3.csv-style CSV or .mllp file")
+    batch_parser.add_argument("--labels", default=None,
+                              help="Labels of the CSV rows to score against")
+    batch_parser.add_argument("--output", default=None,
+                              help="Predictions file; defaults to the input "
+                                   "path with a '_predictions.csv' suffix")
+    batch_parser.add_argument("--chunk_size", default=BATCH_CHUNK_SIZE,
+                              type=int)
+    batch_parser.add_argument("--processes", default=os.cpu_count() or 1,
+                              type=int)
+    for name in ("--pathname", "--model_path", "--history_snapshot"):
+        batch_parser.add_argument(name, default=argparse.SUPPRESS)
+    batch_parser.add_argument("--decision_mode", default=argparse.SUPPRESS,
+                              choices=DECISION_MODES)
     flags = parser.parse_args()
+    if flags.command == "batch" and flags.labels is not None and \
+            flags.input.endswith(".mllp"):
+        parser.error("--labels requires a CSV input")
+    if flags.command is None and flags.workers > 1 and \
+            (flags.engine != "threads" or flags.state_engine != "sqlite"):
+        parser.error("--workers requires --engine threads and "
+                     "--state_engine sqlite")
+    if flags.command is None and flags.ingest_log is not None and \
+            (flags.engine != "threads" or flags.workers > 1 or
+             flags.state_engine != "sqlite"):
+        parser.error("--ingest_log requires --engine threads, --workers 1 "
+                     "and --state_engine sqlite")
+
+    if flags.command == "export-model":
+        export_model(flags.pickle_path, flags.output)
+        print(f"Model '{flags.pickle_path}' compiled to '{flags.output}'.")
+        return
+    if flags.command == "build-snapshot":
+        build_history_snapshot(flags.pathname, flags.output)
+        print(f"History '{flags.pathname}' compiled to '{flags.output}'.")
+        return
+    if flags.command == "batch":
+        run_batch(flags)
+        return
+
+    start_http_server(8000)
 
     try:
         if 'MLLP_ADDRESS' in os.environ:
-            mllp_address = os.environ['MLLP_ADDRESS']
-            hostname, port_str = mllp_address.split(':')
-            port = int(port_str)
-            mllp_address = (hostname, port)
-            print("MLLP_ADDRESS is set: ", mllp_address)
+            mllp_addresses = parse_mllp_addresses(os.environ['MLLP_ADDRESS'])
+            print("MLLP_ADDRESS is set: ", mllp_addresses)
         else:
-            mllp_address = ("localhost", 8440)
+            mllp_addresses = [("localhost", 8440)]
 
         if 'PAGER_ADDRESS' in os.environ:
             pager_address = os.environ['PAGER_ADDRESS']
+            parse_pager_address(pager_address)
             print("PAGER_ADDRESS is set: ", pager_address)
         else:
             pager_address = "localhost:8441"
 
+        history_snapshot = flags.history_snapshot
+        if history_snapshot is not None and \
+                not os.path.exists(history_snapshot):
+            print(f"The history snapshot '{history_snapshot}' does not "
+                  f"exist, ignoring it.")
+            history_snapshot = None
+
         if os.path.exists(flags.db_path):
             print(f"The database file '{flags.db_path}' already exists.")
+            if history_snapshot is None:
+                # The snapshot holds the series of a database built on it.
+                backfill_creatinine_results(flags.db_path, flags.pathname)
+        elif history_snapshot is not None:
+            print(f"The database file '{flags.db_path}' does not exist, "
+                  f"creating it on top of '{history_snapshot}'.")
+            with contextlib.closing(sqlite3.connect(flags.db_path)) as conn:
+                conn.execute(PATIENT_HISTORY_TABLE_SQL)
         else:
             print(f"The database file '{flags.db_path}' does not exist, "
                   f"proceeding to create it.")
-            preload_history_to_sqlite(db_path=flags.db_path,
+            # Build under a temporary name so that an interrupted load is
+            # redone on the next start.
+            temporary_db_path = f"{flags.db_path}.loading"
+            if os.path.exists(temporary_db_path):
+                os.remove(temporary_db_path)
+            preload_history_to_sqlite(db_path=temporary_db_path,
                                       pathname=flags.pathname)
+            os.replace(temporary_db_path, flags.db_path)
 
         initialise_or_load_counters(flags.metrics_path)
-
-        with open("models/trained_model.pkl", "rb") as file:
-            model = pickle.load(file)
-
-        global messages, send_ack
-        messages = []
-        send_ack = False
-
-        t1 = threading.Thread(target=lambda: message_receiver(mllp_address),
-                              daemon=True)
-        t2 = threading.Thread(target=lambda: processor(pager_address, model,
-                                                       db_path=flags.db_path),
-                              daemon=True)
-        t1.start()
+        threading.Thread(target=flush_metrics_periodically,
+                         daemon=True).start()
+        if flags.metrics_checkpoint_interval > 0:
+            threading.Thread(target=checkpoint_counters_periodically,
+                             args=(flags.metrics_path,
+                                   flags.metrics_checkpoint_interval),
+                             daemon=True).start()
+
+        if flags.state_engine == "numpy":
+            snapshot_features = os.path.join(flags.state_snapshot_dir,
+                                             "features.npy")
+            if os.path.exists(snapshot_features):
+                patient_store = ColumnarPatientStore.restore(
+                    flags.state_snapshot_dir)
+                # The snapshot falls behind the database with the first
+                # update; after a crash the state is rebuilt from the
+                # database instead.
+                os.remove(snapshot_features)
+                print(f"Patient state restored from snapshot "
+                      f"'{flags.state_snapshot_dir}'.")
+            else:
+                patient_store = ColumnarPatientStore.from_sqlite(
+                    flags.db_path, history_snapshot)
+                print(f"Patient state built from '{flags.db_path}'.")
+
+        model_path = flags.model_path
+        if not os.path.exists(model_path):
+            print(f"The model file '{model_path}' does not exist, falling "
+                  f"back to '{PICKLED_MODEL_PATH}'.")
+            model_path = PICKLED_MODEL_PATH
+        model = load_model(model_path)
+        model_reloader = None
+        if flags.model_reload_interval > 0:
+            # A compiled model is also rebuilt from a newer pickle of the
+            # same name, e.g. 'models/trained_model.pkl' after retraining.
+            source = None
+            if model_path.endswith('.npz'):
+                source = f"{model_path[:-len('.npz')]}.pkl"
+            model_reloader = ModelReloader(
+                model_path, model,
+                load_validation_set(flags.validation_data,
+                                    flags.validation_labels),
+                flags.model_reload_interval, source=source)
+            threading.Thread(target=model_reloader.run, daemon=True).start()
+            signal.signal(signal.SIGHUP,
+                          lambda signum, frame: model_reloader.request())
+
+        options = ProcessingOptions(
+            db_path=flags.db_path, batch_size=flags.batch_size,
+            batch_latency=flags.batch_latency_ms / 1000,
+            cache_size=flags.patient_cache_size, patient_store=patient_store,
+            history_snapshot=history_snapshot,
+            decision_mode=flags.decision_mode, model_reloader=model_reloader)
+        if flags.engine == "asyncio":
+            asyncio.run(run_async_engine(mllp_addresses, pager_address, model,
+                                         options))
+            return
+
+        if flags.ingest_log is not None:
+            ingest_log = IngestLog(flags.ingest_log)
+
+        # One receiver thread per MLLP feed, all feeding the one processor
+        receivers = [threading.Thread(target=message_receiver,
+                                      args=(address,),
+                                      kwargs={"ingest_log": ingest_log},
+                                      daemon=True)
+                     for address in mllp_addresses]
+        if ingest_log is not None:
+            t2 = threading.Thread(
+                target=log_processor,
+                args=(pager_address, model, ingest_log, options), daemon=True)
+        elif flags.workers > 1:
+            t2 = threading.Thread(
+                target=sharded_processor,
+                args=(pager_address, model, flags.workers, options),
+                daemon=True)
+        else:
+            t2 = threading.Thread(
+                target=processor, args=(pager_address, model, options),
+                daemon=True)
+        for receiver in receivers:
+            receiver.start()
         t2.start()
 
         # Instead of blocking indefinitely on join(), wait for threads to
@@ -1027,14 +836,18 @@ def main() -> None:
     finally:
         # Ensure that we attempt to join threads even after Ctrl+C
         # This waits for threads to acknowledge the stop_event and exit
-        if t1 is not None:
-            t1.join()
+        for receiver in receivers:
+            receiver.join()
         if t2 is not None:
             t2.join()
+        if ingest_log is not None:
+            ingest_log.close()
         save_counters(flags.metrics_path)  # Save counter states before exiting
+        if patient_store is not None:
+            patient_store.snapshot(flags.state_snapshot_dir)
+            print(f"Patient state saved to '{flags.state_snapshot_dir}'.")
         print("Program exited gracefully.")
 
 
 if __name__ == "__main__":
-    start_http_server(8000)
     main()
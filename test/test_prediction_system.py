@@ -1,22 +1,45 @@
 import unittest
+import unittest.mock
 from unittest.mock import patch
+import asyncio
+import prometheus_client
 import sqlite3
 import os
 import sys
 import pickle
 import tempfile
+import contextlib
 import warnings
 import statistics
 import csv
+import http.server
+import socket
+import threading
+import collections
+import queue
+import time
+import multiprocessing
+import zlib
 from sklearn.metrics import fbeta_score
 
 try:
     # Try importing as if running in Docker (without src prefix)
-    from prediction_system import *
+    from prediction_core import *
 except ModuleNotFoundError:
     # Fallback to local import with src prefix
     sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'src'))
-    from prediction_system import *
+    from prediction_core import *
+from ingest_log import *
+from pager import *
+from async_engine import *
+from batch_scoring import *
+from prediction_system import *
+
+try:
+    # The pager simulator is not shipped in the Docker image
+    import simulator
+except ModuleNotFoundError:
+    simulator = None
 
 
 class TestAKIPredictor(unittest.TestCase):
@@ -46,6 +69,9 @@ class TestAKIPredictor(unittest.TestCase):
         self.aki_predictor = AKIPredictor(self.model, self.db_path,
                                           metrics_count_flag=False)
 
+    def tearDown(self):
+        self.aki_predictor.close()
+
     @classmethod
     def tearDownClass(cls):
         # Close the connection and remove the temporary database file
@@ -81,7 +107,7 @@ class TestAKIPredictor(unittest.TestCase):
 
         cls.conn.commit()
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_invalid_mrn(self, mock_log_error):
         message = [
             "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
@@ -104,7 +130,7 @@ class TestAKIPredictor(unittest.TestCase):
         self.assertIsNone(patient_data, "Patient data should not be created for "
                                         "invalid MRN")
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_invalid_message_indexing(self, mock_log_error):
         # Message with missing segments to trigger IndexError
         message = ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200"]
@@ -118,7 +144,7 @@ class TestAKIPredictor(unittest.TestCase):
                                           "invalid message format: list index "
                                           "out of range")
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_lims_message_not_for_creatinine(self, mock_log_error):
         # Example message with a test type other than creatinine
         message = [
@@ -146,7 +172,7 @@ class TestAKIPredictor(unittest.TestCase):
                                                         "not be updated for "
                                                         "non-creatinine results")
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_incorrect_creatinine_value(self, mock_log_error):
         # An example message with incorrect creatinine test result
         message = [
@@ -221,7 +247,7 @@ class TestAKIPredictor(unittest.TestCase):
         self.assertIn("999999", self.aki_predictor.pending_predictions,
                       "New patient MRN was not added to pending_predictions")
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_pas_message_with_invalid_dob(self, mock_log_error):
         message = [
             "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
@@ -246,7 +272,7 @@ class TestAKIPredictor(unittest.TestCase):
         self.assertEqual(patient_data, expected_data, "Patient data should not be "
                                                       "created for invalid DOB")
 
-    @patch('prediction_system.logging.error')
+    @patch('prediction_core.logging.error')
     def test_pas_message_with_invalid_sex(self, mock_log_error):
         message = [
             "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
@@ -377,7 +403,7 @@ class TestAKIPredictor(unittest.TestCase):
                          "MRN should be removed from pending_predictions after "
                          "demographic update and AKI prediction attempt")
 
-    @patch('prediction_system.logging.info')
+    @patch('prediction_core.logging.info')
     def test_detect_aki_high_creatinine_returns_mrn(self, mock_log_info):
         # High creatinine level message for an existing patient
         high_creatinine_message = [
@@ -403,6 +429,134 @@ class TestAKIPredictor(unittest.TestCase):
         mock_log_info.assert_called_once_with(f"{msg_identifier}\n>> "
                                               f"AKI predicted for MRN: 160064")
 
+    def test_database_connection_is_reused_in_wal_mode(self):
+        message = [
+            "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A03|||2.5",
+            "PID|1||640400"
+        ]
+        self.aki_predictor.examine_message_and_predict_aki(message)
+        conn = self.aki_predictor._connection()
+        self.aki_predictor.examine_message_and_predict_aki(message)
+        self.assertIs(self.aki_predictor._connection(), conn,
+                      "The predictor should keep one connection per thread")
+
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(journal_mode, "wal", "Connection should use WAL mode")
+
+    def test_group_commit_writes_are_visible_only_after_commit(self):
+        messages = [[
+            "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+            f"PID|1||{mrn}",
+            "OBR|1||||||20240331003200",
+            "OBX|1|SN|CREATININE||95.0"
+        ] for mrn in ("777001", "777002")]
+        for message in messages:
+            self.aki_predictor.examine_message_and_predict_aki(message,
+                                                               commit=False)
+
+        self.cursor.execute("SELECT COUNT(*) FROM patient_history "
+                            "WHERE mrn IN ('777001', '777002')")
+        self.assertEqual(self.cursor.fetchone()[0], 0, "Uncommitted writes "
+                                                       "should not be visible")
+
+        self.assertTrue(self.aki_predictor.commit())
+        self.cursor.execute("SELECT COUNT(*) FROM patient_history "
+                            "WHERE mrn IN ('777001', '777002')")
+        self.assertEqual(self.cursor.fetchone()[0], 2, "Both messages should "
+                                                       "be committed together")
+
+    def test_failed_message_in_group_does_not_discard_others(self):
+        good = [
+            "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+            "PID|1||777003||JOHN DOE||19800312|M"
+        ]
+        self.aki_predictor.examine_message_and_predict_aki(good, commit=False)
+        with patch.object(self.aki_predictor, 'attempt_aki_prediction',
+                          side_effect=sqlite3.OperationalError("failed")):
+            self.aki_predictor.examine_message_and_predict_aki([
+                "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                "PID|1||777003",
+                "OBR|1||||||20240331003200",
+                "OBX|1|SN|CREATININE||95.0"
+            ], commit=False)
+        self.aki_predictor.commit()
+
+        self.cursor.execute("SELECT sex, test_1 FROM patient_history "
+                            "WHERE mrn = '777003'")
+        self.assertEqual(self.cursor.fetchone(), (0, None),
+                         "Only the failed message should be rolled back")
+
+    def test_batch_is_scored_in_one_predict_call(self):
+        def messages(mrn):
+            return [
+                ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                 f"PID|1||{mrn}||JOHN DOE||19500312|M"],
+            ] + [
+                ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                 f"PID|1||{mrn}",
+                 "OBR|1||||||20240331003200",
+                 f"OBX|1|SN|CREATININE||{result}"]
+                for result in (60.0, 420.0, 65.0)
+            ]
+
+        expected = [self.aki_predictor.examine_message_and_predict_aki(m)
+                    for m in messages("777010")]
+        with patch.object(self.aki_predictor, 'model',
+                          wraps=self.aki_predictor.model) as model:
+            results = self.aki_predictor.examine_messages_and_predict_aki(
+                messages("777011"))
+
+        model.predict.assert_called_once()
+        self.assertEqual(len(model.predict.call_args[0][0]), 3,
+                         "Every LIMS message should be scored in one call")
+        self.assertEqual(results, [mrn and "777011" for mrn in expected],
+                         "Batched results should match one-by-one results")
+
+    def test_failed_batch_predict_falls_back_to_one_at_a_time(self):
+        class FailsOnResult65:
+            def predict(self, features):
+                if (features[:, FIRST_TEST_COLUMN] == 65.0).any():
+                    raise ValueError("cannot score this row")
+                return np.ones(len(features), dtype=int)
+
+        messages = [
+            ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+             "PID|1||777012||JOHN DOE||19500312|M"],
+        ] + [
+            ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+             "PID|1||777012",
+             "OBR|1||||||20240331003200",
+             f"OBX|1|SN|CREATININE||{result}"]
+            for result in (60.0, 420.0, 65.0)
+        ]
+        with patch.object(self.aki_predictor, 'model', FailsOnResult65()):
+            results = self.aki_predictor.examine_messages_and_predict_aki(
+                messages)
+        self.assertEqual(results, [None, "777012", "777012", None],
+                         "Only the prediction the model failed on should "
+                         "be lost")
+
+    def test_cached_patient_is_not_read_from_database(self):
+        self.assertGreater(self.aki_predictor.warm_cache(), 0)
+        statements = []
+        self.aki_predictor._connection().set_trace_callback(statements.append)
+
+        message = [
+            "MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+            "PID|1||755374",
+            "OBR|1||||||20240331003200",
+            "OBX|1|SN|CREATININE||99.0"
+        ]
+        self.aki_predictor.examine_message_and_predict_aki(message)
+        self.assertFalse([sql for sql in statements
+                          if sql.lstrip().upper().startswith("SELECT")],
+                         "Cached patients should not be read from SQLite")
+
+        # The write-through must still reach the database.
+        self.cursor.execute("SELECT test_1 FROM patient_history "
+                            "WHERE mrn = '755374'")
+        self.assertEqual(self.cursor.fetchone()[0], 99.0)
+
     def test_pas_discharge_message_does_not_update_database(self):
         # Discharge message for non-existing patient
         discharge_message = [
@@ -423,6 +577,759 @@ class TestAKIPredictor(unittest.TestCase):
                                         "for discharge message")
 
 
+class TestProcessingMetrics(unittest.TestCase):
+    def setUp(self):
+        registry = prometheus_client.CollectorRegistry()
+        self.metrics = {
+            name: prometheus_client.Counter(name.lower(), name,
+                                            registry=registry)
+            for name in ("MESSAGES_PROCESSED", "POSITIVE_AKI_PREDICTIONS",
+                         "TOTAL_BLOOD_TEST_RESULTS_RECEIVED",
+                         "NORMAL_BLOOD_TEST_RESULTS_RECEIVED",
+                         "AKI_BLOOD_TEST_RESULTS_RECEIVED")}
+        for kind in ("TOTAL", "NORMAL", "AKI"):
+            for statistic in ("MEAN", "STDDEV"):
+                name = f"{kind}_BLOOD_TEST_RESULT_{statistic}"
+                self.metrics[name] = prometheus_client.Gauge(
+                    name.lower(), name, registry=registry)
+        self.metrics["PENDING_PREDICTIONS"] = prometheus_client.Gauge(
+            "pending_predictions", "pending", registry=registry)
+        self.metrics["POSITIVE_PREDICTION_RATE"] = prometheus_client.Gauge(
+            "positive_prediction_rate", "rate", registry=registry)
+        self.metrics["MESSAGE_STAGE_LATENCY"] = prometheus_client.Histogram(
+            "message_stage_latency_seconds", "latency", ["stage"],
+            registry=registry)
+        patcher = patch.multiple("prediction_core", create=True,
+                                 **self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_flush_publishes_what_was_counted_since_the_last_flush(self):
+        metrics = ProcessingMetrics()
+        metrics.count('messages_processed')
+        metrics.count('messages_processed')
+        metrics.count('pending_predictions')
+        metrics.flush()
+        metrics.count('messages_processed')
+        metrics.count('pending_predictions', -1)
+        metrics.flush()
+        metrics.flush()
+
+        self.assertEqual(metric_value(self.metrics["MESSAGES_PROCESSED"]), 3)
+        self.assertEqual(metric_value(self.metrics["PENDING_PREDICTIONS"]), 0)
+
+    def test_result_statistics_across_threads(self):
+        # Large offsets make the sum of squares formula lose precision.
+        values = [1e9 + value for value in (4, 7, 13, 16, 21, 5)]
+        metrics = ProcessingMetrics()
+        metrics.restore({'total_blood_test_results_received': 2,
+                         'total_blood_test_result_mean': 1e9 + 5.5,
+                         'total_blood_test_result_stddev': 1.5})
+        thread = threading.Thread(target=lambda: [
+            metrics.result('total', value) for value in values[2:4]])
+        thread.start()
+        thread.join()
+        for value in values[4:]:
+            metrics.result('total', value)
+        metrics.result('aki', values[0])
+        metrics.count('positive_aki_predictions')
+        metrics.flush()
+
+        self.assertEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULTS_RECEIVED"]), 4)
+        self.assertAlmostEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULT_MEAN"]),
+            statistics.fmean(values))
+        self.assertAlmostEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULT_STDDEV"]),
+            statistics.pstdev(values), places=6)
+        self.assertAlmostEqual(metric_value(
+            self.metrics["POSITIVE_PREDICTION_RATE"]), 1 / 6)
+
+    def test_batches_taken_in_a_worker_are_merged(self):
+        values = [1e9 + value for value in (4, 7, 13, 16)]
+        worker = ProcessingMetrics()
+        worker.count('messages_processed', 3)
+        for value in values[2:]:
+            worker.result('total', value)
+        worker.time('inference', 0.0003)
+        # Batches cross the process boundary pickled.
+        batch = pickle.loads(pickle.dumps(worker.take()))
+        self.assertEqual(worker.take().counts, {}, "A batch is taken once")
+
+        metrics = ProcessingMetrics()
+        metrics.count('messages_processed')
+        for value in values[:2]:
+            metrics.result('total', value)
+        metrics.merge(batch)
+        metrics.flush()
+
+        self.assertEqual(metric_value(self.metrics["MESSAGES_PROCESSED"]), 4)
+        self.assertEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULTS_RECEIVED"]), 4)
+        self.assertAlmostEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULT_MEAN"]),
+            statistics.fmean(values))
+        self.assertAlmostEqual(metric_value(
+            self.metrics["TOTAL_BLOOD_TEST_RESULT_STDDEV"]),
+            statistics.pstdev(values), places=6)
+        self.assertEqual(
+            self.metrics["MESSAGE_STAGE_LATENCY"].labels('inference')
+            ._sum.get(), 0.0003)
+
+    def test_stage_latencies_are_observed(self):
+        metrics = ProcessingMetrics()
+        metrics.time('parse', 0.00002)
+        metrics.time('inference', 0.0003)
+        metrics.flush()
+        latency = self.metrics["MESSAGE_STAGE_LATENCY"]
+        for stage, seconds in (('parse', 0.00002), ('inference', 0.0003)):
+            samples = {sample.name: sample.value
+                       for sample in latency.collect()[0].samples
+                       if sample.labels.get('stage') == stage}
+            self.assertEqual(samples['message_stage_latency_seconds_count'],
+                             1)
+            self.assertAlmostEqual(
+                samples['message_stage_latency_seconds_sum'], seconds)
+
+
+class TestCounterCheckpoints(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "counter_state.json")
+
+    def test_load_returns_the_newest_checkpoint(self):
+        write_counter_state(self.path, {"messages_received": 1})
+        write_counter_state(self.path, {"messages_received": 2})
+        self.assertEqual(load_counter_state(self.path),
+                         {"messages_received": 2})
+        self.assertFalse(os.path.exists(f"{self.path}.tmp"))
+
+    @patch('prediction_core.logging.error')
+    def test_load_falls_back_to_the_previous_checkpoint(self, mock_log_error):
+        write_counter_state(self.path, {"messages_received": 1})
+        write_counter_state(self.path, {"messages_received": 2})
+        with open(self.path, "w") as f:
+            f.write('{"messages_rec')  # Torn write
+        self.assertEqual(load_counter_state(self.path),
+                         {"messages_received": 1})
+        mock_log_error.assert_called_once()
+
+    def test_load_without_checkpoint(self):
+        self.assertIsNone(load_counter_state(self.path))
+
+    def test_unchanged_metrics_are_not_written_again(self):
+        state = {"messages_received": 3}
+        with patch('prediction_core.collect_counter_state',
+                   return_value=state), \
+                patch('prediction_core.write_counter_state') as mock_write:
+            previous = checkpoint_counters(self.path)
+            checkpoint_counters(self.path, previous)
+        mock_write.assert_called_once_with(self.path, state)
+
+
+class TestAgeCalculation(unittest.TestCase):
+
+    def test_age_on(self):
+        today = datetime(2024, 3, 12).date()
+        self.assertEqual(age_on("19800312", today), 44)
+        self.assertEqual(age_on("19800313", today), 43)
+        self.assertIsNone(age_on("1980-03-12", today))
+
+    def test_date_of_birth_parsed_once(self):
+        today = datetime(2031, 1, 1).date()
+        age_on("19910721", today)
+        hits = age_on.cache_info().hits
+        self.assertEqual(age_on("19910721", today), 39)
+        self.assertEqual(age_on.cache_info().hits, hits + 1)
+
+    def test_reference_date_read_once_a_day(self):
+        reference = ReferenceDate()
+        first = reference.today()
+        with patch('prediction_core.datetime') as mock_datetime:
+            self.assertEqual(reference.today(), first)
+            mock_datetime.now.assert_not_called()
+
+
+class TestHL7Message(unittest.TestCase):
+
+    def test_fields_of_a_lims_message(self):
+        message = HL7Message([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+            "PID|1||442925",
+            "OBR|1||||||20240331003200",
+            "OBX|1|SN|CREATININE||127.5"])
+        self.assertEqual(message.message_type, "ORU^R01")
+        self.assertEqual(message.timestamp, "20240331003200")
+        self.assertEqual(message.mrn, "442925")
+        self.assertEqual(message.test_type, "CREATININE")
+        self.assertEqual(message.test_result, "127.5")
+        self.assertIsNone(message.date_of_birth)
+
+    def test_segments_out_of_position_are_found_by_type(self):
+        message = HL7Message([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+            "EVN|A01|20240331003200",
+            "PID|1||497030||ROSCOE DOUGLAS||19870515|M"])
+        self.assertEqual(message.mrn, "497030")
+        self.assertEqual(message.date_of_birth, "19870515")
+        self.assertEqual(message.sex, "M")
+        self.assertIsNone(message.test_type)
+
+    def test_missing_segment_raises_index_error(self):
+        with self.assertRaises(IndexError):
+            HL7Message([
+                "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                "PID|1||442925",
+                "OBR|1||||||20240331003200"])
+
+
+class TestPatientCache(unittest.TestCase):
+    def test_record_round_trips_database_row(self):
+        row = (50, 1, 112.34, 94.65, 89.37, 98.63, 97.07)
+        self.assertEqual(PatientRecord.from_row(row).row(), row)
+
+    def test_first_result_initialises_all_slots(self):
+        record = PatientRecord(age=40, sex=0)
+        self.assertEqual(record.row(), (40, 0, None, None, None, None, None))
+        record.push_result(150.0)
+        self.assertEqual(record.results(), (150.0,) * 5)
+
+    def test_ring_buffer_keeps_five_most_recent_results(self):
+        record = PatientRecord.from_row((40, 0, 5.0, 4.0, 3.0, 2.0, 1.0))
+        for result in (6.0, 7.0, 8.0, 9.0, 10.0, 11.0):
+            record.push_result(result)
+        self.assertEqual(record.results(), (11.0, 10.0, 9.0, 8.0, 7.0))
+
+    def test_least_recently_used_record_is_evicted(self):
+        cache = PatientCache(capacity=2)
+        cache.put("1", PatientRecord())
+        cache.put("2", PatientRecord())
+        cache.get("1")
+        cache.put("3", PatientRecord())
+        self.assertIn("1", cache)
+        self.assertNotIn("2", cache)
+        self.assertIn("3", cache)
+        self.assertEqual(len(cache), 2)
+
+
+class TestCreatinineBaselines(unittest.TestCase):
+    def test_rolling_windows_match_recomputed_aggregates(self):
+        rng = np.random.default_rng(7)
+        day = 24 * 3600.0
+        times = np.cumsum(rng.exponential(3 * day, 400))
+        values = rng.choice([60.0, 75.5, 90.0, 120.25, 300.0], 400)
+        baselines = CreatinineBaselines()
+        for i, (taken_at, value) in enumerate(zip(times, values)):
+            baselines.push(taken_at, value)
+            earlier = slice(0, i)
+            recent = values[earlier][times[earlier] >= taken_at - 7 * day]
+            year = values[earlier][times[earlier] >= taken_at - 365 * day]
+            self.assertEqual(baselines.minimum,
+                             min(recent) if len(recent) else None)
+            self.assertEqual(baselines.median,
+                             statistics.median(year) if len(year) else None)
+            self.assertEqual(baselines.latest, value)
+
+    def test_baselines_are_rebuilt_from_the_database(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db_path = os.path.join(directory.name, "db.db")
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        predictor = AKIPredictor(None, db_path, metrics_count_flag=False)
+        self.addCleanup(predictor.close)
+        for timestamp, result in (("20240301090000", "80.0"),
+                                  ("20240305090000", "100.0"),
+                                  ("20240309090000", "150.0")):
+            predictor.examine_message_and_predict_aki([
+                f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{timestamp}||ORU^R01|||2.5",
+                "PID|1||777001",
+                f"OBR|1||||||{timestamp}",
+                f"OBX|1|SN|CREATININE||{result}"
+            ])
+        cursor = predictor._connection().cursor()
+        expected = (150.0, 100.0, 90.0)
+        self.assertEqual(
+            predictor.creatinine_baselines.get(cursor, "777001").features(),
+            expected)
+        self.assertEqual(cursor.execute(
+            "SELECT taken_at FROM creatinine_results WHERE mrn = '777001' "
+            "ORDER BY taken_at").fetchall()[0],
+            (parse_hl7_timestamp("20240301090000"),))
+
+        predictor.creatinine_baselines = CreatinineBaselineCache()
+        self.assertEqual(
+            predictor.creatinine_baselines.get(cursor, "777001").features(),
+            expected)
+        predictor.creatinine_baselines = CreatinineBaselineCache()
+        predictor.creatinine_baselines.warm(cursor, {"777001"})
+        self.assertIn("777001", predictor.creatinine_baselines)
+        self.assertEqual(
+            predictor.creatinine_baselines.get(None, "777001").features(),
+            expected)
+
+    def test_preload_keeps_dated_results(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        self.addCleanup(os.remove, db_path)
+        os.close(db_file)
+        history_csv_path = os.getenv("HISTORY_CSV_PATH",
+                                     "data/hospital-history/history.csv")
+        preload_history_to_sqlite(db_path, history_csv_path, chunk_size=500)
+        preload_history_to_sqlite(db_path, history_csv_path)
+
+        with open(history_csv_path, 'r') as file:
+            rows = list(csv.reader(file))[1:]
+        expected = sorted(
+            (row[0], datetime.strptime(row[i], '%Y-%m-%d %H:%M:%S'),
+             float(row[i + 1]))
+            for row in rows for i in range(1, len(row), 2) if row[i])
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            loaded = sorted(
+                (mrn, RESULT_TIME_EPOCH + timedelta(seconds=taken_at), value)
+                for mrn, taken_at, value in conn.execute(
+                    "SELECT mrn, taken_at, value FROM creatinine_results"))
+        self.assertEqual(loaded, sorted(set(expected)))
+
+    def test_backfill_fills_only_an_empty_series(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        self.addCleanup(os.remove, db_path)
+        os.close(db_file)
+        history_csv_path = os.getenv("HISTORY_CSV_PATH",
+                                     "data/hospital-history/history.csv")
+        preload_history_to_sqlite(db_path, history_csv_path)
+        select_results = "SELECT mrn, taken_at, value FROM creatinine_results"
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            preloaded = sorted(conn.execute(select_results))
+            # A database from before the series: history updated since.
+            with conn:
+                conn.execute("DELETE FROM creatinine_results")
+                conn.execute("UPDATE patient_history SET test_1 = 999.0")
+
+        self.assertEqual(
+            backfill_creatinine_results(db_path, history_csv_path),
+            len(preloaded))
+        self.assertEqual(
+            backfill_creatinine_results(db_path, history_csv_path), 0)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            self.assertEqual(sorted(conn.execute(select_results)), preloaded)
+            self.assertEqual(conn.execute(
+                "SELECT DISTINCT test_1 FROM patient_history").fetchall(),
+                [(999.0,)])
+
+
+class TestKDIGORules(unittest.TestCase):
+    @staticmethod
+    def baselines(latest, minimum, median):
+        baselines = CreatinineBaselines()
+        baselines.latest, baselines.minimum, baselines.median = \
+            latest, minimum, median
+        return baselines
+
+    def test_decide_matches_decide_all(self):
+        cases = [(100.0, None, None), (100.0, 80.0, None),
+                 (100.0, None, 40.0), (150.0, 100.0, 120.0),
+                 (300.0, 100.0, 90.0), (100.0, 0.0, 100.0),
+                 (141.0, 100.0, 150.0)]
+        latest, minimum, median = (
+            np.array([np.nan if value is None else value for value in column])
+            for column in zip(*cases))
+        for mode in DECISION_MODES:
+            rules = KDIGORules(mode)
+            expected = [np.nan if decision is None else float(decision)
+                        for decision in (rules.decide(self.baselines(*case))
+                                         for case in cases)]
+            np.testing.assert_array_equal(
+                rules.decide_all(latest, minimum, median), expected)
+
+    def test_hybrid_mode_asks_model_only_in_ambiguous_band(self):
+        rules = KDIGORules('hybrid')
+        self.assertFalse(rules.decide(self.baselines(100.0, 90.0, 95.0)))
+        self.assertTrue(rules.decide(self.baselines(300.0, 100.0, 110.0)))
+        self.assertIsNone(rules.decide(self.baselines(160.0, 100.0, 110.0)))
+        self.assertIsNone(rules.decide(self.baselines(160.0, None, None)))
+        self.assertFalse(KDIGORules('rules').decide(
+            self.baselines(160.0, None, None)))
+        with self.assertRaises(ValueError):
+            KDIGORules('oracle')
+
+    def test_rules_mode_does_not_call_the_model(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db_path = os.path.join(directory.name, "db.db")
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        model = unittest.mock.Mock()
+        predictor = AKIPredictor(model, db_path, metrics_count_flag=False,
+                                 decision_mode='rules')
+        self.addCleanup(predictor.close)
+        predictor.examine_message_and_predict_aki([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240301090000||ADT^A01|||2.5",
+            "PID|1||777002||JOHN DOE||19500312|M"])
+        pages = [predictor.examine_message_and_predict_aki([
+            f"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{timestamp}||ORU^R01|||2.5",
+            "PID|1||777002",
+            f"OBR|1||||||{timestamp}",
+            f"OBX|1|SN|CREATININE||{result}"
+        ]) for timestamp, result in (("20240301090000", "80.0"),
+                                     ("20240302090000", "90.0"),
+                                     ("20240303090000", "130.0"))]
+        self.assertEqual(pages, [None, None, "777002"])
+        model.predict.assert_not_called()
+
+    def test_rule_modes_on_test_set(self):
+        test_data_path = os.getenv("TEST_DATA_PATH",
+                                   "data/test_data/test_f3.csv")
+        labels_path = os.getenv("LABELS_PATH",
+                                "data/test_data/labels_f3.csv")
+        features, labels = TestModelF3Score.load_and_preprocess_test_data(
+            test_data_path, labels_path)
+        baselines = []
+        with open(test_data_path, 'r') as file:
+            csv_reader = csv.reader(file)
+            next(csv_reader)
+            for row in csv_reader:
+                row = [value for value in row if value != '']
+                patient = CreatinineBaselines()
+                for date, result in zip(row[2::2], row[3::2]):
+                    taken_at = datetime.strptime(date, HISTORY_DATE_FORMAT)
+                    patient.push(
+                        (taken_at - RESULT_TIME_EPOCH).total_seconds(),
+                        float(result))
+                baselines.append([np.nan if value is None else value
+                                  for value in patient.features()])
+        latest, minimum, median = np.array(baselines).T
+        with open("models/trained_model.pkl", "rb") as file:
+            model = pickle.load(file)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            rules = fbeta_score(labels, KDIGORules('rules').predict(
+                model, features, latest, minimum, median), beta=3)
+            hybrid = fbeta_score(labels, KDIGORules('hybrid').predict(
+                model, features, latest, minimum, median), beta=3)
+            by_model = fbeta_score(labels, model.predict(features), beta=3)
+        self.assertGreaterEqual(rules, 0.7)
+        # The band was chosen on half of these rows only, with no guarantee
+        # of matching the model on the rest.
+        self.assertAlmostEqual(hybrid, by_model, delta=0.01)
+
+
+class TestBatchScoring(unittest.TestCase):
+    test_data_path = os.getenv("TEST_DATA_PATH", "data/test_data/test_f3.csv")
+    labels_path = os.getenv("LABELS_PATH", "data/test_data/labels_f3.csv")
+
+    def test_chunk_features_match_per_row_features(self):
+        with open(self.test_data_path, 'r') as file:
+            csv_reader = csv.reader(file)
+            next(csv_reader)
+            rows = list(csv_reader)
+        features, labels = TestModelF3Score.load_and_preprocess_test_data(
+            self.test_data_path, self.labels_path)
+        chunk_features, *baselines = csv_chunk_features(rows)
+        np.testing.assert_array_equal(chunk_features, features)
+
+        expected = []
+        for row in rows:
+            row = [value for value in row if value != '']
+            patient = CreatinineBaselines()
+            for date, result in zip(row[2::2], row[3::2]):
+                taken_at = datetime.strptime(date, HISTORY_DATE_FORMAT)
+                patient.push((taken_at - RESULT_TIME_EPOCH).total_seconds(),
+                             float(result))
+            expected.append([np.nan if value is None else value
+                             for value in patient.features()])
+        np.testing.assert_array_equal(np.array(baselines).T, expected)
+
+    def test_batch_score_csv_matches_model(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        output_path = os.path.join(directory.name, "predictions.csv")
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            scored, scores = batch_score_csv(
+                self.test_data_path, output_path, "models/trained_model.pkl",
+                self.labels_path, chunk_size=997)
+            with open("models/trained_model.pkl", "rb") as file:
+                model = pickle.load(file)
+            features, labels = TestModelF3Score.load_and_preprocess_test_data(
+                self.test_data_path, self.labels_path)
+            expected = model.predict(features)
+
+        with open(output_path, 'r') as file:
+            predictions = [row[0] == 'y' for row in list(csv.reader(file))[1:]]
+        self.assertEqual(scored, len(labels))
+        self.assertEqual(predictions, [bool(aki) for aki in expected])
+        self.assertAlmostEqual(scores.f_score(),
+                               fbeta_score(labels, expected, beta=3))
+        self.assertGreaterEqual(scores.f_score(), 0.7)
+
+    def test_batch_score_mllp_finds_the_live_predictions(self):
+        with open("models/trained_model.pkl", "rb") as file:
+            model = pickle.load(file)
+        messages = []
+        for mrn, creatinine in [("777050", 420.0), ("777051", 60.0),
+                                ("777052", 380.0), ("777053", 65.0)]:
+            messages.append(
+                ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                 f"PID|1||{mrn}||JOHN DOE||19500312|M"])
+            messages.append(
+                ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                 f"PID|1||{mrn}",
+                 "OBR|1||||||20240331003200",
+                 f"OBX|1|SN|CREATININE||{creatinine}"])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        db_path = os.path.join(directory.name, "db.db")
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        aki_predictor = AKIPredictor(model, db_path, metrics_count_flag=False)
+        expected = aki_predictor.examine_messages_and_predict_aki(messages)
+        aki_predictor.close()
+
+        history_path = os.path.join(directory.name, "history.csv")
+        with open(history_path, 'w') as file:
+            file.write("mrn,creatinine_date_0,creatinine_result_0\n"
+                       "777050,2024-03-01 09:00:00,80.0\n")
+        snapshot_path = os.path.join(directory.name, "history.db")
+        build_history_snapshot(history_path, snapshot_path)
+        input_path = os.path.join(directory.name, "messages.mllp")
+        with open(input_path, 'wb') as file:
+            file.writelines(to_mllp(message) for message in messages)
+        output_path = os.path.join(directory.name, "predictions.csv")
+        scored = batch_score_mllp(input_path, output_path, model,
+                                  snapshot_path, directory.name,
+                                  chunk_size=3, processes=2)
+
+        with open(output_path, 'r') as file:
+            positives = [(int(index), mrn)
+                         for index, mrn in list(csv.reader(file))[1:]]
+        self.assertEqual(scored, len(messages))
+        self.assertEqual(positives, [(index, mrn) for index, mrn
+                                     in enumerate(expected) if mrn])
+        self.assertTrue(positives, "Some patients should have been predicted")
+
+
+class TestModelReloader(unittest.TestCase):
+    def setUp(self):
+        with open("models/trained_model.pkl", "rb") as file:
+            self.model = pickle.load(file)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.model_path = os.path.join(directory.name, "model.pkl")
+        self.write_model(self.model)
+        self.metrics = {name: unittest.mock.MagicMock() for name in (
+            "MODEL_VERSION", "MODEL_RELOADS", "MODEL_RELOAD_LATENCY")}
+        patcher = patch.multiple("prediction_core", create=True,
+                                 **self.metrics)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        validation = load_validation_set(
+            os.getenv("TEST_DATA_PATH", "data/test_data/test_f3.csv"),
+            os.getenv("LABELS_PATH", "data/test_data/labels_f3.csv"))
+        self.assertIsNotNone(validation)
+        self.reloader = ModelReloader(self.model_path, self.model,
+                                      validation)
+        self.predictor = AKIPredictor(self.model, ":memory:",
+                                      metrics_count_flag=False)
+        self.addCleanup(self.predictor.close)
+        self.reloader.register(self.predictor, self.model)
+
+    def write_model(self, model):
+        with open(self.model_path, "wb") as file:
+            pickle.dump(model, file)
+        # Make the change visible even within the timestamp resolution
+        stat = os.stat(self.model_path)
+        os.utime(self.model_path, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 1_000_000_000))
+
+    def test_valid_model_is_swapped_in(self):
+        self.assertFalse(self.reloader.check(), "Unchanged file")
+        self.write_model(CompiledModel.compile(self.model))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertTrue(self.reloader.check())
+        self.assertIsInstance(self.predictor.model, CompiledModel)
+        self.assertIs(self.reloader.model, self.predictor.model)
+        self.metrics["MODEL_VERSION"].set.assert_called_with(
+            model_version(self.model_path))
+        self.metrics["MODEL_RELOADS"].labels.assert_called_with('swapped')
+        self.assertFalse(self.reloader.check(), "Already swapped in")
+
+        # Targets registered with an older model catch up at once
+        shard = unittest.mock.Mock()
+        self.reloader.register(shard, self.model)
+        shard.swap_model.assert_called_once_with(self.predictor.model)
+
+    def test_invalid_models_are_rejected(self):
+        self.write_model(AlwaysPositiveModel())
+        self.assertFalse(self.reloader.check())
+        self.metrics["MODEL_RELOADS"].labels.assert_called_with('rejected')
+
+        with open(self.model_path, "wb") as file:
+            file.write(b"not a model")
+        self.assertFalse(self.reloader.check())
+        self.metrics["MODEL_RELOADS"].labels.assert_called_with('failed')
+        self.assertIs(self.predictor.model, self.model)
+
+    def test_newer_pickle_is_compiled_over_the_compiled_model(self):
+        compiled_path = f"{self.model_path[:-len('.pkl')]}.npz"
+        compiled = export_model(self.model_path, compiled_path)
+        # The pickle is older than the file compiled from it.
+        stat = os.stat(self.model_path)
+        os.utime(compiled_path, ns=(stat.st_atime_ns,
+                                    stat.st_mtime_ns + 1_000_000_000))
+        reloader = ModelReloader(compiled_path, compiled,
+                                 self.reloader.validation,
+                                 source=self.model_path)
+        reloader.register(self.predictor, self.model)
+        self.assertFalse(reloader.check(), "Pickle already compiled")
+
+        self.write_model(self.model)
+        os.utime(self.model_path, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 2_000_000_000))
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertTrue(reloader.check())
+        self.assertIsInstance(self.predictor.model, CompiledModel)
+        self.assertIsNot(self.predictor.model, compiled)
+        self.metrics["MODEL_VERSION"].set.assert_called_with(
+            model_version(compiled_path))
+        self.assertFalse(reloader.check(), "Already swapped in")
+
+    def test_rejected_pickle_leaves_the_compiled_model(self):
+        compiled_path = f"{self.model_path[:-len('.pkl')]}.npz"
+        compiled = export_model(self.model_path, compiled_path)
+        version = model_version(compiled_path)
+        reloader = ModelReloader(compiled_path, compiled,
+                                 self.reloader.validation,
+                                 source=self.model_path)
+        stat = os.stat(compiled_path)
+        self.write_model(self.model)
+        os.utime(self.model_path, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 2_000_000_000))
+        with patch("prediction_core.CompiledModel.compile",
+                   return_value=AlwaysPositiveModel()):
+            self.assertFalse(reloader.check())
+        self.metrics["MODEL_RELOADS"].labels.assert_called_with('rejected')
+        self.assertEqual(model_version(compiled_path), version)
+        self.assertIs(reloader.model, compiled)
+
+
+class TestColumnarPatientStore(unittest.TestCase):
+    model = None
+
+    @classmethod
+    def setUpClass(cls):
+        with open("models/trained_model.pkl", "rb") as file:
+            cls.model = pickle.load(file)
+        warnings.filterwarnings("ignore", category=UserWarning,
+                                module="sklearn.*")
+
+    def setUp(self):
+        self.store = ColumnarPatientStore(capacity=2)
+        self.rows = {
+            "640400": (33, 0, 107.66, 116.58, 85.98, 100.95, 104.96),
+            "160064": (42, 0, 84.54, 88.10, 76.24, 79.46, 83.36),
+            "999999": (None, None, 150.0, 150.0, 150.0, 150.0, 150.0),
+        }
+        for mrn, row in self.rows.items():
+            self.store.put(mrn, PatientRecord.from_row(row))
+
+    def test_store_grows_and_keeps_rows(self):
+        self.assertEqual(len(self.store), 3)
+        for mrn, row in self.rows.items():
+            self.assertEqual(self.store.get(mrn).row(), row)
+        self.assertIsNone(self.store.get("123"))
+
+    def test_record_updates_store_in_place(self):
+        record = self.store.get("640400")
+        record.push_result(110.0)
+        record.age = 34
+        self.assertEqual(self.store.get("640400").row(),
+                         (34, 0, 110.0, 107.66, 116.58, 85.98, 100.95))
+        self.assertEqual(self.store.age[self.store.index["640400"]], 34)
+
+    def test_features_are_a_view(self):
+        features = self.store.get("160064").features()
+        self.assertTrue(np.shares_memory(features, self.store.features))
+
+    def test_snapshot_and_restore(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.store.snapshot(directory)
+            restored = ColumnarPatientStore.restore(directory)
+        self.assertEqual(len(restored), 3)
+        for mrn, row in self.rows.items():
+            self.assertEqual(restored.get(mrn).row(), row)
+
+    def test_rescore_matches_individual_predictions(self):
+        mrns, predictions = self.store.rescore(self.model)
+        self.assertEqual(list(mrns), ["640400", "160064"],
+                         "Patients without demographics cannot be scored")
+        for mrn, prediction in zip(mrns, predictions):
+            expected = self.model.predict([self.rows[mrn]])[0]
+            self.assertEqual(prediction, expected)
+
+    def test_predictor_uses_columnar_store(self):
+        predictor = AKIPredictor(self.model, db_path=None,
+                                 metrics_count_flag=False,
+                                 patient_store=self.store)
+        mrn = predictor.examine_message_and_predict_aki([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+            "PID|1||160064",
+            "OBR|1||||||20240331003200",
+            "OBX|1|SN|CREATININE||300"
+        ])
+        self.assertEqual(mrn, "160064")
+        self.assertEqual(self.store.get("160064").results()[:2],
+                         (300.0, 84.54))
+
+        predictor.examine_message_and_predict_aki([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+            "PID|1||555555||JOHN SMITH||19900101|M"
+        ])
+        self.assertEqual(self.store.get("555555").sex, 0)
+        self.assertEqual(len(predictor._connections), 0,
+                         "The columnar engine should not open SQLite")
+
+    def test_predictor_writes_store_through_and_undoes_rollbacks(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        predictor = AKIPredictor(self.model, db_path,
+                                 metrics_count_flag=False,
+                                 patient_store=self.store)
+        self.addCleanup(predictor.close)
+        predictor.examine_message_and_predict_aki([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+            "PID|1||555555||JOHN SMITH||19900101|M"
+        ])
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            self.assertEqual(conn.execute(
+                "SELECT sex FROM patient_history WHERE mrn = '555555'"
+            ).fetchone(), (0,), "Updates are written through")
+            conn.execute("""
+                CREATE TRIGGER reject BEFORE INSERT ON patient_history
+                WHEN NEW.mrn IN ('160064', '555556')
+                BEGIN SELECT RAISE(ABORT, 'rejected'); END""")
+            conn.commit()
+
+        # Messages failing after the store was updated leave it unchanged
+        predictor.examine_messages_and_predict_aki([
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+             "PID|1||160064",
+             "OBR|1||||||20240331003200",
+             "OBX|1|SN|CREATININE||300"],
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+             "PID|1||555556||JANE SMITH||19900101|F"]])
+        self.assertEqual(self.store.get("160064").row(), self.rows["160064"])
+        self.assertIsNone(self.store.get("555556"))
+        self.assertEqual(len(self.store), 4)
+
+
 class TestMLLPConversion(unittest.TestCase):
     def test_to_mllp(self):
         ACK = [
@@ -490,6 +1397,905 @@ class TestMLLPConversion(unittest.TestCase):
                          "message segments for the fourth test.")
 
 
+class TestMLLPFrameDecoder(unittest.TestCase):
+    PAS = [
+        "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5",
+        "PID|1||497030||ROSCOE DOHERTY||19870515|M"
+    ]
+    LIMS = [
+        "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+        "PID|1||125412",
+        "OBR|1||||||20240331003200",
+        "OBX|1|SN|CREATININE||127.5695463720204"
+    ]
+
+    def test_single_frame(self):
+        decoder = MLLPFrameDecoder()
+        decoder.feed(to_mllp(self.PAS))
+        self.assertEqual(decoder.decode(), [self.PAS])
+        self.assertEqual(len(decoder), 0, "Buffer should be fully consumed")
+
+    def test_frame_split_across_reads(self):
+        decoder = MLLPFrameDecoder()
+        frame = to_mllp(self.LIMS)
+        for i in range(len(frame) - 1):
+            decoder.feed(frame[i:i + 1])
+            self.assertEqual(decoder.decode(), [], "Partial frame should not "
+                                                   "be decoded")
+        decoder.feed(frame[-1:])
+        self.assertEqual(decoder.decode(), [self.LIMS])
+
+    def test_coalesced_frames_in_one_read(self):
+        decoder = MLLPFrameDecoder()
+        data = to_mllp(self.PAS) + to_mllp(self.LIMS) + to_mllp(self.PAS)
+        decoder.feed(data + to_mllp(self.LIMS)[:10])
+        self.assertEqual(decoder.decode(), [self.PAS, self.LIMS, self.PAS])
+        decoder.feed(to_mllp(self.LIMS)[10:])
+        self.assertEqual(decoder.decode(), [self.LIMS])
+
+    def test_noise_before_start_of_block_is_discarded(self):
+        decoder = MLLPFrameDecoder()
+        decoder.feed(b"\r\n" + to_mllp(self.PAS))
+        self.assertEqual(decoder.decode(), [self.PAS])
+
+    @patch('prediction_core.logging.error')
+    def test_frame_without_end_marker_is_dropped(self, mock_log_error):
+        decoder = MLLPFrameDecoder()
+        decoder.feed(to_mllp(self.PAS)[:20] + to_mllp(self.LIMS))
+        self.assertEqual(decoder.decode(), [self.LIMS])
+        mock_log_error.assert_called_once()
+        self.assertEqual(len(decoder), 0)
+
+        # Also when the new frame has not been received in full yet.
+        mock_log_error.reset_mock()
+        decoder.feed(to_mllp(self.LIMS)[:20] + to_mllp(self.PAS)[:10])
+        self.assertEqual(decoder.decode(), [])
+        decoder.feed(to_mllp(self.PAS)[10:])
+        self.assertEqual(decoder.decode(), [self.PAS])
+        mock_log_error.assert_called_once()
+
+    def test_frame_larger_than_buffer(self):
+        decoder = MLLPFrameDecoder(buffer_size=16)
+        large = self.LIMS + ["NTE|1||" + "X" * 5000]
+        decoder.feed(to_mllp(self.PAS))
+        decoder.feed(to_mllp(large))
+        self.assertEqual(decoder.decode(), [self.PAS, large])
+
+    def test_recv_from_socket(self):
+        sender, receiver = socket.socketpair()
+        with sender, receiver:
+            sender.sendall(to_mllp(self.PAS) + to_mllp(self.LIMS))
+            decoder = MLLPFrameDecoder()
+            messages = []
+            while len(messages) < 2:
+                self.assertGreater(decoder.recv_from(receiver), 0)
+                messages += decoder.decode()
+            self.assertEqual(messages, [self.PAS, self.LIMS])
+
+
+class TestPagerDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.db_file, self.db_path = tempfile.mkstemp(suffix='.db')
+        self.sent = []
+
+    def tearDown(self):
+        os.close(self.db_file)
+        os.remove(self.db_path)
+
+    def send(self, failures):
+        # Fails the first `failures` attempts for every MRN
+        def send(mrn):
+            self.sent.append(mrn)
+            return self.sent.count(mrn) > failures
+        return send
+
+    def test_failed_pages_are_retried_once_per_mrn(self):
+        dispatcher = PagerDispatcher("pager", retry_delay=0.001,
+                                     metrics_count_flag=False,
+                                     send=self.send(failures=2))
+        dispatcher.submit("640400")
+        dispatcher.submit("640400")
+        dispatcher.submit("822825")
+        dispatcher.start()
+        self.assertTrue(dispatcher.join(timeout=5))
+        dispatcher.close()
+
+        self.assertEqual(self.sent.count("640400"), 3, "A duplicate page "
+                                                       "should be dropped")
+        self.assertEqual(self.sent.count("822825"), 3)
+
+    def test_abandons_page_after_max_retries(self):
+        dispatcher = PagerDispatcher("pager", self.db_path, max_retries=4,
+                                     retry_delay=0.001,
+                                     metrics_count_flag=False,
+                                     send=self.send(failures=10))
+        dispatcher.start()
+        dispatcher.submit("640400")
+        self.assertTrue(dispatcher.join(timeout=5))
+        dispatcher.close()
+        self.assertEqual(self.sent, ["640400"] * 4)
+
+        conn = sqlite3.connect(self.db_path)
+        count = conn.execute("SELECT COUNT(*) FROM pending_pages").fetchone()
+        conn.close()
+        self.assertEqual(count[0], 0, "Abandoned pages should be removed")
+
+    def test_send_exceptions_count_as_failed_attempts(self):
+        def send(mrn):
+            self.sent.append(mrn)
+            if len(self.sent) < 3:
+                raise RuntimeError("pager client bug")
+            return True
+
+        dispatcher = PagerDispatcher("pager", retry_delay=0.001, workers=1,
+                                     metrics_count_flag=False, send=send)
+        dispatcher.start()
+        with self.assertLogs(level="ERROR"):
+            dispatcher.submit("640400")
+            self.assertTrue(dispatcher.join(timeout=5))
+        # The worker survived to deliver later pages.
+        dispatcher.submit("822825")
+        self.assertTrue(dispatcher.join(timeout=5))
+        dispatcher.close()
+        self.assertEqual(self.sent, ["640400"] * 3 + ["822825"])
+
+    def test_undelivered_pages_survive_restart(self):
+        dispatcher = PagerDispatcher("pager", self.db_path, queue_size=1,
+                                     metrics_count_flag=False,
+                                     send=self.send(failures=0))
+        dispatcher.submit("640400")
+        dispatcher.submit("822825")
+        dispatcher.close()
+        self.assertEqual(self.sent, [])
+
+        dispatcher = PagerDispatcher("pager", self.db_path, queue_size=1,
+                                     metrics_count_flag=False,
+                                     send=self.send(failures=0))
+        dispatcher.start()
+        self.assertTrue(dispatcher.join(timeout=5))
+        dispatcher.close()
+        self.assertEqual(self.sent, ["640400", "822825"])
+
+    def test_full_queue_without_database_drops_page(self):
+        dispatcher = PagerDispatcher("pager", queue_size=1,
+                                     metrics_count_flag=False,
+                                     send=self.send(failures=0))
+        self.assertTrue(dispatcher.submit("640400"))
+        self.assertFalse(dispatcher.submit("822825"))
+        dispatcher.close()
+
+
+class KeepAlivePagerHandler(http.server.BaseHTTPRequestHandler):
+    """Minimal HTTP/1.1 pager that keeps connections open between pages."""
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    # Idle connections are closed by the server quickly
+    timeout = 0.2
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.send_response(200)
+        self.send_header("Content-Length", "3")
+        self.end_headers()
+        self.wfile.write(b"ok\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPagerConnectionPool(unittest.TestCase):
+    def start_pager(self, handler):
+        connections = []
+
+        def new_handler(request, client_address, server):
+            connections.append(client_address)
+            return handler(request, client_address, server)
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                 new_handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        pool = PagerConnectionPool(f"127.0.0.1:{server.server_address[1]}",
+                                   metrics_count_flag=False)
+        self.addCleanup(pool.close)
+        return pool, connections
+
+    def test_keep_alive_connection_is_reused(self):
+        pool, connections = self.start_pager(KeepAlivePagerHandler)
+        for mrn in ("640400", "822825", "125412"):
+            self.assertTrue(pool.send(mrn))
+        self.assertEqual(len(connections), 1, "Pages should share one "
+                                              "keep-alive connection")
+
+    def test_reconnects_after_server_closes_connection(self):
+        pool, connections = self.start_pager(KeepAlivePagerHandler)
+        self.assertTrue(pool.send("640400"))
+        time.sleep(0.5)
+        self.assertTrue(pool.send("822825"), "A stale connection should be "
+                                             "replaced transparently")
+        self.assertEqual(len(connections), 2)
+
+    @unittest.skipIf(simulator is None, "simulator.py is not available")
+    def test_simulator_pager(self):
+        pool, connections = self.start_pager(
+            lambda *args: simulator.PagerRequestHandler(lambda: None, *args))
+        self.assertTrue(pool.send("640400"))
+        self.assertTrue(pool.send("822825"))
+        self.assertFalse(pool.send("not-an-mrn"))
+        # The simulator closes the connection after every response
+        self.assertEqual(len(connections), 3)
+
+    def test_unreachable_pager(self):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        pool = PagerConnectionPool(f"127.0.0.1:{port}",
+                                   metrics_count_flag=False)
+        self.assertFalse(pool.send("640400"))
+
+    def test_invalid_address_is_rejected_on_construction(self):
+        for address in ("pager", "pager:", "pager:port", ":8441"):
+            with self.assertRaises(ValueError):
+                PagerConnectionPool(address, metrics_count_flag=False)
+        self.assertEqual(parse_pager_address("pager:8441"), ("pager", 8441))
+
+
+class AlwaysPositiveModel:
+    def predict(self, features):
+        return np.ones(len(features), dtype=int)
+
+
+class TestAsyncEngine(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db_file, self.db_path = tempfile.mkstemp(suffix='.db')
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0),
+                                                 KeepAlivePagerHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.pager_address = f"127.0.0.1:{server.server_address[1]}"
+
+    def tearDown(self):
+        os.close(self.db_file)
+        os.remove(self.db_path)
+
+    async def test_pool_reuses_keep_alive_connection(self):
+        pool = AsyncPagerConnectionPool(self.pager_address,
+                                        metrics_count_flag=False)
+        for mrn in ("640400", "822825", "125412"):
+            self.assertTrue(await pool.send(mrn))
+        self.assertEqual(len(pool._idle), 1)
+        pool.close()
+
+    async def test_dispatcher_retries_failed_pages(self):
+        sent = []
+
+        async def send(mrn):
+            sent.append(mrn)
+            return sent.count(mrn) > 2
+
+        dispatcher = AsyncPagerDispatcher("pager", self.db_path,
+                                          retry_delay=0.001,
+                                          metrics_count_flag=False, send=send)
+        await dispatcher.start()
+        await dispatcher.submit("640400")
+        await dispatcher.submit("640400")
+        await asyncio.wait_for(dispatcher.join(), 5)
+        await dispatcher.close()
+        self.assertEqual(sent, ["640400"] * 3)
+
+    async def test_dispatcher_retries_pages_whose_send_raises(self):
+        sent = []
+
+        async def send(mrn):
+            sent.append(mrn)
+            if len(sent) < 2:
+                raise RuntimeError("pager client bug")
+            return True
+
+        dispatcher = AsyncPagerDispatcher("pager", self.db_path,
+                                          retry_delay=0.001,
+                                          metrics_count_flag=False, send=send)
+        await dispatcher.start()
+        with self.assertLogs(level="ERROR"):
+            await dispatcher.submit("640400")
+            await asyncio.wait_for(dispatcher.join(), 5)
+        await dispatcher.close()
+        self.assertEqual(sent, ["640400"] * 2)
+
+    @staticmethod
+    def admission_and_high_creatinine(mrn):
+        return [
+            to_mllp(["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                     f"PID|1||{mrn}||JOHN DOE||19500312|M"]),
+            to_mllp(["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                     f"PID|1||{mrn}",
+                     "OBR|1||||||20240331003200",
+                     "OBX|1|SN|CREATININE||420.0"]),
+        ]
+
+    async def run_feeds(self, feeds):
+        """Serves each list of MLLP messages as a feed until all are ACKed.
+
+        Returns:
+            tuple: The paged MRNs, the patched metrics and the feed names.
+        """
+        ack = to_mllp(ACK)
+        servers = []
+        for messages in feeds:
+            acknowledged = asyncio.Event()
+
+            async def serve(reader, writer, messages=messages,
+                            acknowledged=acknowledged):
+                writer.write(b"".join(messages))
+                await reader.readexactly(len(ack) * len(messages))
+                acknowledged.set()
+                writer.close()
+
+            server = await asyncio.start_server(serve, "127.0.0.1", 0)
+            self.addAsyncCleanup(server.wait_closed)
+            self.addCleanup(server.close)
+            servers.append((server, acknowledged))
+        paged = []
+
+        async def send(mrn):
+            paged.append(mrn)
+            return True
+
+        registry = prometheus_client.CollectorRegistry()
+        metrics = {name: unittest.mock.MagicMock() for name in (
+            "MESSAGES_RECEIVED", "MESSAGES_ACKNOWLEDGED",
+            "MLLP_SOCKET_CONNECTIONS", "FEED_ACKNOWLEDGEMENT_LAG",
+            "FEED_RECONNECTIONS")}
+        for name in ("FEED_MESSAGES_RECEIVED", "FEED_MESSAGES_ACKNOWLEDGED"):
+            metrics[name] = prometheus_client.Counter(
+                name.lower(), name, ["feed"], registry=registry)
+        pipeline = asyncio.Queue()
+        with patch.multiple("prediction_core", create=True, **metrics):
+            tasks = [asyncio.create_task(async_processor(
+                "pager", AlwaysPositiveModel(), pipeline,
+                ProcessingOptions(self.db_path, batch_size=4,
+                                  metrics_count_flag=False),
+                pager_send=send))]
+            tasks += [asyncio.create_task(async_message_receiver(
+                server.sockets[0].getsockname(), pipeline))
+                for server, _ in servers]
+            for _, acknowledged in servers:
+                await asyncio.wait_for(acknowledged.wait(), 5)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        names = ["%s:%d" % server.sockets[0].getsockname()[:2]
+                 for server, _ in servers]
+        return paged, metrics, names
+
+    async def test_messages_are_acknowledged_and_paged(self):
+        messages = [message for mrn in ("777020", "777021", "777022")
+                    for message in self.admission_and_high_creatinine(mrn)]
+        paged, metrics, _ = await self.run_feeds([messages])
+
+        self.assertEqual(sorted(paged), ["777020", "777021", "777022"])
+        acknowledgements = metrics["MESSAGES_ACKNOWLEDGED"].inc.call_args_list
+        self.assertEqual(sum(call.args[0] for call in acknowledgements),
+                         len(messages))
+
+    async def test_feeds_share_one_pipeline(self):
+        feeds = [self.admission_and_high_creatinine("777030"),
+                 self.admission_and_high_creatinine("777031")
+                 + self.admission_and_high_creatinine("777032")]
+        paged, metrics, names = await self.run_feeds(feeds)
+
+        self.assertEqual(sorted(paged), ["777030", "777031", "777032"])
+        received = metrics["FEED_MESSAGES_RECEIVED"]
+        acknowledged = metrics["FEED_MESSAGES_ACKNOWLEDGED"]
+        for feed, messages in zip(names, feeds):
+            self.assertEqual(received.labels(feed)._value.get(),
+                             len(messages))
+            self.assertEqual(acknowledged.labels(feed)._value.get(),
+                             len(messages))
+
+
+class CountingQueue(queue.Queue):
+    """A queue that counts how often it is read."""
+
+    def __init__(self):
+        super().__init__()
+        self.gets = 0
+
+    def get(self, *args, **kwargs):
+        self.gets += 1
+        return super().get(*args, **kwargs)
+
+
+class TestMessageHandoff(unittest.TestCase):
+    """The receiver and processor hand messages over without polling."""
+
+    def setUp(self):
+        self.message_queue = CountingQueue()
+        patcher = patch("prediction_system.message_queue", self.message_queue)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(stop_event.clear)
+
+    def test_processor_blocks_on_empty_queue(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        with patch("prediction_system.PagerDispatcher"):
+            thread = threading.Thread(
+                target=processor, args=("pager", AlwaysPositiveModel(),
+                                        ProcessingOptions(db_path)),
+                daemon=True)
+            thread.start()
+            time.sleep(1)
+            # A busy loop would have read the queue thousands of times.
+            self.assertLessEqual(self.message_queue.gets,
+                                 1 / STOP_POLL_INTERVAL + 1)
+
+            # The blocked processor wakes as soon as a message arrives.
+            queued = QueuedMessage(
+                ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                 "PID|1||777040||JOHN DOE||19500312|M"])
+            self.message_queue.put(queued)
+            self.assertTrue(queued.processed.wait(STOP_POLL_INTERVAL / 2))
+            stop_event.set()
+            thread.join(timeout=5)
+
+    def test_receiver_acknowledges_in_arrival_order(self):
+        ack = to_mllp(ACK)
+        metrics = {name: unittest.mock.MagicMock() for name in (
+            "MESSAGES_RECEIVED", "MESSAGES_ACKNOWLEDGED",
+            "MLLP_SOCKET_CONNECTIONS", "FEED_MESSAGES_RECEIVED",
+            "FEED_MESSAGES_ACKNOWLEDGED", "FEED_ACKNOWLEDGEMENT_LAG",
+            "FEED_RECONNECTIONS")}
+        with socket.create_server(("127.0.0.1", 0)) as server, \
+                patch.multiple("prediction_core", create=True, **metrics):
+            thread = threading.Thread(
+                target=message_receiver, args=(server.getsockname(),),
+                daemon=True)
+            thread.start()
+            connection, _ = server.accept()
+            with connection:
+                connection.sendall(b"".join(
+                    to_mllp(["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||"
+                             "20240331003200||ADT^A01|||2.5",
+                             f"PID|1||77705{index}||JOHN DOE||19500312|M"])
+                    for index in range(3)))
+                queued = [self.message_queue.get(timeout=5)
+                          for _ in range(3)]
+                self.assertEqual([item.segments[1][7:13] for item in queued],
+                                 ["777050", "777051", "777052"])
+
+                # Later messages finishing first are held back.
+                queued[2].processed.set()
+                queued[1].processed.set()
+                connection.settimeout(0.5)
+                with self.assertRaises(socket.timeout):
+                    connection.recv(1024)
+
+                queued[0].processed.set()
+                connection.settimeout(5)
+                received = b""
+                while len(received) < 3 * len(ack):
+                    received += connection.recv(1024)
+                self.assertEqual(received, ack * 3)
+                stop_event.set()
+            thread.join(timeout=5)
+
+
+class TestCommitFailures(unittest.TestCase):
+    """Windows whose COMMIT fails must be neither paged nor acknowledged."""
+
+    def setUp(self):
+        db_file, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, self.db_path)
+        # Every new patient breaks a deferred foreign key, which fails
+        # the COMMIT of its transaction rather than the INSERT.
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+            conn.executescript("""
+                CREATE TABLE guard_parent (mrn TEXT PRIMARY KEY);
+                CREATE TABLE guard (mrn TEXT REFERENCES guard_parent (mrn)
+                                    DEFERRABLE INITIALLY DEFERRED);
+                CREATE TRIGGER break_commits AFTER INSERT ON patient_history
+                BEGIN INSERT INTO guard VALUES (NEW.mrn); END;
+            """)
+        patcher = patch("prediction_core.SQLITE_CONNECTION_PRAGMAS",
+                        SQLITE_CONNECTION_PRAGMAS + ("PRAGMA foreign_keys=ON",))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(stop_event.clear)
+        self.messages = [
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+             "PID|1||777060||JOHN DOE||19500312|M"],
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+             "PID|1||777060",
+             "OBR|1||||||20240331003200",
+             "OBX|1|SN|CREATININE||420.0"]]
+
+    def repair_commits(self):
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute("DROP TRIGGER break_commits")
+
+    def test_failed_commit_raises_and_rolls_back(self):
+        aki_predictor = AKIPredictor(AlwaysPositiveModel(), self.db_path,
+                                     metrics_count_flag=False)
+        self.addCleanup(aki_predictor.close)
+        with self.assertRaises(CommitError):
+            aki_predictor.examine_messages_and_predict_aki(self.messages)
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(*) FROM patient_history").fetchone()[0], 0)
+
+        self.repair_commits()
+        self.assertEqual(
+            aki_predictor.examine_messages_and_predict_aki(self.messages),
+            [None, "777060"])
+
+    def test_locked_database_raises_instead_of_dropping_messages(self):
+        self.repair_commits()
+        aki_predictor = AKIPredictor(AlwaysPositiveModel(), self.db_path,
+                                     metrics_count_flag=False)
+        self.addCleanup(aki_predictor.close)
+        with contextlib.closing(sqlite3.connect(
+                self.db_path, isolation_level=None)) as writer:
+            writer.execute("BEGIN IMMEDIATE")
+            with patch("prediction_core.SQLITE_BUSY_TIMEOUT_PER_WRITER",
+                       0.05):
+                with self.assertRaises(CommitError):
+                    aki_predictor.examine_messages_and_predict_aki(
+                        self.messages)
+            writer.execute("ROLLBACK")
+            self.assertEqual(writer.execute(
+                "SELECT COUNT(*) FROM patient_history").fetchone()[0], 0)
+
+        self.assertEqual(
+            aki_predictor.examine_messages_and_predict_aki(self.messages),
+            [None, "777060"])
+
+    def test_processor_withholds_window_until_committed(self):
+        window = [QueuedMessage(message) for message in self.messages]
+        for queued in window:
+            message_queue.put(queued)
+        with patch("prediction_system.PagerDispatcher") as dispatcher_class:
+            thread = threading.Thread(
+                target=processor,
+                args=("pager", AlwaysPositiveModel(),
+                      ProcessingOptions(self.db_path, batch_size=2)),
+                daemon=True)
+            thread.start()
+            time.sleep(0.5)
+            dispatcher = dispatcher_class.return_value
+            self.assertFalse(any(queued.processed.is_set()
+                                 for queued in window))
+            dispatcher.submit.assert_not_called()
+
+            self.repair_commits()
+            for queued in window:
+                self.assertTrue(queued.processed.wait(timeout=5))
+            stop_event.set()
+            thread.join(timeout=5)
+        dispatcher.submit.assert_called_once_with("777060")
+
+    def test_async_processor_withholds_window_until_committed(self):
+        paged = []
+
+        async def send(mrn):
+            paged.append(mrn)
+            return True
+
+        async def run():
+            pipeline = asyncio.Queue()
+            window = [AsyncQueuedMessage(message)
+                      for message in self.messages]
+            for queued in window:
+                pipeline.put_nowait(queued)
+            task = asyncio.create_task(async_processor(
+                "pager", AlwaysPositiveModel(), pipeline,
+                ProcessingOptions(self.db_path, batch_size=2,
+                                  metrics_count_flag=False),
+                pager_send=send))
+            await asyncio.sleep(0.5)
+            self.assertFalse(any(queued.processed.done()
+                                 for queued in window))
+            self.assertEqual(paged, [])
+
+            self.repair_commits()
+            await asyncio.wait_for(asyncio.gather(
+                *(queued.processed for queued in window)), 5)
+            stop_event.set()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(run())
+        self.assertEqual(paged, ["777060"])
+
+
+class TestPendingPredictions(unittest.TestCase):
+    def setUp(self):
+        db_file, self.db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, self.db_path)
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+
+    def predictor(self):
+        aki_predictor = AKIPredictor(AlwaysPositiveModel(), self.db_path,
+                                     metrics_count_flag=False)
+        self.addCleanup(aki_predictor.close)
+        return aki_predictor
+
+    @staticmethod
+    def admission(mrn):
+        return ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                f"PID|1||{mrn}||JOHN DOE||19500312|M"]
+
+    @staticmethod
+    def creatinine(mrn):
+        return ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                f"PID|1||{mrn}",
+                "OBR|1||||||20240331003200",
+                "OBX|1|SN|CREATININE||420.0"]
+
+    def test_pending_prediction_survives_a_restart(self):
+        before = self.predictor()
+        self.assertIsNone(before.examine_message_and_predict_aki(
+            self.creatinine("555001")))
+        before.close()
+
+        after = self.predictor()
+        self.assertEqual(after.resume_pending_predictions(), [])
+        self.assertIn("555001", after.pending_predictions)
+        self.assertEqual(after.examine_message_and_predict_aki(
+            self.admission("555001")), "555001")
+        self.assertNotIn("555001", after.pending_predictions)
+
+        restarted = self.predictor()
+        restarted.resume_pending_predictions()
+        self.assertEqual(len(restarted.pending_predictions), 0)
+
+    @patch('prediction_core.logging.info')
+    def test_expired_pending_prediction_is_not_scored(self, mock_log_info):
+        aki_predictor = self.predictor()
+        aki_predictor.examine_message_and_predict_aki(
+            self.creatinine("555002"))
+        aki_predictor.pending_predictions.ttl = 0.0
+        time.sleep(0.01)
+
+        self.assertIsNone(aki_predictor.examine_message_and_predict_aki(
+            self.admission("555002")))
+        self.assertNotIn("555002", aki_predictor.pending_predictions)
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            self.assertEqual(conn.execute(
+                "SELECT COUNT(*) FROM pending_predictions").fetchone(), (0,))
+
+    def test_resume_scores_patients_admitted_meanwhile(self):
+        self.predictor().examine_messages_and_predict_aki(
+            [self.creatinine("555003"), self.creatinine("555004")])
+        with contextlib.closing(sqlite3.connect(self.db_path)) as conn:
+            conn.execute("UPDATE patient_history SET age = 74, sex = 0 "
+                         "WHERE mrn = '555003'")
+            conn.commit()
+
+        aki_predictor = self.predictor()
+        self.assertEqual(aki_predictor.resume_pending_predictions(),
+                         ["555003"])
+        self.assertEqual(list(aki_predictor.pending_predictions), ["555004"])
+
+
+class TestShardedProcessing(unittest.TestCase):
+    def test_message_shard_follows_mrn(self):
+        message = ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                   "PID|1||640400||JOHN DOE||19500312|M"]
+        self.assertEqual(message_shard(message, 4), mrn_shard("640400", 4))
+        self.assertEqual(mrn_shard("640400", 4), zlib.crc32(b"640400") % 4,
+                         "Shards must not depend on the process")
+        self.assertEqual(message_shard(message[:1], 4), 0)
+
+    def test_shards_page_like_a_single_processor(self):
+        with open("models/trained_model.pkl", "rb") as file:
+            model = pickle.load(file)
+        messages = []
+        for mrn, creatinine in [("777040", 420.0), ("777041", 60.0),
+                                ("777042", 380.0), ("777043", 65.0),
+                                ("777044", 450.0), ("777045", 70.0)]:
+            messages.append(
+                ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+                 f"PID|1||{mrn}||JOHN DOE||19500312|M"])
+            messages.append(
+                ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+                 f"PID|1||{mrn}",
+                 "OBR|1||||||20240331003200",
+                 f"OBX|1|SN|CREATININE||{creatinine}"])
+
+        expected_path, sharded_path = (self.new_database(),
+                                       self.new_database())
+        aki_predictor = AKIPredictor(model, expected_path,
+                                     metrics_count_flag=False)
+        expected = aki_predictor.examine_messages_and_predict_aki(messages)
+        aki_predictor.close()
+
+        dispatcher = unittest.mock.Mock()
+        metrics = ProcessingMetrics()
+        context = multiprocessing.get_context("spawn")
+        with patch("prediction_core.PROCESSING_METRICS", metrics):
+            shards = [ProcessingShard(context, shard, 2, model, dispatcher,
+                                      sharded_path, 1000, None)
+                      for shard in range(2)]
+            self.assertTrue(all([shard.wait_started() for shard in shards]))
+            window = [QueuedMessage(message) for message in messages]
+            for index, shard in enumerate(shards):
+                shard.submit([queued for queued in window
+                              if message_shard(queued.segments, 2) == index])
+            for queued in window:
+                self.assertTrue(queued.processed.wait(timeout=10))
+            for shard in shards:
+                shard.close()
+
+        paged = [call.args[0] for call in dispatcher.submit.call_args_list]
+        self.assertEqual(sorted(paged), sorted(mrn for mrn in expected if mrn))
+        self.assertTrue(paged, "Some patients should have been paged")
+        # The workers' metrics are merged into this process.
+        counts = collections.Counter()
+        for batch in metrics._batches:
+            counts.update(batch.counts)
+        self.assertEqual(counts['messages_processed'], len(messages))
+        self.assertEqual(counts['positive_aki_predictions'], len(paged))
+        self.assertEqual(metrics.statistics()['total'].count, 6)
+
+    def new_database(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        return db_path
+
+
+class TestIngestLog(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.messages = [
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+             f"PID|1||{mrn}||JOHN DOE||19500312|M"]
+            for mrn in ("640400", "822825", "125412")]
+
+    def open_log(self, **kwargs):
+        log = IngestLog(self.directory, **kwargs)
+        self.addCleanup(log.close)
+        return log
+
+    def test_read_returns_appended_messages_in_order(self):
+        log = self.open_log()
+        log.append(self.messages[:2])
+        log.append(self.messages[2:])
+        records = log.read(log.start(), 10, timeout=0)
+        self.assertEqual([segments for segments, _ in records], self.messages)
+        self.assertEqual(log.read(records[-1][1], 10, timeout=0), [])
+
+    def test_read_resumes_from_position(self):
+        log = self.open_log()
+        log.append(self.messages)
+        first = log.read(log.start(), 1, timeout=0)
+        self.assertEqual(len(first), 1)
+        rest = log.read(first[0][1], 10, timeout=0)
+        self.assertEqual([segments for segments, _ in rest], self.messages[1:])
+
+    def test_segments_rotate_and_are_discarded(self):
+        log = self.open_log(segment_size=1)
+        for message in self.messages:
+            log.append([message])
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+        records = log.read(log.start(), 10, timeout=0)
+        self.assertEqual([segments for segments, _ in records], self.messages)
+        log.discard_before(records[-1][1])
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ["00000003.log", "00000004.log"])
+
+    @patch('prediction_core.logging.error')
+    def test_torn_record_after_crash_is_skipped(self, mock_log_error):
+        log = IngestLog(self.directory)
+        log.append(self.messages[:2])
+        log.close()
+        with open(os.path.join(self.directory, "00000001.log"), "r+b") as f:
+            f.truncate(os.path.getsize(f.name) - 5)
+
+        log = self.open_log()
+        log.append(self.messages[2:])
+        records = log.read(log.start(), 10, timeout=0)
+        self.assertEqual([segments for segments, _ in records],
+                         [self.messages[0], self.messages[2]])
+        mock_log_error.assert_called_once()
+
+    def test_position_is_committed_with_messages(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        aki_predictor = AKIPredictor(None, db_path, metrics_count_flag=False)
+        self.addCleanup(aki_predictor.close)
+        self.assertIsNone(aki_predictor.load_ingest_position())
+
+        aki_predictor.examine_messages_and_predict_aki(self.messages,
+                                                       commit=False)
+        aki_predictor.record_ingest_position((1, 300))
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(INGEST_POSITION_TABLE_SQL)
+            self.assertIsNone(conn.execute(
+                "SELECT segment FROM ingest_position").fetchone())
+        aki_predictor.commit()
+        self.assertEqual(aki_predictor.load_ingest_position(), (1, 300))
+
+    def test_pages_are_committed_with_position(self):
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(db_file)
+        self.addCleanup(os.remove, db_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+        log = self.open_log()
+        log.append([
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ADT^A01|||2.5",
+             "PID|1||777060||JOHN DOE||19500312|M"],
+            ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+             "PID|1||777060",
+             "OBR|1||||||20240331003200",
+             "OBX|1|SN|CREATININE||420.0"]])
+        self.addCleanup(stop_event.clear)
+
+        # The process dies after the commit, before the dispatcher is told.
+        class Crash(Exception):
+            pass
+
+        with patch("prediction_system.PagerDispatcher") as dispatcher_class:
+            dispatcher_class.return_value.submit.side_effect = Crash
+            log_processor("pager", AlwaysPositiveModel(), log,
+                          ProcessingOptions(db_path, batch_size=2))
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            self.assertEqual(conn.execute(
+                "SELECT mrn FROM pending_pages").fetchall(), [("777060",)])
+
+        # A dispatcher on the same database resumes the page.
+        sent = []
+        dispatcher = PagerDispatcher("pager", db_path,
+                                     metrics_count_flag=False,
+                                     send=lambda mrn: sent.append(mrn) or True)
+        dispatcher.start()
+        self.assertTrue(dispatcher.join(timeout=5))
+        dispatcher.close()
+        self.assertEqual(sent, ["777060"])
+
+
+class TestParseMLLPAddresses(unittest.TestCase):
+    def test_single_address(self):
+        self.assertEqual(parse_mllp_addresses("localhost:8440"),
+                         [("localhost", 8440)])
+
+    def test_several_feeds(self):
+        self.assertEqual(
+            parse_mllp_addresses("lims-a:8440, lims-b:8440,pas:8450,"),
+            [("lims-a", 8440), ("lims-b", 8440), ("pas", 8450)])
+
+    def test_invalid_address(self):
+        with self.assertRaises(ValueError):
+            parse_mllp_addresses("localhost")
+        with self.assertRaises(ValueError):
+            parse_mllp_addresses(" , ")
+
+    def test_invalid_port(self):
+        for value in ("localhost:", "localhost:abc", "lims-a:8440,pas:-1"):
+            with self.assertRaisesRegex(ValueError, "Invalid MLLP address"):
+                parse_mllp_addresses(value)
+
+
 class TestPreloadHistoryToSQLite(unittest.TestCase):
     db_path = None
     db_file = None
@@ -605,6 +2411,97 @@ class TestPreloadHistoryToSQLite(unittest.TestCase):
         conn3.commit()
         conn3.close()
 
+    def test_history_snapshot_serves_patients_missing_from_database(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        snapshot_path = os.path.join(directory.name, "history.db")
+        db_path = os.path.join(directory.name, "live.db")
+        history_csv_path = os.getenv("HISTORY_CSV_PATH",
+                                     "data/hospital-history/history.csv")
+        rows = build_history_snapshot(history_csv_path, snapshot_path)
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            conn.execute(PATIENT_HISTORY_TABLE_SQL)
+
+        # Without demographics no prediction is made, so no model is needed
+        predictor = AKIPredictor(None, db_path, metrics_count_flag=False,
+                                 history_snapshot=snapshot_path)
+        self.addCleanup(predictor.close)
+        self.assertEqual(predictor.warm_cache(), rows)
+        predictor.cache = PatientCache(10)
+
+        expected = self.conn.execute(
+            "SELECT test_1, test_2, test_3, test_4 FROM patient_history "
+            "WHERE mrn = '822825'").fetchone()
+        predictor.examine_message_and_predict_aki([
+            "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240331003200||ORU^R01|||2.5",
+            "PID|1||822825",
+            "OBR|1||||||20240331003200",
+            "OBX|1|SN|CREATININE||99.5"
+        ])
+
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            live = conn.execute(
+                "SELECT test_1, test_2, test_3, test_4, test_5 "
+                "FROM patient_history WHERE mrn = '822825'").fetchone()
+        self.assertEqual(live, (99.5, *expected), "The patient's history "
+                                                  "should come from the "
+                                                  "snapshot")
+        with contextlib.closing(sqlite3.connect(snapshot_path)) as conn:
+            self.assertEqual(conn.execute(
+                "SELECT test_1 FROM patient_history WHERE mrn = '822825'"
+            ).fetchone()[0], expected[0], "The snapshot is read-only")
+
+        predictor.cache = PatientCache(10)
+        record = predictor._load_patient(predictor._connection().cursor(),
+                                         "822825")
+        self.assertEqual(record.results()[0], 99.5, "The database should "
+                                                    "take precedence")
+
+    def test_latest_results_are_padded_with_mean(self):
+        nan = np.nan
+        results = np.array([
+            [1.0, 2.0, 3.0, 4.0, 5.0, 6.0],
+            [10.0, 20.0, nan, nan, nan, nan],
+            [nan, nan, nan, nan, nan, nan],
+            [7.0, nan, 8.0, nan, nan, nan],
+        ])
+        np.testing.assert_array_equal(latest_results(results), [
+            [6.0, 5.0, 4.0, 3.0, 2.0],
+            [20.0, 10.0, 15.0, 15.0, 15.0],
+            [0.0, 0.0, 0.0, 0.0, 0.0],
+            [8.0, 7.0, 7.5, 7.5, 7.5],
+        ])
+
+    def test_chunked_load_matches_row_by_row_parsing(self):
+        history_csv_path = os.getenv("HISTORY_CSV_PATH",
+                                     "data/hospital-history/history.csv")
+        expected = {}
+        with open(history_csv_path, 'r') as file:
+            csv_reader = csv.reader(file)
+            next(csv_reader)
+            for row in csv_reader:
+                test_results = list(map(float, [
+                    value for value in row if value != ''][2::2]))[::-1]
+                if len(test_results) < 5:
+                    average_result = statistics.mean(test_results) \
+                        if test_results else 0
+                    test_results += [average_result] * (5 - len(test_results))
+                expected[row[0]] = tuple(test_results[:5])
+
+        db_file, db_path = tempfile.mkstemp(suffix='.db')
+        self.addCleanup(os.remove, db_path)
+        os.close(db_file)
+        rows = preload_history_to_sqlite(db_path, history_csv_path,
+                                         chunk_size=100)
+        self.assertEqual(rows, sum(1 for _ in open(history_csv_path)) - 1)
+
+        conn = sqlite3.connect(db_path)
+        loaded = {row[0]: row[1:] for row in conn.execute(
+            "SELECT mrn, test_1, test_2, test_3, test_4, test_5 "
+            "FROM patient_history")}
+        conn.close()
+        self.assertEqual(loaded, expected)
+
 
 class TestModelF3Score(unittest.TestCase):
     @classmethod
@@ -670,6 +2567,24 @@ class TestModelF3Score(unittest.TestCase):
         self.assertGreaterEqual(f3_score, 0.7, f"F3 score is below the 70% "
                                                f"threshold: {f3_score}")
 
+    def test_compiled_model_matches_pickled_model(self):
+        compiled = CompiledModel.compile(self.model)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "model.npz")
+            compiled.save(path)
+            loaded = CompiledModel.load(path)
+
+        expected = self.model.predict(self.X_test)
+        self.assertEqual(loaded.predict(self.X_test).tolist(),
+                         expected.tolist(), "The compiled model should make "
+                                            "the same predictions")
+
+        # Unknown results (NaN) must follow the same branches as well
+        X_missing = np.array(self.X_test, dtype=float)
+        X_missing[:, 3:] = np.nan
+        self.assertEqual(compiled.predict(X_missing).tolist(),
+                         self.model.predict(X_missing).tolist())
+
 
 if __name__ == '__main__':
     unittest.main()